@@ -0,0 +1,190 @@
+"""Time the stages of a shelltest run over a synthetic corpus
+
+    python -m benchmarks.bench --files 200 --tests 20 --output results.json
+    python -m benchmarks.bench --baseline results.json
+"""
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus
+from terseparse import Arg, Parser, types
+
+from shelltest import __version__
+from shelltest.shelltest import (ShellTestFileFinder, ShellTestParser, ShellTestResultsFormatter,
+                                 ShellTestRunner)
+
+
+log = logging.getLogger(__name__)
+
+version = 1
+
+stages = ('find_paths', 'parse', 'run', 'format')
+
+
+def _time(fn, repeat):
+    """Call fn repeat times, returning its last result and the time each call took"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def _stats(times):
+    return {'min': min(times), 'median': statistics.median(times), 'times': times}
+
+
+def bench(root, repeat=5, run_files=20, jobs=1):
+    """Time each stage of a run over the shell test files in root
+    Parameters
+    ==========
+    root : str
+        directory of shell test files
+    repeat : int (default: 5)
+        number of times each stage is timed
+    run_files : int (default: 20)
+        only the tests of this many files are run and formatted, as running is much slower
+        than the other stages
+    jobs : int (default: 1)
+        jobs passed to ShellTestRunner.run
+
+    Returns
+    =======
+    (dict of stage name to timings, dict of counts)
+    """
+    timings = {}
+    paths, timings['find_paths'] = _time(
+        lambda: list(ShellTestFileFinder([root]).find_paths()), repeat)
+    tests, timings['parse'] = _time(
+        lambda: [t for p in paths for t in ShellTestParser(p).parse()], repeat)
+    run_paths = set(paths[:run_files])
+    run_tests = [t for t in tests if t.source.name in run_paths]
+    results, timings['run'] = _time(
+        lambda: list(ShellTestRunner(run_tests).run(jobs=jobs)), repeat)
+    _, timings['format'] = _time(lambda: ShellTestResultsFormatter(results).format(), repeat)
+    counts = {
+        'files': len(paths),
+        'tests': len(tests),
+        'run_tests': len(run_tests),
+        'failed': sum(1 for r in results if not r.status.success),
+    }
+    return {name: _stats(times) for name, times in timings.items()}, counts
+
+
+def compare(current, baseline, tolerance):
+    """Compare the minimum time of each stage to a baseline
+    Parameters
+    ==========
+    current, baseline : dict
+        benchmark results as written by main
+    tolerance : float
+        fraction a stage may be slower than the baseline before it is a regression
+
+    Returns
+    =======
+    (list of report lines, list of stages that regressed)
+    """
+    out = []
+    regressed = []
+    if current['params'] != baseline['params']:
+        out.append('warning: baseline was measured with different parameters {}'
+                   .format(baseline['params']))
+    for stage in stages:
+        if stage not in current['stages'] or stage not in baseline['stages']:
+            continue
+        cur = current['stages'][stage]['min']
+        base = baseline['stages'][stage]['min']
+        ratio = cur / base if base else float('inf')
+        line = '{:<12} {:10.4f}s {:10.4f}s {:7.2f}x'.format(stage, base, cur, ratio)
+        if ratio > 1 + tolerance:
+            regressed.append(stage)
+            line += '  REGRESSION'
+        out.append(line)
+    return out, regressed
+
+
+description = """benchmark shelltest over a synthetic corpus"""
+P = Parser(
+    "bench", description,
+    Arg('--files', 'number of shell test files', type=types.Int.positive, default=100),
+    Arg('--tests', 'number of tests in each file', type=types.Int.positive, default=20),
+    Arg('--output-lines', 'lines of output of each test', type=types.Int.positive, default=5),
+    Arg('--line-length', 'characters in each line of output', type=types.Int.positive,
+        default=40),
+    Arg('--escaped-newlines', 'percent of commands split with escaped newlines',
+        type=types.Int(0, 101), default=10),
+    Arg('--failure-rate', 'percent of tests with unexpected output', type=types.Int(0, 101),
+        default=0),
+    Arg('--seed', 'seed of the corpus generator', type=types.Int(), default=0),
+    Arg('--repeat', 'number of times each stage is timed', type=types.Int.positive, default=5),
+    Arg('--run-files', 'number of files whose tests are run and formatted',
+        type=types.Int.positive, default=20),
+    Arg(('-j', '--jobs'), 'number of shell test files to run in parallel',
+        type=types.Int.positive, default=1),
+    Arg('--corpus', 'directory to write the corpus to, a temporary directory by default'),
+    Arg('--output', 'file to write the results to as JSON'),
+    Arg('--baseline', 'JSON results of a previous run to compare against'),
+    Arg('--tolerance', 'percent a stage may be slower than the baseline',
+        type=types.Int.positive, default=20))
+
+
+def main():
+    parser, args = P.parse_args()
+    ns = args.ns
+    params = {
+        'files': ns.files,
+        'tests': ns.tests,
+        'output_lines': ns.output_lines,
+        'line_length': ns.line_length,
+        'escaped_newlines': ns.escaped_newlines,
+        'failure_rate': ns.failure_rate,
+        'seed': ns.seed,
+        'repeat': ns.repeat,
+        'run_files': ns.run_files,
+        'jobs': ns.jobs,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        root = ns.corpus or tmp
+        corpus.generate(root, ns.files, ns.tests, ns.output_lines, ns.line_length,
+                        ns.escaped_newlines / 100, ns.failure_rate / 100, ns.seed)
+        timings, counts = bench(root, ns.repeat, ns.run_files, ns.jobs)
+    results = {
+        'version': version,
+        'shelltest': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'counts': counts,
+        'stages': timings,
+    }
+    for stage in stages:
+        print('{:<12} {:10.4f}s min {:10.4f}s median'.format(
+            stage, timings[stage]['min'], timings[stage]['median']))
+    if ns.output:
+        os.makedirs(os.path.dirname(ns.output) or '.', exist_ok=True)
+        with open(ns.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if ns.baseline:
+        with open(ns.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != version:
+            sys.exit('baseline {!r} has unsupported version {!r}'
+                     .format(ns.baseline, baseline.get('version')))
+        out, regressed = compare(results, baseline, ns.tolerance / 100)
+        print('{:<12} {:>11} {:>11} {:>8}'.format('stage', 'baseline', 'current', 'ratio'))
+        print('\n'.join(out))
+        if regressed:
+            print('{} stage(s) regressed by more than {}%'.format(len(regressed), ns.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
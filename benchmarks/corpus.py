@@ -0,0 +1,68 @@
+"""Generate synthetic shell test files for benchmarking"""
+import os
+import random
+
+
+def _command(rng, output, escaped_newlines):
+    """Command printing the lines of output, split over escaped newlines for some tests"""
+    cmd = "printf '%s\\n'"
+    words = [cmd] + ["'{}'".format(line) for line in output]
+    if rng.random() < escaped_newlines and len(words) > 1:
+        return ' \\\n'.join(words)
+    return ' '.join(words)
+
+
+def _line(rng, length):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789 ') for _ in range(length))
+
+
+def generate_file(rng, tests=20, output_lines=5, line_length=40, escaped_newlines=0.1,
+                  failure_rate=0.0):
+    """Contents of a single shell test file"""
+    out = ['#!/usr/bin/env shelltest']
+    for _ in range(tests):
+        output = [_line(rng, line_length) for _ in range(output_lines)]
+        out.append('> ' + _command(rng, output, escaped_newlines))
+        if rng.random() < failure_rate:
+            output = output[:-1] + ['unexpected output']
+        out.extend(output)
+    return '\n'.join(out) + '\n'
+
+
+def generate(root, files=100, tests=20, output_lines=5, line_length=40, escaped_newlines=0.1,
+             failure_rate=0.0, seed=0):
+    """Write a corpus of shell test files to root
+    Parameters
+    ==========
+    root : str
+        directory the files are written to, in a tree of subdirectories of 10 files each
+    files : int (default: 100)
+        number of files
+    tests : int (default: 20)
+        number of tests in each file
+    output_lines : int (default: 5)
+        lines of output of each test
+    line_length : int (default: 40)
+        characters in each line of output
+    escaped_newlines : float (default: 0.1)
+        fraction of commands split over several lines with escaped newlines
+    failure_rate : float (default: 0.0)
+        fraction of tests whose expected output does not match
+    seed : int (default: 0)
+        seed of the random generator, the same seed generates the same corpus
+
+    Returns
+    =======
+    list of the paths written
+    """
+    rng = random.Random(seed)
+    paths = []
+    for n in range(files):
+        d = os.path.join(root, 'dir{:04d}'.format(n // 10))
+        os.makedirs(d, exist_ok=True)
+        path = os.path.join(d, 'test{:06d}.sh'.format(n))
+        with open(path, 'w') as f:
+            f.write(generate_file(rng, tests, output_lines, line_length, escaped_newlines,
+                                  failure_rate))
+        paths.append(path)
+    return paths
@@ -0,0 +1,12 @@
+#!/usr/bin/env shelltest
+#[sht] normalize = ansi
+> printf '\033[32mok\033[0m\n'
+ok
+> echo "build 1234 finished"
+build {{re:\d+}} finished
+> date +%Y-%m-%d #[sht] match = regex
+\d{4}-\d{2}-\d{2}
+> echo "report-$$.txt" #[sht] match = glob
+report-*.txt
+> awk 'BEGIN { print 1/3 }' #[sht] match = numeric #[sht] numeric_tolerance = 0.001
+0.333
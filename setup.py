@@ -28,6 +28,9 @@ setup(name='shelltest',
       entry_points = {
           'console_scripts': [
               'shelltest=shelltest.cli:main'
+          ],
+          'pytest11': [
+              'shelltest=shelltest.pytest_plugin'
           ]},
       python_requires='>=3',
       long_description="""
@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import logging
+import resource
+import shlex
+import time
+from asyncio.subprocess import PIPE
+
+from shelltest.shelltest import (_get_cwd, _get_env, _get_rlimits, _get_usage, _kill_group,
+                                 _launcher_args, _OutputBuffer, _OutputPrinter, _READ_SIZE,
+                                 _rlimit_exceeded, _set_rlimits, _status_str, ShellTestResult,
+                                 ShellTestRunner)
+
+
+log = logging.getLogger(__name__)
+
+
+async def _read(stream, buf, on_data=None):
+    """Read stream into the _OutputBuffer buf until EOF, buf holds the partial output if
+    cancelled"""
+    while True:
+        data = await stream.read(_READ_SIZE)
+        if not data:
+            break
+        buf.write(data)
+        if on_data is not None:
+            on_data(data)
+
+
+class AsyncShellTestRunner(ShellTestRunner):
+    """AsyncShellTestRunner runs shell tests on an asyncio event loop"""
+
+    def __init__(self, tests, concurrency=8, cache=None, hooks=None):
+        """Initialize an AsyncShellTestRunner
+        Parameters
+        ==========
+        tests : iterable of ShellTest
+        concurrency : int (default: 8)
+            maximum number of commands running at the same time
+        cache : ShellTestResultCache (default: None)
+            when given, tests that passed in a previous run are not run again
+        hooks : ShellTestHooks or iterable of ShellTestHooks (default: None)
+            told about each test and its phases, on the event loop's thread
+        """
+        super().__init__(tests, cache, hooks)
+        self._concurrency = concurrency
+
+    async def _start(self, test, cwd=None, env=None):
+        """Start the command of test with its resource limits"""
+        rlimits = _get_rlimits(test.cfg)
+        kwargs = dict(stdout=PIPE, stderr=PIPE, cwd=cwd or _get_cwd(test), env=env or _get_env(),
+                      start_new_session=True)
+        if not rlimits or not hasattr(resource, 'prlimit'):
+            preexec_fn = functools.partial(_set_rlimits, rlimits) if rlimits else None
+            return await asyncio.create_subprocess_exec(
+                *self._get_command(test), preexec_fn=preexec_fn, **kwargs)
+        # limits are set on a launcher while it waits for its command
+        proc = await asyncio.create_subprocess_exec(
+            *_launcher_args(shlex.split(test.cfg.command_shell)), stdin=PIPE, **kwargs)
+        try:
+            _set_rlimits(rlimits, proc.pid)
+            proc.stdin.write(test.command.encode('utf-8'))
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, ProcessLookupError):
+            pass
+        proc.stdin.close()
+        return proc
+
+    async def _execute(self, test, show_output, comparator=None, cwd=None, env=None):
+        if self._uses_session(test):
+            # Sessions are blocking, drive them from the default executor
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._execute_session, test, show_output,
+                                              cwd, env)
+        printer = _OutputPrinter() if show_output else None
+        start = time.perf_counter()
+        proc = await self._start(test, cwd, env)
+        self._phase(test, 'spawn', start)
+        start = time.perf_counter()
+        stdout = _OutputBuffer(test.cfg.spill_output_bytes, keep=comparator is None)
+        stderr = _OutputBuffer(test.cfg.spill_output_bytes)
+        max_bytes = test.cfg.max_output_bytes
+        timed_out = exceeded = False
+
+        def on_stderr(data):
+            nonlocal exceeded
+            if max_bytes is not None and not exceeded and stdout.size + stderr.size > max_bytes:
+                _kill_group(proc)
+                exceeded = True
+
+        def on_stdout(data):
+            if printer:
+                printer.write(data)
+            on_stderr(data)
+            if comparator is not None and comparator.feed(data):
+                _kill_group(proc)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(_read(proc.stdout, stdout, on_stdout),
+                               _read(proc.stderr, stderr, on_stderr)),
+                self._get_timeout(test))
+        except asyncio.TimeoutError:
+            _kill_group(proc)
+            timed_out = True
+        except asyncio.CancelledError:
+            _kill_group(proc)
+            await proc.wait()
+            raise
+        except BaseException:
+            _kill_group(proc)
+            raise
+        ret_code = await proc.wait()
+        self._phase(test, 'wait', start)
+        if printer:
+            printer.close()
+        err_output = stderr.excerpt()
+        stderr.close()
+        if not stdout.spilled:
+            stdout = stdout.excerpt()
+        if exceeded:
+            limit = 'max_output_bytes'
+        else:
+            limit = _rlimit_exceeded(test.cfg, ret_code)
+        # the event loop reaps the child, so no rusage is available
+        return stdout, err_output, ret_code, timed_out, None, limit
+
+    async def run_test(self, test, show_output=False):
+        """Run a single shell test
+        Parameters
+        ==========
+        test : ShellTest
+            Shell test to run
+        show_output : bool (default: False)
+            Show output from a command while it is running
+
+        Returns
+        =======
+        The ShellTestResult of running test
+        """
+        if self._hooks is None:
+            return await self._run_test(test, show_output)
+        start = time.perf_counter()
+        self._hooks.on_test_start(test)
+        result = await self._run_test(test, show_output)
+        self._hooks.on_test_end(result, start, time.perf_counter())
+        return result
+
+    async def _run_test(self, test, show_output):
+        key, result = self._cached_result(test)
+        if result is not None:
+            return result
+        if self._expired():
+            return self._expired_result(test)
+        loop = asyncio.get_running_loop()
+        # setting up fixtures and copying them is blocking
+        fixture = await loop.run_in_executor(None, self._get_fixture, test)
+        if fixture is not None and not fixture.ok:
+            return self._setup_failed_result(test, fixture)
+        cwd = env = None
+        if fixture is not None:
+            cwd = fixture.path
+            if test.cfg.isolated:
+                cwd = await loop.run_in_executor(None, fixture.copy)
+            env = fixture.env
+        comparator = self._get_comparator(test)
+        start = time.monotonic()
+        try:
+            actual_output, err_output, ret_code, timed_out, rusage, limit = \
+                await self._execute(test, show_output, comparator, cwd, env)
+        finally:
+            if fixture is not None and test.cfg.isolated:
+                fixture.remove(cwd)
+        usage = _get_usage(time.monotonic() - start, rusage)
+        start = time.perf_counter()
+        actual_output, out_verified, mismatch = \
+            self._compare_output(test, actual_output, comparator)
+        status = self.get_status(test, actual_output, ret_code, timed_out, out_verified, limit)
+        self._phase(test, 'compare', start)
+        self._cache_status(key, status)
+        return ShellTestResult(test, actual_output, err_output, ret_code, status, usage,
+                               mismatch)
+
+    async def _run_after(self, i, waits, futures, semaphore, show_tests, show_output):
+        """Run test i once the tests it waits for have finished, a test fails with the error
+        of a test it waits for"""
+        test = self.tests[i]
+        try:
+            if waits:
+                await asyncio.wait([futures[j] for j in waits])
+                for j in waits:
+                    if futures[j].exception() is not None:
+                        raise futures[j].exception()
+            async with semaphore:
+                res = await self.run_test(test, show_output)
+            self._test_finished(test)
+            if show_tests:
+                print('exec: {!r} ... {}'.format(test.command, _status_str(res.status)))
+            futures[i].set_result(res)
+        except Exception as e:
+            futures[i].set_exception(e)
+
+    async def run(self, show_tests=False, show_output=False, total_timeout=None):
+        """Run tests, files are run concurrently and tests within a file in order, unless they
+        are independent, name the tests they need or are isolated
+        Parameters
+        ==========
+        show_tests : bool (default: False)
+            display tests as they are executed
+        show_output : bool (default: False)
+            Show output from a command while it is running
+        total_timeout : float (default: None)
+            seconds all tests may run for
+
+        Returns
+        =======
+        An async generator of ShellTestResults, in the same order as the tests
+        """
+        if total_timeout is not None:
+            self._deadline = time.monotonic() + total_timeout
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self._concurrency)
+        futures = [loop.create_future() for _ in self.tests]
+        tasks = [asyncio.ensure_future(
+                    self._run_after(i, waits, futures, semaphore, show_tests, show_output))
+                 for i, waits in enumerate(self._dependencies())]
+        try:
+            for future in futures:
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.close()
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+
+from shelltest.match import compile_matcher
+from shelltest.shelltest import CompactShellTest, ShellTest, ShellTestConfig, ShellTestSource
+
+
+log = logging.getLogger(__name__)
+
+
+def _fingerprint(path):
+    """Fingerprint of a dependency file, changes when the file is modified"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _load_json(path, version):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != version:
+        log.debug('ignoring %r with version %r', path, data.get('version'))
+        return None
+    return data
+
+
+def _save_json(path, data):
+    """Atomically replace path with data"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class ShellTestResultCache:
+    """ShellTestResultCache records shell tests that passed so unchanged tests can be skipped
+
+    A test is identified by its command, expected output, configuration, the fingerprints
+    (size and mtime) of the files listed in its `depends` option and the keys of the tests it
+    waits for, so a change to an earlier test of a file invalidates the tests after it. Entries
+    are stored in a JSON file with the time they were last used, the least recently used
+    entries are evicted once there are more than max_entries.
+    """
+
+    version = 2
+
+    def __init__(self, path='.shelltest_cache', max_entries=100000):
+        """Initialize a ShellTestResultCache
+        Parameters
+        ==========
+        path : str
+            directory the cache is stored in
+        max_entries : int
+            maximum number of passing tests to remember
+        """
+        self._path = path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    @property
+    def _file(self):
+        return os.path.join(self._path, 'results.json')
+
+    def _load(self):
+        data = _load_json(self._file, self.version)
+        return data['entries'] if data else {}
+
+    def key(self, test, waits=()):
+        """Hash identifying test and the state of its dependencies
+        Parameters
+        ==========
+        test : ShellTest
+        waits : iterable of str (default: ())
+            keys of the tests test waits for
+        """
+        cwd = os.path.dirname(os.path.abspath(test.source.name))
+        depends = [(dep, _fingerprint(os.path.join(cwd, dep))) for dep in test.cfg.depends]
+        cfg = sorted((k, repr(v)) for k, v in test.cfg.items())
+        data = [cwd, test.command, test.expected_output, cfg, depends, list(waits)]
+        return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+    def passed(self, key):
+        """True if the test with key passed in a previous run"""
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = time.time()
+                return True
+        return False
+
+    def add(self, key):
+        """Record that the test with key passed"""
+        with self._lock:
+            self._entries[key] = time.time()
+
+    def save(self):
+        """Write the cache to disk, evicting the least recently used entries"""
+        with self._lock:
+            if len(self._entries) > self._max_entries:
+                keep = sorted(self._entries.items(), key=lambda kv: kv[1], reverse=True)
+                self._entries = dict(keep[:self._max_entries])
+            data = {'version': self.version, 'entries': self._entries}
+        _save_json(self._file, data)
+
+
+def source_key(source):
+    """Key of a ShellTestSource that is stable across runs"""
+    return '{}:{}'.format(os.path.abspath(source.name), source.line_num)
+
+
+class ShellTestRunHistory:
+    """ShellTestRunHistory records the outcome and duration of each test of previous runs
+
+    Tests are keyed by their ShellTestSource. Only tests that were run are updated, so the
+    history of tests left out of a run (e.g. by --last-failed) is kept.
+    """
+
+    version = 1
+
+    def __init__(self, path='.shelltest_cache'):
+        """Initialize a ShellTestRunHistory
+        Parameters
+        ==========
+        path : str
+            directory the history is stored in
+        """
+        self._file = os.path.join(path, 'history.json')
+        data = _load_json(self._file, self.version)
+        self._tests = data['tests'] if data else {}
+
+    def failed(self, source):
+        """True if the test at source failed the last time it was run"""
+        entry = self._tests.get(source_key(source))
+        return entry is not None and not entry['passed']
+
+    def duration(self, source):
+        """Wall time of the test at source the last time it was run, None if unknown"""
+        entry = self._tests.get(source_key(source))
+        return entry and entry.get('duration')
+
+    def file_durations(self):
+        """Total wall time of the tests of each file the last time they were run, keyed by
+        absolute path. Files with a test without a recorded duration are left out"""
+        totals = {}
+        for key, entry in self._tests.items():
+            path = key.rsplit(':', 1)[0]
+            duration = entry.get('duration')
+            if duration is None:
+                totals[path] = None
+            elif path not in totals or totals[path] is not None:
+                totals[path] = totals.get(path, 0) + duration
+        return {path: total for path, total in totals.items() if total is not None}
+
+    def failed_files(self):
+        """Absolute paths of files with a test that failed the last time it was run"""
+        return set(key.rsplit(':', 1)[0] for key, entry in self._tests.items()
+                   if not entry['passed'])
+
+    def last_failed(self, paths):
+        """Paths with previously failing tests, all paths if nothing failed"""
+        failed = self.failed_files()
+        selected = [p for p in paths if os.path.abspath(p) in failed]
+        return selected or paths
+
+    def failed_first(self, paths):
+        """Paths reordered so files with previously failing tests come first"""
+        failed = self.failed_files()
+        return sorted(paths, key=lambda p: os.path.abspath(p) not in failed)
+
+    def record(self, results):
+        """Generator passing results through while recording their outcome"""
+        for r in results:
+            entry = self._tests.setdefault(source_key(r.test.source), {})
+            entry['passed'] = r.status.success
+            if r.usage is not None:
+                entry['duration'] = r.usage.wall_time
+            yield r
+
+    def save(self):
+        _save_json(self._file, {'version': self.version, 'tests': self._tests})
+
+
+class ShellTestParseCache:
+    """ShellTestParseCache stores the tests parsed from shell test files
+
+    Entries are keyed by the absolute path of a file and invalidated when its size, mtime or
+    inode, the parser version or the configuration the file is parsed with changes. All
+    entries are kept in a single pickle file, so they are loaded with one read.
+    """
+
+    version = 2
+
+    def __init__(self, path='.shelltest_cache'):
+        """Initialize a ShellTestParseCache
+        Parameters
+        ==========
+        path : str
+            directory the cache is stored in
+        """
+        self._file = os.path.join(path, 'parse.pickle')
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self._file, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return {}
+        return data['entries']
+
+    def key(self, path, cfg, parser_version):
+        """Key of the current state of path parsed with cfg, None if path can not be read"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (parser_version, st.st_size, st.st_mtime_ns, st.st_ino,
+                tuple(sorted((k, repr(v)) for k, v in cfg.items())))
+
+    def get(self, path, key):
+        """Get the tests of path parsed when it had key
+        Returns
+        =======
+        (file ShellTestConfig, list of ShellTest) or None when path is not cached
+        """
+        if key is None:
+            return None
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is None or entry[0] != key:
+            return None
+        _, vals, tests = entry
+        cfg = ShellTestConfig(vals)
+        source_dir = os.path.dirname(os.path.abspath(path))
+        return cfg, [self._test(path, key, cmd, output, line_num,
+                                cfg.copy() if test_vals is None else ShellTestConfig(test_vals),
+                                source_dir)
+                     for cmd, output, line_num, test_vals in tests]
+
+    @classmethod
+    def _test(cls, path, key, cmd, output, line_num, cfg, source_dir):
+        src = ShellTestSource(path, line_num)
+        if isinstance(output, tuple):
+            # CompactShellTest's store the offsets of their output
+            _, size, mtime_ns, _, _ = key
+            return CompactShellTest(cmd, src, cfg, output, (mtime_ns, size))
+        return ShellTest(cmd, output, src, cfg, compile_matcher(output, cfg, source_dir))
+
+    def put(self, path, key, cfg, tests):
+        """Store the tests parsed from path, cfg is the configuration of the file"""
+        if key is None:
+            return
+        vals = dict(cfg.items())
+        # only the configs of tests with options of their own are stored
+        entry = (key, vals,
+                 [(t.command, t.span if isinstance(t, CompactShellTest) else t.expected_output,
+                   t.source.line_num, None if dict(t.cfg.items()) == vals else dict(t.cfg.items()))
+                  for t in tests])
+        with self._lock:
+            self._entries[os.path.abspath(path)] = entry
+            self._dirty = True
+
+    def save(self):
+        """Write the cache to disk if anything changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'version': self.version, 'entries': self._entries}
+            self._dirty = False
+        os.makedirs(os.path.dirname(self._file), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self._file, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._file)
@@ -1,19 +1,98 @@
+import json
 import logging
 import sys
 
-from terseparse import Parser, Arg, Lazy
+from terseparse import Parser, Arg, Lazy, types
 from shelltest import __version__
-from shelltest.shelltest import run
+from shelltest.cache import ShellTestParseCache, ShellTestResultCache, ShellTestRunHistory
+from shelltest.hooks import ChromeTraceProfiler
+from shelltest.reporters import DurationsReporter, JsonLinesReporter, JUnitXmlReporter
+from shelltest.shelltest import run, ShellTestConfig
+from shelltest.watch import watch
 
 
 log = logging.getLogger(__name__)
 
+# options describing a single run, they can not be combined with --watch
+_not_watched = ('shard', 'last_failed', 'failed_first', 'junit_xml', 'report_jsonl',
+                'report_durations', 'profile')
+
+
+class Shard(types.Type):
+    """Shard given as INDEX/COUNT, with 1 <= INDEX <= COUNT"""
+
+    name = 'INDEX/COUNT'
+    description = 'INDEX/COUNT'
+
+    def convert(self, val_str):
+        try:
+            index, count = (int(v) for v in val_str.split('/'))
+        except ValueError:
+            self.fail(val_str, 'Value must be INDEX/COUNT')
+        if not 1 <= index <= count:
+            self.fail(val_str, 'Value must satisfy: 1 <= INDEX <= COUNT')
+        return index, count
+
+
+class Seconds(types.Type):
+    """A positive number of seconds, which may be fractional"""
+
+    name = 'seconds'
+    description = 'seconds'
+
+    def convert(self, val_str):
+        try:
+            val = float(val_str)
+        except ValueError:
+            self.fail(val_str, 'Value must be a number')
+        if not val > 0:
+            self.fail(val_str, 'Value must satisfy: 0 < val')
+        return val
+
+
 description = """shelltest runner"""
 P = Parser("shelltest", description,
     Arg('--debug', 'enable verbose logging', action='store_true'),
     Arg('--verbose', 'show tests', action='store_true'),
     Arg('--show-output', 'show output from each test as it is run',
         action='store_true'),
+    Arg('--session', 'run the commands of each file in one long lived shell',
+        action='store_true', default=False),
+    Arg(('-j', '--jobs'), 'number of tests to run in parallel',
+        type=types.Int.positive, default=1),
+    Arg('--timeout', 'default seconds each test may run for before it is killed',
+        type=Seconds()),
+    Arg('--total-timeout', 'seconds the whole run may take, later tests time out once it expires',
+        type=Seconds()),
+    Arg('--durations', 'show the N slowest tests', type=types.Int.positive, default=0),
+    Arg('--incremental', 'skip tests that passed in a previous run and have not changed',
+        action='store_true', default=False),
+    Arg('--cache-dir', 'directory the results of previous runs are stored in, the outcome of '
+        'each test is recorded when it is given (default: .shelltest_cache)'),
+    Arg('--shard', 'only run shard INDEX of COUNT, shards are balanced by --shard-durations or '
+        'by file size', type=Shard()),
+    Arg('--shard-durations', 'JSON file of the durations of test files, as written by '
+        '--report-durations, used to balance shards'),
+    Arg('--include', 'only run files found in directories that match the glob pattern',
+        action='append'),
+    Arg('--exclude', 'skip files and directories matching the glob pattern',
+        action='append'),
+    Arg('--compact', 'read expected output from the test files when needed instead of '
+        'keeping it in memory', action='store_true', default=False),
+    Arg('--parse-cache', 'reuse tests parsed from unchanged files in previous runs',
+        action='store_true', default=False),
+    Arg('--last-failed', 'only run tests that failed in the previous run',
+        action='store_true', default=False),
+    Arg('--failed-first', 'run files with tests that failed in the previous run first',
+        action='store_true', default=False),
+    Arg('--watch', 'run the tests again whenever test files or their dependencies change',
+        action='store_true', default=False),
+    Arg('--junit-xml', 'write a JUnit XML report to the file as tests complete'),
+    Arg('--report-jsonl', 'write the result of each test to the file as JSON lines'),
+    Arg('--report-durations', 'write the duration of each test file to the file as JSON, '
+        'keyed by path relative to the current directory'),
+    Arg('--profile', 'write the time spent in each phase of the run to the file as a Chrome '
+        'trace'),
     Arg('--version', 'show version', action='version',
         version='%(prog)s ({})'.format(__version__)),
     Arg('paths', 'shell test file paths', nargs='+', metavar='path'))
@@ -24,9 +103,70 @@ def main():
     if args.ns.debug:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.basicConfig()
+    cfg = ShellTestConfig()
+    cfg.session = args.ns.session
+    cfg.timeout = args.ns.timeout
+    cache_dir = args.ns.cache_dir or '.shelltest_cache'
+    cache = ShellTestResultCache(cache_dir) if args.ns.incremental else None
+    parse_cache = ShellTestParseCache(cache_dir) if args.ns.parse_cache else None
+    if args.ns.watch:
+        given = [name for name in _not_watched if getattr(args.ns, name)]
+        if given:
+            parser.error('--watch can not be used with {}'.format(
+                ', '.join('--' + name.replace('_', '-') for name in given)))
+        watch(args.ns.paths,
+              show_tests=args.ns.verbose or args.ns.show_output,
+              show_output=args.ns.show_output,
+              jobs=args.ns.jobs,
+              cfg=cfg,
+              include=args.ns.include,
+              exclude=args.ns.exclude,
+              durations=args.ns.durations,
+              total_timeout=args.ns.total_timeout,
+              cache=cache,
+              parse_cache=parse_cache,
+              compact=args.ns.compact)
+        return
+    # history is only written when it is asked for, plain runs leave no files behind
+    history = None
+    if args.ns.cache_dir or args.ns.last_failed or args.ns.failed_first:
+        history = ShellTestRunHistory(cache_dir)
+    reporters = []
+    if args.ns.junit_xml:
+        reporters.append(JUnitXmlReporter(args.ns.junit_xml))
+    if args.ns.report_jsonl:
+        reporters.append(JsonLinesReporter(args.ns.report_jsonl))
+    if args.ns.report_durations:
+        reporters.append(DurationsReporter(args.ns.report_durations))
+    shard_durations = None
+    if args.ns.shard_durations:
+        try:
+            with open(args.ns.shard_durations, encoding='utf-8') as f:
+                shard_durations = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error('can not read --shard-durations {!r}: {}'.format(
+                args.ns.shard_durations, e))
+    profiler = ChromeTraceProfiler(args.ns.profile) if args.ns.profile else None
     results, fmt, failed_tests = run(args.ns.paths,
                                      show_tests=args.ns.verbose or args.ns.show_output,
-                                     show_output=args.ns.show_output)
-    print(fmt.format())
+                                     show_output=args.ns.show_output,
+                                     jobs=args.ns.jobs,
+                                     cfg=cfg,
+                                     total_timeout=args.ns.total_timeout,
+                                     cache=cache,
+                                     history=history,
+                                     last_failed=args.ns.last_failed,
+                                     failed_first=args.ns.failed_first,
+                                     parse_cache=parse_cache,
+                                     include=args.ns.include,
+                                     exclude=args.ns.exclude,
+                                     compact=args.ns.compact,
+                                     reporters=reporters,
+                                     shard=args.ns.shard,
+                                     hooks=profiler,
+                                     shard_durations=shard_durations)
+    print(fmt.format(durations=args.ns.durations))
+    if profiler is not None:
+        profiler.save()
     if failed_tests:
         sys.exit(1)
@@ -0,0 +1,210 @@
+from collections import deque, namedtuple
+
+
+# bytes of output kept for lines longer than expected and for the report of a difference
+_MAX_EXCERPT = 65536
+
+
+# line_num is the line of the actual output the first difference is on, expected and actual
+# are excerpts of the outputs around it
+ShellTestMismatch = namedtuple('ShellTestMismatch', ('line_num', 'expected', 'actual'))
+
+
+def _decode(data):
+    return data.decode('utf-8', errors='replace')
+
+
+def _strip_lines(lines):
+    """The whitespace stripped, non-empty lines of the iterable lines"""
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _strip_whitespace(string):
+    return _strip_lines(string.split('\n'))
+
+
+class StreamingComparator:
+    """StreamingComparator compares output to the expected output of a test as it arrives
+
+    Only a few lines of context are kept in memory. Once the output diverges the comparator
+    collects `context` more lines of output for the report and then stops, feed returns True
+    from then on when the process should be killed.
+    """
+
+    def __init__(self, expected_output, ignore_trailing_whitespace, kill=False, context=3):
+        """Initialize a StreamingComparator
+        Parameters
+        ==========
+        expected_output : str
+        ignore_trailing_whitespace : bool
+            compare whitespace stripped, non-empty lines as ShellTestRunner.check_output does
+        kill : bool (default: False)
+            request the process is killed once a mismatch has been reported
+        context : int (default: 3)
+            lines of context kept around the first difference
+        """
+        self._kill = kill
+        self._context = context
+        self._strip = ignore_trailing_whitespace
+        if self._strip:
+            self._expected = list(_strip_whitespace(expected_output))
+            # a partial line longer than any expected line, once stripped, can not match
+            self._max_partial = _MAX_EXCERPT + max(
+                (len(line.encode('utf-8')) for line in self._expected), default=0)
+        else:
+            self._expected = expected_output.encode('utf-8')
+        self._pos = 0
+        self._line_num = 0
+        self._partial = bytearray()
+        self._recent = deque(maxlen=context)
+        self._tail = None
+        self._mismatch_line = None
+        self._mismatch = None
+        self._finished = False
+
+    @property
+    def matched(self):
+        """True if the output matched, only valid after finish"""
+        return self._finished and self._mismatch is None
+
+    @property
+    def mismatch(self):
+        """ShellTestMismatch describing the first difference or None"""
+        return self._mismatch
+
+    @property
+    def done(self):
+        return self._mismatch is not None
+
+    def feed(self, data):
+        """Compare the next chunk of output
+        Returns
+        =======
+        True if the process producing the output should be killed
+        """
+        if self.done:
+            return self._kill
+        if self._tail is not None:
+            self._collect(data)
+        elif self._strip:
+            self._feed_lines(data)
+        else:
+            self._feed_exact(data)
+        return self._kill and self.done
+
+    def finish(self):
+        """Called once all output has been fed"""
+        if not self.done:
+            if self._tail is None:
+                if self._strip:
+                    self._finish_lines()
+                else:
+                    self._finish_exact()
+            if self._tail is not None:
+                self._report()
+        self._finished = True
+
+    def _collect(self, data):
+        self._tail += data
+        if self._tail.count(b'\n') > self._context or len(self._tail) > _MAX_EXCERPT:
+            self._report()
+
+    def _diverged(self, line_num, tail):
+        self._mismatch_line = line_num
+        self._tail = bytearray()
+        self._collect(tail)
+
+    def _feed_exact(self, data):
+        expected = self._expected[self._pos:self._pos + len(data)]
+        if expected == data:
+            self._pos += len(data)
+            return
+        i = next((i for i, (a, b) in enumerate(zip(expected, data)) if a != b),
+                 min(len(expected), len(data)))
+        self._exact_diverged(self._pos + i, data[i:])
+
+    def _exact_diverged(self, offset, rest):
+        self._pos = offset
+        line_start = self._expected.rfind(b'\n', 0, offset) + 1
+        line_num = self._expected.count(b'\n', 0, offset) + 1
+        self._diverged(line_num, self._expected[line_start:offset] + rest)
+
+    def _finish_exact(self):
+        if self._pos < len(self._expected):
+            self._exact_diverged(self._pos, b'')
+
+    def _feed_lines(self, data):
+        self._partial += data
+        start = 0
+        while self._tail is None and not self.done:
+            end = self._partial.find(b'\n', start)
+            if end == -1:
+                break
+            self._feed_line(bytes(self._partial[start:end + 1]))
+            start = end + 1
+        if self._tail is not None:
+            self._collect(self._partial[start:])
+        if self._tail is not None or self.done:
+            self._partial = bytearray()
+        else:
+            del self._partial[:start]
+            if len(self._partial) > self._max_partial:
+                self._bound_partial()
+
+    def _bound_partial(self):
+        """Keep the partial line from growing without bounds"""
+        stripped = bytes(self._partial).strip()
+        if len(stripped) > self._max_partial:
+            self._line_num += 1
+            self._diverged(self._line_num, stripped[:self._max_partial])
+            self._partial = bytearray()
+        else:
+            # whitespace around a line is not compared
+            self._partial = bytearray(stripped + b' ')
+
+    def _feed_line(self, line):
+        self._line_num += 1
+        stripped = _decode(line).strip()
+        if stripped:
+            if self._pos < len(self._expected) and stripped == self._expected[self._pos]:
+                self._pos += 1
+            else:
+                self._diverged(self._line_num, line)
+                return
+        self._recent.append(line)
+
+    def _finish_lines(self):
+        if self._partial:
+            self._feed_line(bytes(self._partial))
+            self._partial = bytearray()
+        if self._tail is None and self._pos < len(self._expected):
+            self._diverged(self._line_num + 1, b'')
+
+    def _report(self):
+        lines = bytes(self._tail).split(b'\n')
+        tail = b'\n'.join(lines[:self._context + 1])[:_MAX_EXCERPT]
+        if self._strip:
+            before = b''.join(self._recent)
+            start = max(0, self._pos - len(self._recent))
+            expected = '\n'.join(self._expected[start:self._pos + self._context + 1])
+        else:
+            line_start = self._expected.rfind(b'\n', 0, self._pos) + 1
+            start = line_start
+            for _ in range(self._context):
+                if start == 0:
+                    break
+                start = self._expected.rfind(b'\n', 0, start - 1) + 1
+            before = self._expected[start:line_start]
+            end = line_start
+            for _ in range(self._context + 1):
+                nl = self._expected.find(b'\n', end)
+                if nl == -1:
+                    end = len(self._expected)
+                    break
+                end = nl + 1
+            expected = _decode(self._expected[start:end])
+        self._mismatch = ShellTestMismatch(self._mismatch_line, expected, _decode(before + tail))
+        self._tail = None
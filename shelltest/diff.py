@@ -0,0 +1,195 @@
+import difflib
+from bisect import bisect_left
+from collections import Counter
+
+
+# Ranges with at most this many lines (both sides combined) are matched with difflib,
+# larger ranges are first split on lines that are unique to both sides (patience diff)
+_SMALL_RANGE = 2000
+
+
+def _longest_increasing(pairs):
+    """Longest subsequence of pairs, sorted by their first item, increasing in the second"""
+    tails = []
+    tail_idx = []
+    prev = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(k)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = k
+        prev[k] = tail_idx[pos - 1] if pos else None
+    out = []
+    k = tail_idx[-1] if tail_idx else None
+    while k is not None:
+        out.append(pairs[k])
+        k = prev[k]
+    return out[::-1]
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+    a_cnt = Counter(a[alo:ahi])
+    b_cnt = Counter(b[blo:bhi])
+    b_idx = {b[j]: j for j in range(blo, bhi) if b_cnt[b[j]] == 1}
+    pairs = [(i, b_idx[a[i]]) for i in range(alo, ahi)
+             if a_cnt[a[i]] == 1 and a[i] in b_idx]
+    return _longest_increasing(pairs)
+
+
+def _match(a, b, alo, ahi, blo, bhi, blocks):
+    """Append matching blocks (i, j, n) of a[alo:ahi] and b[blo:bhi] to blocks, in order"""
+    n = 0
+    while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+        n += 1
+    if n:
+        blocks.append((alo, blo, n))
+        alo, blo = alo + n, blo + n
+    m = 0
+    while alo < ahi - m and blo < bhi - m and a[ahi - m - 1] == b[bhi - m - 1]:
+        m += 1
+    ahi, bhi = ahi - m, bhi - m
+    if alo < ahi and blo < bhi:
+        if (ahi - alo) + (bhi - blo) <= _SMALL_RANGE:
+            sm = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+            for i, j, k in sm.get_matching_blocks():
+                if k:
+                    blocks.append((alo + i, blo + j, k))
+        else:
+            # without unique lines the range is left unmatched, it is replaced as a whole
+            anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+            for i, j in anchors:
+                _match(a, b, alo, i, blo, j, blocks)
+                blocks.append((i, j, 1))
+                alo, blo = i + 1, j + 1
+            if anchors and alo < ahi and blo < bhi:
+                _match(a, b, alo, ahi, blo, bhi, blocks)
+    if m:
+        blocks.append((ahi, bhi, m))
+
+
+def get_opcodes(a, b):
+    """Opcodes turning a into b, in the format of difflib.SequenceMatcher.get_opcodes"""
+    if len(a) + len(b) <= _SMALL_RANGE:
+        return difflib.SequenceMatcher(None, a, b).get_opcodes()
+    blocks = []
+    _match(a, b, 0, len(a), 0, len(b), blocks)
+    blocks.append((len(a), len(b), 0))
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                _, i1, _, j1, _ = opcodes.pop()
+                opcodes.append(('equal', i1, i, j1, j))
+            else:
+                opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+
+def group_opcodes(opcodes, context=3):
+    """Group opcodes into hunks with context lines, like
+    difflib.SequenceMatcher.get_grouped_opcodes"""
+    if not opcodes:
+        opcodes = [('equal', 0, 1, 0, 1)]
+    if opcodes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    nn = context + context
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+
+def summary(a, b):
+    """Lines describing the first difference between a and b"""
+    i = 0
+    while i < len(a) and i < len(b) and a[i] == b[i]:
+        i += 1
+    out = ['first difference at line {} ({} expected lines, {} actual lines)'
+           .format(i + 1, len(a), len(b))]
+    if i < len(a):
+        out.append('-' + a[i])
+    if i < len(b):
+        out.append('+' + b[i])
+    return out
+
+
+def unified_diff(a, b, fromfile='expected', tofile='actual', context=3,
+                 max_hunks=None, max_lines=None, max_input_lines=None):
+    """Unified diff of the lists of lines a and b, limited in size
+    Parameters
+    ==========
+    a, b : list of str
+        lines to compare, without line endings
+    fromfile, tofile : str
+        names used in the diff header
+    context : int (default: 3)
+        lines of context around each change
+    max_hunks : int (default: None)
+        maximum number of hunks shown
+    max_lines : int (default: None)
+        maximum number of lines of diff shown
+    max_input_lines : int (default: None)
+        when either input is longer only the first difference is summarized
+
+    Returns
+    =======
+    list of diff lines
+    """
+    if max_input_lines is not None and max(len(a), len(b)) > max_input_lines:
+        return summary(a, b)
+    groups = list(group_opcodes(get_opcodes(a, b), context))
+    if not groups:
+        return []
+    out = ['--- {}'.format(fromfile), '+++ {}'.format(tofile)]
+    for n, group in enumerate(groups):
+        if max_hunks is not None and n >= max_hunks:
+            out.append('... {} more hunk(s) not shown'.format(len(groups) - n))
+            break
+        first, last = group[0], group[-1]
+        out.append('@@ -{} +{} @@'.format(_format_range(first[1], last[2]),
+                                          _format_range(first[3], last[4])))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                out.extend(' ' + line for line in a[i1:i2])
+                continue
+            out.extend('-' + line for line in a[i1:i2])
+            out.extend('+' + line for line in b[j1:j2])
+        if max_lines is not None and len(out) > max_lines:
+            out = out[:max_lines]
+            out.append('... diff truncated after {} lines'.format(max_lines))
+            break
+    return out
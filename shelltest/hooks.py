@@ -0,0 +1,161 @@
+"""Hooks observing a shell test run
+
+A ShellTestHooks object is told as each file is found and parsed, as each test starts and ends,
+about the phases of each test and when the results are formatted. Events are called on the
+thread doing the work, and times are time.perf_counter() values.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+_thread_id = getattr(threading, 'get_native_id', threading.get_ident)
+
+
+class ShellTestHooks:
+    """ShellTestHooks receives the events of a run, subclasses override the events they need"""
+
+    def on_discover(self, path, start, end):
+        """The shell test file path was found, searching for it took from start to end"""
+
+    def on_parse(self, path, tests, start, end):
+        """The file path was parsed into the list of ShellTests tests"""
+
+    def on_test_start(self, test):
+        """The ShellTest test is about to run"""
+
+    def on_phase(self, test, phase, start, end):
+        """A phase of test took from start to end. Phases are 'spawn' (starting the command),
+        'wait' (running it and capturing its output), 'compare' (checking its output) and
+        'diff' (formatting a failed result)"""
+
+    def on_test_end(self, result, start, end):
+        """The test of the ShellTestResult result ran from start to end"""
+
+    def on_report(self, text, start, end):
+        """The results were formatted as text"""
+
+
+class _HookList(ShellTestHooks):
+    """Passes each event on to several ShellTestHooks in turn"""
+
+    def __init__(self, hooks):
+        self._hooks = hooks
+
+    def on_discover(self, path, start, end):
+        for hooks in self._hooks:
+            hooks.on_discover(path, start, end)
+
+    def on_parse(self, path, tests, start, end):
+        for hooks in self._hooks:
+            hooks.on_parse(path, tests, start, end)
+
+    def on_test_start(self, test):
+        for hooks in self._hooks:
+            hooks.on_test_start(test)
+
+    def on_phase(self, test, phase, start, end):
+        for hooks in self._hooks:
+            hooks.on_phase(test, phase, start, end)
+
+    def on_test_end(self, result, start, end):
+        for hooks in self._hooks:
+            hooks.on_test_end(result, start, end)
+
+    def on_report(self, text, start, end):
+        for hooks in self._hooks:
+            hooks.on_report(text, start, end)
+
+
+def combine_hooks(hooks):
+    """A single ShellTestHooks for hooks, None when there are none
+    Parameters
+    ==========
+    hooks : ShellTestHooks, iterable of ShellTestHooks or None
+    """
+    if hooks is None or isinstance(hooks, ShellTestHooks):
+        return hooks
+    hooks = list(hooks)
+    if not hooks:
+        return None
+    return hooks[0] if len(hooks) == 1 else _HookList(hooks)
+
+
+class ChromeTraceProfiler(ShellTestHooks):
+    """ChromeTraceProfiler records the events of a run in the Chrome trace event format
+
+    Every thread doing work is a row of the trace, with the phases of each test nested in the
+    test. The trace is written by save and can be opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, path):
+        """Initialize a ChromeTraceProfiler
+        Parameters
+        ==========
+        path : str or file like object
+            path to write the trace to or file like object to write to
+        """
+        self._path = path
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def _span(self, name, cat, start, end, args):
+        tid = _thread_id()
+        if tid not in self._threads:
+            with self._lock:
+                self._threads[tid] = threading.current_thread().name
+        # list.append is atomic, events of worker threads need no lock
+        self._events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': self._pid, 'tid': tid,
+                             'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+                             'args': args})
+
+    @classmethod
+    def _location(cls, test):
+        return '{}:{}'.format(test.source.name, test.source.line_num)
+
+    def on_discover(self, path, start, end):
+        self._span('discover', 'discover', start, end, {'path': path})
+
+    def on_parse(self, path, tests, start, end):
+        self._span('parse', 'parse', start, end, {'path': path, 'tests': len(tests)})
+
+    def on_phase(self, test, phase, start, end):
+        self._span(phase, 'phase', start, end, {'test': self._location(test)})
+
+    def on_test_end(self, result, start, end):
+        self._span(self._location(result.test), 'test', start, end,
+                   {'command': result.test.command, 'success': result.status.success})
+
+    def on_report(self, text, start, end):
+        self._span('report', 'report', start, end, {})
+
+    @property
+    def events(self):
+        """Trace events recorded so far, with a thread_name event for each thread"""
+        meta = [{'name': 'process_name', 'ph': 'M', 'pid': self._pid, 'tid': 0,
+                 'args': {'name': 'shelltest'}}]
+        meta += [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                  'args': {'name': name}} for tid, name in self._thread_names()]
+        return meta + list(self._events)
+
+    def _thread_names(self):
+        with self._lock:
+            return sorted(self._threads.items())
+
+    def save(self):
+        """Write the trace"""
+        trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        if isinstance(self._path, str):
+            with open(self._path, 'w', encoding='utf-8') as fobj:
+                json.dump(trace, fobj)
+        else:
+            json.dump(trace, self._path)
+            self._path.flush()
+        log.debug('wrote %d trace events to %r', len(trace['traceEvents']), self._path)
@@ -0,0 +1,223 @@
+import codecs
+import fnmatch
+import math
+import os
+import re
+import tempfile
+
+from shelltest.compare import _MAX_EXCERPT, _strip_lines
+
+
+# ANSI escape sequences: CSI (colors, cursor movement), OSC (titles, links) and two byte escapes
+_ansi = r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]'
+
+_number = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+_re_number = re.compile(_number)
+
+# {{re:PATTERN}} in expected output matches PATTERN
+_re_marker = re.compile(r'\{\{re:(.*?)\}\}')
+
+modes = ('exact', 'regex', 'glob', 'numeric')
+
+normalizers = ('ansi', 'paths')
+
+
+def _literal_pattern(line, numbers=None):
+    """Regex matching line literally except for its markers
+
+    When numbers is a list, numbers in the literal text are matched by the groups _n0, _n1, ...
+    and appended to it
+    """
+    out = []
+    pos = 0
+    for m in _re_marker.finditer(line):
+        out.append(_literal(line[pos:m.start()], numbers))
+        out.append('(?:{})'.format(m.group(1)))
+        pos = m.end()
+    out.append(_literal(line[pos:], numbers))
+    return ''.join(out)
+
+
+def _literal(text, numbers):
+    if numbers is None:
+        return re.escape(text)
+    parts = []
+    pos = 0
+    for m in _re_number.finditer(text):
+        parts.append(re.escape(text[pos:m.start()]))
+        parts.append('(?P<_n{}>{})'.format(len(numbers), _number))
+        numbers.append(float(m.group()))
+        pos = m.end()
+    parts.append(re.escape(text[pos:]))
+    return ''.join(parts)
+
+
+class _Line:
+    """A line of expected output compiled for one comparison mode"""
+
+    __slots__ = ('text', 'regex', 'numbers')
+
+    def __init__(self, text, mode):
+        self.text = text
+        self.regex = None
+        self.numbers = None
+        if mode == 'regex':
+            self.regex = re.compile(text)
+        elif mode == 'glob':
+            self.regex = re.compile(fnmatch.translate(text))
+        elif mode == 'numeric':
+            self.numbers = []
+            self.regex = re.compile(_literal_pattern(text, self.numbers))
+        elif _re_marker.search(text):
+            self.regex = re.compile(_literal_pattern(text))
+
+    def match(self, line, tolerance):
+        if self.regex is None:
+            return line == self.text
+        m = self.regex.fullmatch(line)
+        if m is None:
+            return False
+        if self.numbers is None:
+            return True
+        return all(math.isclose(float(m.group('_n{}'.format(i))), e,
+                                rel_tol=tolerance, abs_tol=tolerance)
+                   for i, e in enumerate(self.numbers))
+
+
+class ShellTestMatcher:
+    """ShellTestMatcher compares output to the expected output of a test
+
+    The expected output is compiled once, each line as a literal (with {{re:PATTERN}} markers),
+    a regex, a glob or a line of numbers compared with a tolerance. The actual output is
+    normalized and compared line by line in a single pass.
+    """
+
+    def __init__(self, expected_output, mode='exact', normalize=(),
+                 ignore_trailing_whitespace=True, tolerance=1e-6, source_dir=None):
+        """Initialize a ShellTestMatcher
+        Parameters
+        ==========
+        expected_output : str
+        mode : str (default: 'exact')
+            one of shelltest.match.modes
+        normalize : iterable of str (default: ())
+            normalizations of the actual output, from shelltest.match.normalizers. 'ansi' removes
+            ANSI escape sequences, 'paths' replaces source_dir with $SHELLTEST_DIR and the
+            temporary directory with $TMP
+        ignore_trailing_whitespace : bool (default: True)
+            compare whitespace stripped, non-empty lines
+        tolerance : float (default: 1e-6)
+            relative and absolute tolerance of numbers in numeric mode
+        source_dir : str (default: None)
+            directory of the shell test file
+        """
+        if mode not in modes:
+            raise ValueError('invalid match mode {!r}, must be one of {}'.format(mode, modes))
+        unknown = set(normalize) - set(normalizers)
+        if unknown:
+            raise ValueError('invalid normalizations {}, must be in {}'.format(
+                sorted(unknown), normalizers))
+        self._key = (expected_output, mode, tuple(normalize), ignore_trailing_whitespace,
+                     tolerance, source_dir)
+        self._strip = ignore_trailing_whitespace
+        self._tolerance = tolerance
+        lines = expected_output.split('\n')
+        if self._strip:
+            lines = _strip_lines(lines)
+        self._lines = [_Line(line, mode) for line in lines]
+        # longer lines of output are only compared by their start
+        self._max_line = _MAX_EXCERPT + max((len(line.text) for line in self._lines), default=0)
+        self._normalize, self._replacements = self._compile_normalize(normalize, source_dir)
+
+    def __eq__(self, other):
+        return isinstance(other, ShellTestMatcher) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return 'ShellTestMatcher{!r}'.format(self._key[1:])
+
+    @classmethod
+    def _compile_normalize(cls, normalize, source_dir):
+        """One regex matching everything that is normalized, and the replacement of each group"""
+        patterns = []
+        replacements = []
+        if 'ansi' in normalize:
+            patterns.append(_ansi)
+            replacements.append('')
+        if 'paths' in normalize:
+            # longer paths first, the source directory may be in the temporary directory
+            paths = [(os.path.realpath(tempfile.gettempdir()), '$TMP'),
+                     (tempfile.gettempdir(), '$TMP')]
+            if source_dir is not None:
+                paths += [(os.path.abspath(source_dir), '$SHELLTEST_DIR'),
+                          (os.path.realpath(source_dir), '$SHELLTEST_DIR')]
+            for path, replacement in sorted(set(paths), key=lambda p: -len(p[0])):
+                patterns.append(re.escape(path))
+                replacements.append(replacement)
+        if not patterns:
+            return None, None
+        regex = re.compile('|'.join('({})'.format(p) for p in patterns))
+        return regex, replacements
+
+    def normalize(self, text):
+        if self._normalize is None:
+            return text
+        return self._normalize.sub(lambda m: self._replacements[m.lastindex - 1], text)
+
+    def _match_lines(self, lines):
+        if self._strip:
+            lines = _strip_lines(lines)
+        expected = iter(self._lines)
+        for line in lines:
+            exp = next(expected, None)
+            if exp is None or not exp.match(self.normalize(line), self._tolerance):
+                return False
+        return next(expected, None) is None
+
+    def match(self, actual_output):
+        """True if actual_output matches the expected output"""
+        return self._match_lines(actual_output.split('\n'))
+
+    def match_chunks(self, chunks):
+        """True if the output in the iterable of byte chunks matches the expected output
+
+        Only the first characters of very long lines are kept, enough to tell them apart from
+        any line of the expected output.
+        """
+        return self._match_lines(_gen_lines(chunks, self._max_line))
+
+
+def _gen_lines(chunks, max_line=None):
+    """Decoded lines of the output in chunks, as str.split('\n') would split them
+
+    Lines longer than max_line characters are cut to max_line characters, the rest of such a
+    line is dropped as it arrives.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = ''
+    truncated = False
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if truncated:
+            end = text.find('\n')
+            if end < 0:
+                continue
+            text = text[end:]
+            truncated = False
+        lines = (partial + text).split('\n')
+        partial = lines.pop()
+        yield from lines
+        if max_line is not None and len(partial) > max_line:
+            partial = partial[:max_line]
+            truncated = True
+    yield partial + ('' if truncated else decoder.decode(b'', final=True))
+
+
+def compile_matcher(expected_output, cfg, source_dir=None):
+    """ShellTestMatcher for a test, None when it is compared with ShellTestRunner.check_output"""
+    if cfg.match == 'exact' and not cfg.normalize and '{{re:' not in expected_output:
+        return None
+    return ShellTestMatcher(expected_output, cfg.match, cfg.normalize,
+                            cfg.ignore_trailing_whitespace, cfg.numeric_tolerance, source_dir)
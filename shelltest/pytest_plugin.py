@@ -0,0 +1,124 @@
+"""pytest plugin collecting shell test files
+
+Enable it with `--shelltest` or `shelltest = true` in the pytest configuration. Each shell test
+file becomes a pytest.File with one item per command. Files are only parsed when pytest
+collects them, and with pytest-xdist the tests of a file are kept on one worker.
+"""
+import logging
+import os
+
+import pytest
+
+from shelltest.cache import ShellTestParseCache
+from shelltest.shelltest import (ShellTestConfig, ShellTestFileFinder, ShellTestParser,
+                                 ShellTestResultsFormatter, ShellTestRunner)
+from shelltest.unittest import get_test_name
+
+
+log = logging.getLogger(__name__)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('shelltest')
+    group.addoption('--shelltest', action='store_true', default=None,
+                    help='collect shell test files (.sh and .shtest)')
+    group.addoption('--shelltest-timeout', type=float, default=None,
+                    help='default seconds each shell test may run for')
+    parser.addini('shelltest', 'collect shell test files', type='bool', default=False)
+
+
+def _enabled(config):
+    enabled = config.getoption('shelltest')
+    return config.getini('shelltest') if enabled is None else enabled
+
+
+def pytest_configure(config):
+    if not _enabled(config):
+        return
+    cfg = ShellTestConfig()
+    cfg.timeout = config.getoption('shelltest_timeout')
+    config._shelltest_cfg = cfg
+    config._shelltest_parse_cache = None
+    if getattr(config, 'cache', None) is not None:
+        path = str(config.cache.mkdir('shelltest'))
+        config._shelltest_parse_cache = ShellTestParseCache(path)
+
+
+def pytest_collect_file(file_path, parent):
+    config = parent.config
+    cfg = getattr(config, '_shelltest_cfg', None)
+    if cfg is not None and ShellTestFileFinder.is_shelltest_file(str(file_path), cfg):
+        return ShellTestFile.from_parent(parent, path=file_path)
+
+
+def pytest_collection_finish(session):
+    parse_cache = getattr(session.config, '_shelltest_parse_cache', None)
+    if parse_cache is not None:
+        parse_cache.save()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_make_scheduler(config, log):
+    """Schedule with xdist_group marks, so each shell test file is run by a single worker
+
+    The scheduler is chosen before anything is collected, so with the plugin enabled and
+    `--dist load` (the default of `-n`) it replaces the scheduler of the whole session. Python
+    tests without an xdist_group mark are still scheduled one at a time. Pass another `--dist`
+    mode to keep it.
+    """
+    if getattr(config, '_shelltest_cfg', None) is None or config.getvalue('dist') != 'load':
+        return None
+    from xdist.scheduler import LoadGroupScheduling
+    return LoadGroupScheduling(config, log)
+
+
+class ShellTestFailure(Exception):
+    """Raised by ShellTestItem.runtest with the ShellTestResult of a failed test"""
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class ShellTestFile(pytest.File):
+    """A shell test file, its tests share one ShellTestRunner"""
+
+    def collect(self):
+        config = self.config
+        parser = ShellTestParser(str(self.path), config._shelltest_cfg,
+                                 config._shelltest_parse_cache)
+        tests = parser.parse()
+        self.runner = ShellTestRunner(tests)
+        group = config.pluginmanager.hasplugin('xdist') and \
+            pytest.mark.xdist_group(os.path.abspath(str(self.path)))
+        for test in tests:
+            item = ShellTestItem.from_parent(self, name=get_test_name(test), test=test)
+            if group:
+                item.add_marker(group)
+            yield item
+
+    def teardown(self):
+        runner = getattr(self, 'runner', None)
+        if runner is not None:
+            runner.close()
+
+
+class ShellTestItem(pytest.Item):
+    """A single command of a shell test file"""
+
+    def __init__(self, *, test, **kwargs):
+        super().__init__(**kwargs)
+        self.test = test
+
+    def runtest(self):
+        result = self.parent.runner.run_test(self.test)
+        if not result.status.success:
+            raise ShellTestFailure(result)
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, ShellTestFailure):
+            return ShellTestResultsFormatter.format_result(excinfo.value.result)
+        return super().repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.path, self.test.source.line_num - 1, 'shelltest: {}'.format(self.test.command)
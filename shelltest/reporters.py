@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+from shelltest.shelltest import ShellTestResultsFormatter
+
+
+log = logging.getLogger(__name__)
+
+
+def report(results, reporters):
+    """Generator passing results through while reporting each one as it arrives
+    Parameters
+    ==========
+    results : iterable of ShellTestResult
+    reporters : iterable of ShellTestReporter
+        started before the first result and finished once results is exhausted or the
+        generator is closed
+    """
+    reporters = list(reporters)
+    for reporter in reporters:
+        reporter.start()
+    try:
+        for r in results:
+            for reporter in reporters:
+                reporter.report(r)
+            yield r
+    finally:
+        for reporter in reporters:
+            reporter.finish()
+
+
+class ShellTestReporter:
+    """ShellTestReporter writes results as they are produced
+
+    Reporters write to a path, which is opened by start and closed by finish, or to a file like
+    object that is left open. Subclasses implement _start, _report and _finish.
+    """
+
+    def __init__(self, path):
+        """Initialize a ShellTestReporter
+        Parameters
+        ==========
+        path : str or file like object
+            path to write the report to or file like object to write to
+        """
+        self._path = path
+        self._fobj = None
+
+    def start(self):
+        if isinstance(self._path, str):
+            self._fobj = open(self._path, 'w', encoding='utf-8')
+        else:
+            self._fobj = self._path
+        self._start()
+
+    def report(self, result):
+        self._report(result)
+
+    def finish(self):
+        if self._fobj is None:
+            return
+        try:
+            self._finish()
+            self._fobj.flush()
+        finally:
+            if isinstance(self._path, str):
+                self._fobj.close()
+            self._fobj = None
+
+    def _start(self):
+        pass
+
+    def _report(self, result):
+        pass
+
+    def _finish(self):
+        pass
+
+
+class JsonLinesReporter(ShellTestReporter):
+    """JsonLinesReporter writes one JSON object per result, output is only kept for failures"""
+
+    @classmethod
+    def to_dict(cls, result):
+        test = result.test
+        usage = result.usage
+        out = {
+            'file': test.source.name,
+            'line': test.source.line_num,
+            'command': test.command,
+            'success': result.status.success,
+            'ret_code': result.ret_code,
+            'timed_out': result.status.timed_out,
+            'cached': result.status.cached,
+            'wall_time': usage and usage.wall_time,
+        }
+        if not result.status.success:
+            out['reason'] = ShellTestResultsFormatter.failure_reason(result)
+            out['expected_output'] = test.expected_output
+            out['actual_output'] = result.actual_output
+            out['err_output'] = result.err_output
+            if result.mismatch is not None:
+                out['mismatch_line'] = result.mismatch.line_num
+        return out
+
+    def _report(self, result):
+        self._fobj.write(json.dumps(self.to_dict(result)) + '\n')
+        self._fobj.flush()
+
+
+# Characters that are not allowed in XML 1.0 documents
+_re_xml_invalid = re.compile('[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+
+def _xml_text(text):
+    return escape(_re_xml_invalid.sub('\ufffd', text))
+
+
+def _xml_attr(text):
+    return quoteattr(_re_xml_invalid.sub('\ufffd', text))
+
+
+class JUnitXmlReporter(ShellTestReporter):
+    """JUnitXmlReporter writes a JUnit XML report with a testsuite per shell test file
+
+    Results arrive grouped by file, so only the test cases of the current file are held in
+    memory until its testsuite element is written.
+    """
+
+    def __init__(self, path, name='shelltest'):
+        """Initialize a JUnitXmlReporter
+        Parameters
+        ==========
+        path : str or file like object
+            path to write the report to or file like object to write to
+        name : str (default: 'shelltest')
+            name of the testsuites element
+        """
+        super().__init__(path)
+        self._name = name
+        self._suite = None
+        self._cases = []
+        self._failures = 0
+        self._time = 0.0
+
+    def _start(self):
+        self._fobj.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self._fobj.write('<testsuites name={}>\n'.format(_xml_attr(self._name)))
+
+    def _testcase(self, result):
+        test = result.test
+        wall_time = result.usage.wall_time if result.usage is not None else 0.0
+        case = '  <testcase classname={} name={} file={} line="{}" time="{:.3f}"'.format(
+            _xml_attr(test.source.name), _xml_attr(test.command), _xml_attr(test.source.name),
+            test.source.line_num, wall_time)
+        if result.status.success:
+            return case + '/>\n', wall_time
+        reason = ShellTestResultsFormatter.failure_reason(result)
+        text = ShellTestResultsFormatter.format_result(result)
+        failure = '    <failure message={}>{}</failure>\n'.format(
+            _xml_attr(reason), _xml_text(text))
+        return case + '>\n' + failure + '  </testcase>\n', wall_time
+
+    def _write_suite(self):
+        if self._suite is None:
+            return
+        self._fobj.write(
+            ' <testsuite name={} tests="{}" failures="{}" errors="0" time="{:.3f}">\n'.format(
+                _xml_attr(self._suite), len(self._cases), self._failures, self._time))
+        self._fobj.writelines(self._cases)
+        self._fobj.write(' </testsuite>\n')
+        self._fobj.flush()
+        self._cases = []
+        self._failures = 0
+        self._time = 0.0
+
+    def _report(self, result):
+        if result.test.source.name != self._suite:
+            self._write_suite()
+            self._suite = result.test.source.name
+        case, wall_time = self._testcase(result)
+        self._cases.append(case)
+        self._failures += not result.status.success
+        self._time += wall_time
+
+    def _finish(self):
+        self._write_suite()
+        self._suite = None
+        self._fobj.write('</testsuites>\n')
+
+
+class DurationsReporter(ShellTestReporter):
+    """DurationsReporter writes the total wall time of the tests of each file as a JSON object
+
+    Files are keyed by their path relative to root, the format read by `--shard-durations`.
+    Files with a test that did not run, e.g. a cached one, are left out.
+    """
+
+    def __init__(self, path, root=None):
+        """Initialize a DurationsReporter
+        Parameters
+        ==========
+        path : str or file like object
+            path to write the report to or file like object to write to
+        root : str (default: None)
+            directory paths are relative to, the current directory by default
+        """
+        super().__init__(path)
+        self._root = root
+        self._totals = {}
+
+    def _start(self):
+        self._totals = {}
+
+    def _report(self, result):
+        name = result.test.source.name
+        if name in self._totals and self._totals[name] is None:
+            return
+        if result.usage is None:
+            self._totals[name] = None
+        else:
+            self._totals[name] = self._totals.get(name, 0.0) + result.usage.wall_time
+
+    def _finish(self):
+        root = self._root or os.getcwd()
+        durations = {os.path.relpath(os.path.abspath(name), root): total
+                     for name, total in self._totals.items() if total is not None}
+        json.dump(durations, self._fobj, indent=1, sort_keys=True)
+        self._fobj.write('\n')
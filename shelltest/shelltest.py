@@ -1,25 +1,62 @@
-from collections import defaultdict, namedtuple
-from collections.abc import MutableMapping
-import difflib
+import codecs
+import fcntl
+import fnmatch
+import functools
+import heapq
 import itertools
 import logging
+import mmap
 import os
 import re
+import resource
+import selectors
 import shlex
-from subprocess import Popen, PIPE
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+from subprocess import PIPE, Popen
+
+from shelltest import diff, match
+from shelltest.compare import _decode, _strip_whitespace, StreamingComparator
+from shelltest.hooks import combine_hooks
 
 
 log = logging.getLogger(__name__)
 
 
-ShellTest = namedtuple('ShellTest', ('command', 'expected_output', 'source', 'cfg'))
+# matcher is a shelltest.match.ShellTestMatcher compiled from the expected output when the test
+# is not compared exactly, see shelltest.match.compile_matcher
+ShellTest = namedtuple('ShellTest', ('command', 'expected_output', 'source', 'cfg', 'matcher'),
+                       defaults=(None,))
 
 ShellTestSource = namedtuple('ShellTestSource', ('name', 'line_num'))
 
-ShellTestResultStatus = namedtuple('ShellTestResult', ('success', 'output_verified', 'ret_code_verified'))
+# setup_failed is set when the setup command of the test's file failed and the test was not run,
+# limit_exceeded is the name of the option limiting the resource the command was killed for using
+ShellTestResultStatus = namedtuple('ShellTestResult',
+                                   ('success', 'output_verified', 'ret_code_verified', 'timed_out',
+                                    'cached', 'setup_failed', 'limit_exceeded'),
+                                   defaults=(False, False, False, None))
 
+# mismatch is a ShellTestMismatch when the output was compared with a StreamingComparator,
+# actual_output then only holds an excerpt of the output
 ShellTestResult = namedtuple('ShellTestResult',
-                             ('test', 'actual_output', 'err_output', 'ret_code', 'status'))
+                             ('test', 'actual_output', 'err_output', 'ret_code', 'status', 'usage',
+                              'mismatch'),
+                             defaults=(None, None))
+
+# max_rss is in bytes, times are in seconds. Only wall_time is known for commands not run
+# in their own process (e.g. session mode)
+ShellTestResourceUsage = namedtuple('ShellTestResourceUsage',
+                                    ('wall_time', 'user_time', 'system_time', 'max_rss'),
+                                    defaults=(None, None, None))
 
 ShellTestConfigOption = namedtuple('ShellTestConfigOption', 'name,default,editable,typ')
 
@@ -33,6 +70,8 @@ class ShellTestOptionNotEditable(Exception):
 
 
 def bool_typ(s):
+    if isinstance(s, bool):
+        return s
     s = s.lower()
     if s == 'false':
         return False
@@ -41,23 +80,108 @@ def bool_typ(s):
     raise ValueError('invalid boolean value {!r}'.format(s))
 
 
+def str_or_none_typ(s):
+    if s is None or s.lower() == 'none':
+        return None
+    return s
+
+
+def float_or_none_typ(s):
+    if s is None or (isinstance(s, str) and s.lower() == 'none'):
+        return None
+    return float(s)
+
+
+def int_or_none_typ(s):
+    if s is None or (isinstance(s, str) and s.lower() == 'none'):
+        return None
+    return int(s)
+
+
+def list_typ(s):
+    if isinstance(s, str):
+        return tuple(s.replace(',', ' ').split())
+    return tuple(s)
+
+
+def int_list_typ(s):
+    return tuple(int(n) for n in list_typ(s))
+
+
+def match_typ(s):
+    if s not in match.modes:
+        raise ValueError('invalid match mode {!r}, must be one of {}'.format(s, match.modes))
+    return s
+
+
+def normalize_typ(s):
+    s = list_typ(s)
+    unknown = [n for n in s if n not in match.normalizers]
+    if unknown:
+        raise ValueError('invalid normalizations {}, must be in {}'.format(
+            unknown, match.normalizers))
+    return s
+
+
+_options = (
+    opt('command_prompt', '>', True, str),
+    opt('command_shell', 'sh -c', True, str),
+    opt('ignore_trailing_whitespace', True, True, bool_typ),
+    opt('session', False, True, bool_typ),
+    opt('timeout', None, True, float_or_none_typ),
+    opt('depends', (), True, list_typ),
+    opt('streaming_compare', False, True, bool_typ),
+    opt('kill_on_mismatch', False, True, bool_typ),
+    opt('max_output_bytes', None, True, int_or_none_typ),
+    opt('spill_output_bytes', 16 * 2**20, True, int_or_none_typ),
+    opt('setup', None, True, str_or_none_typ),
+    opt('isolated', False, True, bool_typ),
+    opt('match', 'exact', True, match_typ),
+    opt('normalize', (), True, normalize_typ),
+    opt('numeric_tolerance', 1e-6, True, float),
+    opt('prespawn', False, True, bool_typ),
+    opt('max_memory', None, True, int_or_none_typ),
+    opt('max_cpu_seconds', None, True, int_or_none_typ),
+    opt('max_open_files', None, True, int_or_none_typ),
+    opt('max_processes', None, True, int_or_none_typ),
+    opt('independent', False, True, bool_typ),
+    opt('needs', (), True, int_list_typ),
+    opt('shell_test_exts', ('sh', 'shtest'), False, list))
+
+_options_by_name = { op.name:op for op in _options }
+
+_defaults = { op.name:op.default for op in _options }
+
+
 class ShellTestConfig(MutableMapping):
-    """ShellTestConfig"""
+    """ShellTestConfig
+
+    Copies share their values until either one is modified (copy-on-write), so the configs of
+    all tests in a file cost little more than one config.
+    """
+
+    __slots__ = ('_cfg', '_vals', '_owner')
 
     def __init__(self, shell_test_cfg=None):
-        cfg = (
-            opt('command_prompt', '>', True, str),
-            opt('command_shell', 'sh -c', True, str),
-            opt('ignore_trailing_whitespace', True, True, bool_typ),
-            opt('shell_test_exts', ('sh', 'shtest'), False, list))
-        self.__dict__['_cfg'] = { op.name:op for op in cfg }
-        self.__dict__['_vals'] = { op.name:op.default for op in cfg }
-        if shell_test_cfg is not None:
+        object.__setattr__(self, '_cfg', _options_by_name)
+        object.__setattr__(self, '_vals', dict(_defaults))
+        object.__setattr__(self, '_owner', True)
+        if isinstance(shell_test_cfg, ShellTestConfig):
+            self._vals.update(shell_test_cfg._vals)
+        elif shell_test_cfg is not None:
             for key, val in list(shell_test_cfg.items()):
-                self.__dict__['_vals'][key] = val
+                self._vals[key] = val
 
     def copy(self):
-        return ShellTestConfig(self)
+        cfg = ShellTestConfig.__new__(ShellTestConfig)
+        object.__setattr__(cfg, '_cfg', self._cfg)
+        object.__setattr__(cfg, '_vals', self._vals)
+        object.__setattr__(cfg, '_owner', False)
+        object.__setattr__(self, '_owner', False)
+        return cfg
+
+    def __reduce__(self):
+        return ShellTestConfig, (dict(self._vals),)
 
     def __len__(self):
         return len(self._vals)
@@ -66,6 +190,8 @@ class ShellTestConfig(MutableMapping):
         return iter(self._vals)
 
     def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
         return self[key]
 
     def __setattr__(self, key, val):
@@ -79,16 +205,32 @@ class ShellTestConfig(MutableMapping):
         if not op.editable:
             raise ShellTestOptionNotEditable('{!r} is not an editable option'.format(key))
         log.debug('setting cfg option %r to %r', key, val)
+        if not self._owner:
+            object.__setattr__(self, '_vals', dict(self._vals))
+            object.__setattr__(self, '_owner', True)
         self._vals[key] = op.typ(val)
 
     def __delitem__(self, key):
         raise NotImplemented()
 
 
+def _compile_globs(patterns):
+    """Regex matching any of the glob patterns, None if there are none"""
+    patterns = list(patterns or ())
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(fnmatch.translate(p)) for p in patterns))
+
+
 class ShellTestFileFinder:
     """ShellTestFinder searches for shell tests in directories"""
 
-    def __init__(self, paths, cfg=None):
+    # Version control and tool directories that are not searched unless given explicitly
+    default_exclude = ('.git', '.hg', '.svn', '.tox', '.nox', '.venv', 'node_modules',
+                       '__pycache__', '.pytest_cache', '.mypy_cache', '.shelltest_cache',
+                       '*.egg-info')
+
+    def __init__(self, paths, cfg=None, include=None, exclude=None, default_exclude=True):
         """Initialize ShellTestFinder
         Parameters
         ==========
@@ -96,29 +238,81 @@ class ShellTestFileFinder:
             paths can contain either a link directly to a shell test or a directory
             containing shell tests
         cfg : ShellTestConfig
+        include : iterable of glob patterns (default: None)
+            files found in directories must match one of the patterns, by default files
+            with one of the extensions in cfg.shell_test_exts are included
+        exclude : iterable of glob patterns (default: None)
+            files and directories to skip. Patterns are matched against names and paths
+            relative to the directory being searched
+        default_exclude : bool (default: True)
+            also skip the directories in ShellTestFileFinder.default_exclude
         """
         if isinstance(paths, str):
             paths = [paths]
         self._paths = paths
         self._cfg = cfg or ShellTestConfig()
+        self._include = _compile_globs(include)
+        exclude = list(exclude or ())
+        if default_exclude:
+            exclude.extend(self.default_exclude)
+        self._exclude = _compile_globs(exclude)
+        # directories searched by the last call of find_paths
+        self.searched_dirs = []
 
     @classmethod
     def is_shelltest_file(cls, path, cfg):
         if os.path.isfile(path):
-            # ext is everything from the last dot to the end
-            _, ext = os.path.splitext(path)
-            if ext[1:] in cfg.shell_test_exts:
-                return True
+            return cls._has_shelltest_ext(path, cfg)
         return False
 
     @classmethod
-    def _find_paths(cls, path, cfg):
+    def _has_shelltest_ext(cls, path, cfg):
+        # ext is everything from the last dot to the end
+        _, ext = os.path.splitext(path)
+        return ext[1:] in cfg.shell_test_exts
+
+    def _excluded(self, name, relpath):
+        return self._exclude is not None and \
+            (self._exclude.match(name) is not None or self._exclude.match(relpath) is not None)
+
+    def _included(self, name, relpath):
+        if self._include is None:
+            return self._has_shelltest_ext(name, self._cfg)
+        return self._include.match(name) is not None or self._include.match(relpath) is not None
+
+    def _walk(self, root):
+        """Generator of shell test files under root, directories are searched in sorted order
+        and their files are yielded before descending into subdirectories"""
+        stack = [(root, '')]
+        while stack:
+            dirpath, reldir = stack.pop()
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                log.debug('skipping %r: %s', dirpath, e)
+                continue
+            self.searched_dirs.append(dirpath)
+            subdirs = []
+            for entry in entries:
+                relpath = os.path.join(reldir, entry.name)
+                if self._excluded(entry.name, relpath):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, relpath))
+                    elif entry.is_file() and self._included(entry.name, relpath):
+                        yield entry.path
+                except OSError:
+                    continue
+            stack.extend(reversed(subdirs))
+
+    def _find_paths(self, path):
         """Generator of shell test files
         Parameters
         ==========
         path : str
             path to shell test file or directory
-        cfg : ShellTestConfig
 
         Returns
         =======
@@ -126,37 +320,37 @@ class ShellTestFileFinder:
         """
         log.debug('searching %r', path)
         if os.path.isdir(path):
-            for dirpath, _, filenames in os.walk(path):
-                for filename in filenames:
-                    path = os.path.join(dirpath, filename)
-                    if cls.is_shelltest_file(path, cfg):
-                        yield path
-        elif cls.is_shelltest_file(path, cfg):
+            yield from self._walk(path)
+        elif self.is_shelltest_file(path, self._cfg):
             yield path
 
     def find_paths(self):
         """Generator of shell test file paths"""
+        self.searched_dirs = []
         for path in self._paths:
-            for file_path in self._find_paths(path, self._cfg):
-                yield file_path
+            yield from self._find_paths(path)
 
 
 class TestConfig:
-    def __init__(self, cmd, cmd_line_num, output, cfg):
+    def __init__(self, cmd, cmd_line_num, output, cfg, output_span=None):
         self.cmd = cmd
         self.cmd_line_num = cmd_line_num
         self.output = output
         self.cfg = cfg
+        self.output_span = output_span
 
 
 class ParserFSM:
     _re_arg = re.compile(r'#\[sht\]\s*([a-zA-Z0-9_]+)\s*=\s*(.+?)\s*$')
+    # options of a single test, following its command
+    _re_cmd_arg = re.compile(r'#\[sht\]\s*([a-zA-Z0-9_]+)\s*=\s*(.+?)\s*(?=#\[sht\]|$)')
     _re_cmt = re.compile(r'^\s*#.*$')
 
     def __init__(self, cfg):
         self._state = self._state_parse_header
         self._line = None
         self._line_num = None
+        self._span = None
         self._test = None
         self._cfg = cfg
         self._tests = []
@@ -183,10 +377,42 @@ class ParserFSM:
             self._test_finished()
             # Commands that are just comments are not considered tests
             if not self._re_cmt.match(cmd):
-                self._test = TestConfig(cmd, self._line_num, [], self._cfg.copy())
+                cmd, cfg = self._parse_cmd_args(cmd)
+                self._test = TestConfig(cmd, self._line_num, [], cfg)
                 return True
         return False
 
+    @classmethod
+    def _find_cmd_args(cls, cmd):
+        """Index of the first #[sht] of cmd that is not quoted or escaped, -1 if there is none"""
+        quote = None
+        i = 0
+        while i < len(cmd):
+            c = cmd[i]
+            if c == '\\' and quote != "'":
+                i += 2
+                continue
+            if quote is None:
+                if c in '\'"':
+                    quote = c
+                elif cmd.startswith('#[sht]', i):
+                    return i
+            elif c == quote:
+                quote = None
+            i += 1
+        return -1
+
+    def _parse_cmd_args(self, cmd):
+        """Split options following a command from it, returning the command and its config"""
+        cfg = self._cfg.copy()
+        start = self._find_cmd_args(cmd)
+        if start >= 0:
+            for m in self._re_cmd_arg.finditer(cmd, start):
+                key, val = m.groups()
+                cfg[key] = val
+            cmd = cmd[:start].rstrip()
+        return cmd, cfg
+
     def _parse_arg(self, match_start=False):
         matcher = self._re_arg.match if match_start else self._re_arg.search
         m = matcher(self._line)
@@ -203,14 +429,37 @@ class ParserFSM:
 
     def _state_parse_cmd(self):
         if not self._parse_cmd() and self._test:
-            self._test.output.append(self._line)
+            if self._span is None:
+                self._test.output.append(self._line)
+            else:
+                # output lines are contiguous, only the offsets of the first and last are kept
+                span = self._test.output_span or self._span
+                self._test.output_span = (span[0], self._span[1])
 
     def finalize(self):
         self._test_finished()
-
-    def next_line(self, line, line_num):
+        lines = set()
+        for test in self._tests:
+            # tests can only need earlier tests, so the dependencies form no cycles
+            unknown = [n for n in test.cfg.needs if n not in lines]
+            if unknown:
+                raise ValueError('the command on line {} needs lines {}, which are not earlier '
+                                 'commands'.format(test.cmd_line_num, unknown))
+            lines.add(test.cmd_line_num)
+
+    def next_line(self, line, line_num, span=None):
+        """Feed the next line
+        Parameters
+        ==========
+        line : str
+        line_num : int
+        span : (int, int) (default: None)
+            byte offsets of the line in its file, when given the offsets of each test's output
+            are recorded instead of the output itself
+        """
         self._line = line
         self._line_num = line_num
+        self._span = span
         self._state()
 
     @property
@@ -258,10 +507,84 @@ def is_escaped_newline(line):
     return cnt % 2 == 1
 
 
+def _decode_line(data):
+    # Universal newlines, as files opened in text mode
+    return data.decode('utf-8').replace('\r\n', '\n')
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+@functools.lru_cache(maxsize=64)
+def _map_source(path, stamp):
+    """Memory map of path, stamp identifies the version of the file that is mapped"""
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if (st.st_mtime_ns, st.st_size) != stamp:
+            raise ValueError('{} changed since it was parsed'.format(path))
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CompactShellTest:
+    """CompactShellTest is a ShellTest that does not hold its expected output in memory
+
+    The expected output is read from a memory map of the source file when it is used, only its
+    byte offsets in the file are stored.
+    """
+
+    __slots__ = ('command', 'source', 'cfg', 'span', 'stamp', '_matcher')
+
+    _not_compiled = object()
+
+    def __init__(self, command, source, cfg, span, stamp):
+        """Initialize a CompactShellTest
+        Parameters
+        ==========
+        span : (int, int)
+            byte offsets of the expected output in the source file
+        stamp : (int, int)
+            mtime and size of the source file when it was parsed
+        """
+        self.command = command
+        self.source = source
+        self.cfg = cfg
+        self.span = span
+        self.stamp = stamp
+        self._matcher = self._not_compiled
+
+    @property
+    def expected_output(self):
+        start, end = self.span
+        if start == end:
+            return ''
+        # the spans are only valid for the version of the file that was parsed, a map of it may
+        # still be cached after the file was rewritten in place
+        if _file_stamp(self.source.name) != self.stamp:
+            raise ValueError('{} changed since it was parsed'.format(self.source.name))
+        return _decode_line(_map_source(self.source.name, self.stamp)[start:end])
+
+    @property
+    def matcher(self):
+        # compiled on first use, compiling reads the expected output
+        if self._matcher is self._not_compiled:
+            self._matcher = match.compile_matcher(
+                self.expected_output, self.cfg, os.path.dirname(os.path.abspath(self.source.name)))
+        return self._matcher
+
+    def __repr__(self):
+        return 'CompactShellTest(command={!r}, source={!r}, span={!r})'.format(
+            self.command, self.source, self.span)
+
+
 class ShellTestParser:
     """ShellTesetParser read in a ShellTest file"""
 
-    def __init__(self, path, cfg=None):
+    # Bump when a change to the parser changes the tests parsed from a file
+    version = 2
+
+    def __init__(self, path, cfg=None, cache=None, compact=False):
         """Initialize a ShellTestParser
         Parameters
         ==========
@@ -269,14 +592,16 @@ class ShellTestParser:
             path to file to read from or file like object to read from
         cfg : ShellTestConfig
             configuration object
+        cache : ShellTestParseCache (default: None)
+            cache of previously parsed files, only used when path is a str
+        compact : bool (default: False)
+            parse CompactShellTest's instead of ShellTest's, only used when path is a str
         """
-        if isinstance(path, str):
-            fobj = open(path)
-        else:
-            fobj = path
-        self._fobj = fobj
+        self._fobj = None if isinstance(path, str) else path
         self._path = str(path)
         self._cfg = ShellTestConfig(cfg or {})
+        self._cache = cache if self._fobj is None else None
+        self._compact = compact and self._fobj is None
 
     @property
     def path(self):
@@ -288,15 +613,24 @@ class ShellTestParser:
         =======
         An iterable of ShellTest's found
         """
-        return [t for t in self._test_gen()]
+        if self._cache is None:
+            return [t for t in self._test_gen()]
+        key = self._cache.key(self._path, self._cfg, (self.version, self._compact))
+        cached = self._cache.get(self._path, key)
+        if cached is not None:
+            self._cfg, tests = cached
+            return tests
+        tests = [t for t in self._test_gen()]
+        self._cache.put(self._path, key, self._cfg, tests)
+        return tests
 
     def _parse_args(self):
         """Parse configuration arguments"""
 
-    def _gen_escaped_newlines(self):
+    def _gen_escaped_newlines(self, fobj):
         lines = []
         line_num = None
-        for i, l in enumerate(self._fobj, 1):
+        for i, l in enumerate(fobj, 1):
             if is_escaped_newline(l):
                 line_num = i
                 lines.append(l)
@@ -309,78 +643,1148 @@ class ShellTestParser:
         if lines:
             yield line_num, ''.join(lines)
 
+    def _gen_spans(self, buf):
+        """As _gen_escaped_newlines, also yielding the byte offsets of each line in buf"""
+        lines = []
+        line_num = start = None
+        pos = 0
+        for i in itertools.count(1):
+            if pos >= len(buf):
+                break
+            nl = buf.find(b'\n', pos)
+            end = len(buf) if nl == -1 else nl + 1
+            line = _decode_line(buf[pos:end])
+            if is_escaped_newline(line):
+                if not lines:
+                    line_num, start = i, pos
+                lines.append(line)
+            elif lines:
+                lines.append(line)
+                yield line_num, ''.join(lines), (start, end)
+                lines = []
+            else:
+                yield i, line, (pos, end)
+            pos = end
+        if lines:
+            yield line_num, ''.join(lines), (start, pos)
+
+    def _compact_test_gen(self):
+        fsm = ParserFSM(self._cfg)
+        stamp = _file_stamp(self._path)
+        if stamp[1]:
+            for line_num, line, span in self._gen_spans(_map_source(self._path, stamp)):
+                fsm.next_line(line, line_num, span)
+        fsm.finalize()
+        for test in fsm.tests:
+            src = ShellTestSource(self._path, test.cmd_line_num)
+            span = test.output_span or (0, 0)
+            yield CompactShellTest(test.cmd, src, test.cfg, span, stamp)
+
     def _test_gen(self):
+        if self._compact:
+            yield from self._compact_test_gen()
+            return
         fsm = ParserFSM(self._cfg)
-        for line_num, line in self._gen_escaped_newlines():
-            fsm.next_line(line, line_num)
+        if self._fobj is None:
+            with open(self._path) as fobj:
+                for line_num, line in self._gen_escaped_newlines(fobj):
+                    fsm.next_line(line, line_num)
+        else:
+            for line_num, line in self._gen_escaped_newlines(self._fobj):
+                fsm.next_line(line, line_num)
         fsm.finalize()
+        source_dir = None
+        if self._fobj is None:
+            source_dir = os.path.dirname(os.path.abspath(self._path))
         for test in fsm.tests:
             src = ShellTestSource(self._path, test.cmd_line_num)
-            yield ShellTest(test.cmd, ''.join(test.output), src, test.cfg)
+            output = ''.join(test.output)
+            yield ShellTest(test.cmd, output, src, test.cfg,
+                            match.compile_matcher(output, test.cfg, source_dir))
 
 
-def _get_env():
+def _get_env(extra=None):
     """ Get an environment, only whitelisted variables are passed on """
     whitelist = set(['PATH'])
     env = {}
     for key, val in list(os.environ.items()):
         if key in whitelist:
             env[key] = val
+    if extra:
+        env.update(extra)
     return env
 
 
+def _get_cwd(test):
+    cwd = os.path.dirname(test.source.name)
+    if not os.path.isdir(cwd):
+        cwd = '.'
+    return cwd
+
+
+_READ_SIZE = 65536
+
+
+class _OutputPrinter:
+    """Print command output as it arrives, each line is prefixed with '>>> '"""
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._line_start = True
+
+    def _write(self, text):
+        if not text:
+            return
+        out = []
+        for line in text.splitlines(True):
+            if self._line_start:
+                out.append('>>> ')
+            out.append(line)
+            self._line_start = line.endswith('\n')
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+
+    def write(self, data):
+        self._write(self._decoder.decode(data))
+
+    def close(self):
+        self._write(self._decoder.decode(b'', final=True))
+        if not self._line_start:
+            print()
+
+
+def _kill_group(proc):
+    """Kill the process group led by proc, commands are started in their own session"""
+    # the pid of a process that has been waited for may have been reused
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def _wait(proc):
+    """Reap proc with os.wait4, setting its returncode
+    Returns
+    =======
+    resource usage of proc and its waited for children
+    """
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def _get_usage(wall_time, rusage=None):
+    if rusage is None:
+        return ShellTestResourceUsage(wall_time)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return ShellTestResourceUsage(wall_time, rusage.ru_utime, rusage.ru_stime, max_rss)
+
+
+class _OutputBuffer:
+    """Output of a command, kept in memory until it grows past spill_bytes and written to a
+    temporary file from then on. Output that is not kept only has its start and end kept"""
+
+    # bytes of spilled output kept from its start and end for reporting
+    excerpt_bytes = 4096
+    # bytes of spilled output mapped at a time
+    window_bytes = 16 * 2**20
+
+    def __init__(self, spill_bytes=None, keep=True):
+        """Initialize an _OutputBuffer
+        Parameters
+        ==========
+        spill_bytes : int (default: None)
+            bytes kept in memory, None to keep all output in memory
+        keep : bool (default: True)
+            keep the output, otherwise only its size and excerpt_bytes of its start and end
+            are kept
+        """
+        self._spill_bytes = spill_bytes
+        self._keep = keep
+        self._chunks = []
+        self._file = None
+        self._head = bytearray()
+        self._tail = bytearray()
+        self.size = 0
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, data):
+        self.size += len(data)
+        if not self._keep:
+            n = self.excerpt_bytes
+            head = n - len(self._head)
+            self._head += data[:head]
+            self._tail += data[head:] if head > 0 else data
+            del self._tail[:-n]
+            return
+        if self._file is None and self._spill_bytes is not None and self.size > self._spill_bytes:
+            self._file = tempfile.TemporaryFile(prefix='shelltest-')
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+
+    def getvalue(self):
+        """All output, only available when it was not spilled"""
+        assert not self.spilled, 'spilled output is not kept in memory'
+        return b''.join(self._chunks)
+
+    def _read(self, offset, size):
+        """Generator of chunks of size bytes of spilled output from offset, only they are mapped
+        so memory use does not grow with the output"""
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        end = min(offset + size, self.size)
+        if end <= offset:
+            return
+        with mmap.mmap(self._file.fileno(), end - start, access=mmap.ACCESS_READ,
+                       offset=start) as m:
+            for pos in range(offset - start, end - start, _READ_SIZE):
+                yield m[pos:pos + _READ_SIZE]
+
+    def chunks(self):
+        """Generator of the output in chunks, spilled output is read from memory maps"""
+        if not self.spilled:
+            yield from self._chunks
+            return
+        self._file.flush()
+        for offset in range(0, self.size, self.window_bytes):
+            yield from self._read(offset, self.window_bytes)
+
+    def excerpt(self):
+        """Decoded output, only the start and end of spilled output or output not kept"""
+        if not self._keep:
+            head, tail = bytes(self._head), bytes(self._tail)
+        elif not self.spilled:
+            return _decode(self.getvalue())
+        else:
+            self._file.flush()
+            n = self.excerpt_bytes
+            head = b''.join(self._read(0, n))
+            start = max(n, self.size - n)
+            tail = b''.join(self._read(start, self.size - start))
+        if len(head) + len(tail) == self.size:
+            return _decode(head + tail)
+        omitted = self.size - len(head) - len(tail)
+        return '{}\n... {} bytes not shown ...\n{}'.format(_decode(head), omitted, _decode(tail))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._chunks = []
+
+
+def _capture(proc, on_stdout=None, timeout=None, keep_stdout=True, spill_bytes=None,
+             max_bytes=None):
+    """Drain stdout and stderr of proc concurrently until both are closed
+    Parameters
+    ==========
+    proc : Popen
+        process started with stdout and stderr pipes
+    on_stdout : callable (default: None)
+        called with each chunk of stdout as it is read, the process group of proc is killed
+        when it returns True
+    timeout : float (default: None)
+        seconds to wait for both pipes to close, the process group of proc is killed
+        when it expires
+    keep_stdout : bool (default: True)
+        keep stdout, otherwise it is only passed to on_stdout
+    spill_bytes : int (default: None)
+        bytes of each stream kept in memory before the rest is written to a temporary file
+    max_bytes : int (default: None)
+        the process group of proc is killed once stdout and stderr together exceed max_bytes
+
+    Returns
+    =======
+    (stdout, stderr, timed_out, exceeded) where stdout and stderr are _OutputBuffers of the output
+    read so far and exceeded is True if proc was killed for writing more than max_bytes
+    """
+    bufs = {proc.stdout: _OutputBuffer(spill_bytes, keep_stdout),
+            proc.stderr: _OutputBuffer(spill_bytes)}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    timed_out = exceeded = False
+    try:
+        with selectors.DefaultSelector() as sel:
+            for f in bufs:
+                sel.register(f, selectors.EVENT_READ)
+            while sel.get_map():
+                events = sel.select(_remaining(deadline))
+                if not events and deadline is not None and time.monotonic() >= deadline:
+                    _kill_group(proc)
+                    timed_out = True
+                    break
+                for key, _ in events:
+                    f = key.fileobj
+                    data = os.read(f.fileno(), _READ_SIZE)
+                    if not data:
+                        sel.unregister(f)
+                        continue
+                    bufs[f].write(data)
+                    if max_bytes is not None and \
+                            bufs[proc.stdout].size + bufs[proc.stderr].size > max_bytes:
+                        _kill_group(proc)
+                        exceeded = True
+                        break
+                    if f is proc.stdout and on_stdout is not None and on_stdout(data):
+                        _kill_group(proc)
+                        sel.unregister(proc.stdout)
+                if exceeded:
+                    break
+    except BaseException:
+        # commands run in their own session, a Ctrl-C on the terminal does not reach them
+        _kill_group(proc)
+        raise
+    return bufs[proc.stdout], bufs[proc.stderr], timed_out, exceeded
+
+
+# Run by a launcher shell, the command is read from stdin with builtins only. It is evaluated by
+# the shell as `sh -c` would run it, or passed to the command shell given as arguments. Commands
+# are run with stdin connected to /dev/null
+_LAUNCHER = '''\
+cmd=
+while IFS= read -r line || [ -n "$line" ]; do
+    cmd="${cmd:+$cmd
+}$line"
+done
+exec </dev/null
+[ -n "$cmd" ] || exit 0
+unset line
+[ $# -eq 0 ] || exec "$@" "$cmd"
+eval "unset cmd
+$cmd"
+'''
+
+# Command shells that can run _LAUNCHER themselves
+_POSIX_SHELLS = ('sh', 'bash', 'dash', 'ash', 'ksh', 'mksh', 'zsh')
+
+
+def _is_posix_shell(shell):
+    """True if the command shell (a list of arguments) is a POSIX shell run as `<shell> -c`"""
+    return len(shell) == 2 and shell[1] == '-c' and os.path.basename(shell[0]) in _POSIX_SHELLS
+
+
+def _launcher_args(shell):
+    """Arguments of a launcher that reads a command from stdin and runs it with shell"""
+    if _is_posix_shell(shell):
+        return shell + [_LAUNCHER, shell[0]]
+    return ['sh', '-c', _LAUNCHER, 'sh'] + shell
+
+
+# Options limiting the resources of a command, with the rlimit each of them sets
+_RLIMITS = (
+    ('max_memory', 'RLIMIT_AS'),
+    ('max_cpu_seconds', 'RLIMIT_CPU'),
+    ('max_open_files', 'RLIMIT_NOFILE'),
+    ('max_processes', 'RLIMIT_NPROC'),
+)
+
+# Errors of commands failing because they ran into the limit of an option
+# errors commands typically report when they run into a limit, other failures can cause them too
+_limit_errors = (
+    ('max_memory', re.compile(r'Cannot allocate memory|[Oo]ut of memory|MemoryError|bad_alloc|'
+                              r'memory exhausted')),
+    ('max_open_files', re.compile(r'Too many open files')),
+    ('max_processes', re.compile(r"Resource temporarily unavailable|[Cc]an(?:no|')t fork")),
+)
+
+
+def _get_rlimits(cfg):
+    """(resource, limit) pairs of the resource limit options set in cfg"""
+    return [(getattr(resource, res), cfg[name]) for name, res in _RLIMITS
+            if cfg[name] is not None and hasattr(resource, res)]
+
+
+def _set_rlimits(rlimits, pid=None):
+    """Set rlimits of the process pid, or of the calling process. The hard limit is lowered
+    as well so the command can not raise them, limits above the hard limit are capped"""
+    for res, limit in rlimits:
+        _, hard = resource.prlimit(pid, res) if pid else resource.getrlimit(res)
+        # SIGXCPU is sent at the soft CPU limit, SIGKILL only once the hard limit is reached
+        new_hard = limit + 1 if res == resource.RLIMIT_CPU else limit
+        if hard != resource.RLIM_INFINITY:
+            limit, new_hard = min(limit, hard), min(new_hard, hard)
+        if pid:
+            resource.prlimit(pid, res, (limit, new_hard))
+        else:
+            resource.setrlimit(res, (limit, new_hard))
+
+
+def _rlimit_exceeded(cfg, ret_code, rusage=None):
+    """Name of the resource limit option a failed command was seen to run into, None if it was
+    not. Only the CPU limit can be observed, by its signal or the CPU time used"""
+    if ret_code == 0:
+        return None
+    if cfg.max_cpu_seconds is not None:
+        # SIGXCPU at the limit, the shell reports children killed by a signal as 128 + signal
+        if ret_code in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+            return 'max_cpu_seconds'
+        if rusage is not None and rusage.ru_utime + rusage.ru_stime >= cfg.max_cpu_seconds:
+            return 'max_cpu_seconds'
+    return None
+
+
+def _rlimit_hint(cfg, err_output):
+    """Name of a resource limit option set in cfg whose typical error is in err_output, None if
+    there is none"""
+    for name, regex in _limit_errors:
+        if cfg[name] is not None and regex.search(err_output):
+            return name
+    return None
+
+
+def _cpu_count():
+    """Number of CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class _PooledProcess:
+    """A launcher shell waiting for its command"""
+
+    def __init__(self, shell, cwd, env):
+        self.proc = Popen(_launcher_args(shell), shell=False, stdin=PIPE, stdout=PIPE,
+                          stderr=PIPE, cwd=cwd, env=env, start_new_session=True)
+
+    def start(self, command, rlimits=()):
+        """Hand command to the launcher, False if it is no longer waiting for one
+        Parameters
+        ==========
+        command : str
+        rlimits : list of (resource, limit) (default: ())
+            set before the launcher reads command, so they apply to all of it
+        """
+        try:
+            if self.proc.poll() is not None:
+                return False
+            if rlimits:
+                _set_rlimits(rlimits, self.proc.pid)
+            self.proc.stdin.write(command.encode('utf-8'))
+            return True
+        except (BrokenPipeError, ProcessLookupError):
+            return False
+        finally:
+            self._close_stdin()
+
+    def _close_stdin(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        # the launcher exits when its stdin is closed without a command
+        self._close_stdin()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+
+class ShellTestProcessPool:
+    """ShellTestProcessPool starts the processes of commands ahead of the tests that run them
+
+    A pooled process is the command shell waiting to read a command from a pipe, which it then
+    runs as `sh -c` would. Each process runs exactly one command, so tests keep the semantics of
+    a freshly started process while the cost of starting it is paid in the background, during
+    the previous test. Processes are keyed by the shell test file, command shell, working
+    directory and environment they are started with. Only POSIX shells run as `<shell> -c`
+    are pooled, other commands are started when they are run.
+    """
+
+    def __init__(self, size=None):
+        """Initialize a ShellTestProcessPool
+        Parameters
+        ==========
+        size : int (default: None)
+            number of idle processes kept for each key. By default 1, or 0 when only one CPU is
+            available, processes can then not be started while another test runs
+        """
+        if size is None:
+            size = 1 if _cpu_count() > 1 else 0
+        self._size = size
+        self._idle = defaultdict(list)
+        self._spawning = defaultdict(list)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='shelltest-spawn')
+
+    @classmethod
+    def supports(cls, shell):
+        """True if commands of the command shell (a list of arguments) can be pooled"""
+        return _is_posix_shell(shell)
+
+    @classmethod
+    def _popen(cls, shell, command, cwd, env, rlimits=()):
+        # without prlimit the limits are set in the child before it execs the shell
+        preexec_fn = functools.partial(_set_rlimits, rlimits) if rlimits else None
+        return Popen(shell + [command], shell=False, stdout=PIPE, stderr=PIPE,
+                     cwd=cwd, env=env, start_new_session=True, preexec_fn=preexec_fn)
+
+    def _spawn(self, key):
+        try:
+            proc = _PooledProcess(list(key[1]), key[2], dict(key[3]))
+        except OSError as e:
+            log.debug('can not start a process for the pool: %s', e)
+            return
+        with self._lock:
+            self._idle[key].append(proc)
+
+    def popen(self, name, shell, command, cwd, env, refill=True, rlimits=(), idle=True):
+        """Start command, in an idle process when one is waiting
+        Parameters
+        ==========
+        name : str
+            shell test file the command is from
+        shell : list of str
+            command shell, the command is appended to it
+        command : str
+        cwd : str
+        env : dict
+        refill : bool (default: True)
+            start a process in the background for the next command with the same key
+        rlimits : list of (resource, limit) (default: ())
+            resource limits of the process running command
+        idle : bool (default: True)
+            run command in an idle process if one is waiting
+
+        Returns
+        =======
+        Popen of the process running command
+        """
+        proc = None
+        if idle and self._size and self.supports(shell):
+            proc = self._take((name, tuple(shell), cwd, tuple(sorted(env.items()))), refill)
+        if proc is not None and proc.start(command, rlimits):
+            return proc.proc
+        if proc is not None:
+            proc.close()
+        if not rlimits or not hasattr(resource, 'prlimit'):
+            return self._popen(shell, command, cwd, env, rlimits)
+        # limits are set on a launcher while it waits for its command, unlike preexec_fn this
+        # is safe while other threads run
+        proc = _PooledProcess(shell, cwd, env)
+        if proc.start(command, rlimits):
+            return proc.proc
+        proc.close()
+        log.debug('launcher exited before its command, starting %r directly', command)
+        return self._popen(shell, command, cwd, env, rlimits)
+
+    def _take(self, key, refill):
+        """Take an idle process of key, None if none is waiting"""
+        with self._lock:
+            idle = self._idle[key]
+            proc = idle.pop() if idle else None
+            spawning = self._spawning[key]
+            spawning[:] = [f for f in spawning if not f.done()]
+            if refill and len(idle) + len(spawning) < self._size:
+                spawning.append(self._executor.submit(self._spawn, key))
+        return proc
+
+    def discard(self, names):
+        """Stop the idle processes of the shell test files in names"""
+        names = set(names)
+        with self._lock:
+            futures = [f for key, fs in self._spawning.items() if key[0] in names for f in fs]
+        wait_futures(futures)
+        with self._lock:
+            keys = [key for key in self._idle if key[0] in names]
+            procs = [p for key in keys for p in self._idle.pop(key)]
+            for key in keys:
+                self._spawning.pop(key, None)
+        for proc in procs:
+            proc.close()
+
+    def close(self):
+        """Stop all idle processes"""
+        with self._lock:
+            names = set(key[0] for key in list(self._idle) + list(self._spawning))
+        self.discard(names)
+
+
+class ShellTestSession:
+    """ShellTestSession is a long lived shell that runs each command of a shell test file
+
+    Commands are written to the shell's stdin as a quoted string that the shell evaluates,
+    followed by sentinel markers on stdout and stderr, the exit code of the command is written
+    alongside the stdout marker. A command that is not complete, e.g. with an unterminated
+    quote, fails with a syntax error instead of consuming the markers. Shell state (variables,
+    working directory, functions) carries over from one command to the next.
+    """
+
+    def __init__(self, cfg, cwd, env=None):
+        """Initialize a ShellTestSession
+        Parameters
+        ==========
+        cfg : ShellTestConfig
+            configuration of the file, command_shell must be a POSIX shell
+        cwd : str
+            initial working directory of the shell
+        env : dict (default: None)
+            environment of the shell, by default only whitelisted variables are passed on
+        """
+        cmd = shlex.split(cfg.command_shell)
+        # The shell reads commands from stdin instead of from its arguments
+        if cmd[-1] == '-c':
+            cmd = cmd[:-1]
+        self._marker = '__shelltest_{}__'.format(uuid.uuid4().hex).encode('utf-8')
+        self._proc = Popen(cmd, shell=False, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                           cwd=cwd, env=env or _get_env(), start_new_session=True)
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
+    def _script(self, command):
+        marker = self._marker.decode('utf-8')
+        # The command is data in a single quoted string, `command eval` keeps a syntax error in
+        # it from exiting the shell. stdin is detached from commands so they can not consume
+        # the rest of the session
+        return ('__shelltest_cmd={cmd}\n'
+                'command eval "$__shelltest_cmd" </dev/null\n'
+                'printf \'{marker} %d\\n\' $?\n'
+                'printf \'{marker}\\n\' >&2\n').format(cmd=shlex.quote(command), marker=marker)
+
+    def _read_until_markers(self, timeout, on_stdout=None):
+        """Read stdout and stderr until both markers are seen, the shell exits or timeout expires
+        Parameters
+        ==========
+        timeout : float
+        on_stdout : callable (default: None)
+            called with the output of the command on stdout as it arrives
+        Returns
+        =======
+        (stdout bytes, stderr bytes, exit code or None if the shell exited, timed_out)
+        """
+        bufs = {self._proc.stdout: bytearray(), self._proc.stderr: bytearray()}
+        # stdout passed on to on_stdout, the end of it is held back while it may be a marker
+        passed = 0
+        found = {}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        timed_out = False
+        sel = selectors.DefaultSelector()
+        for f in bufs:
+            sel.register(f, selectors.EVENT_READ)
+        while len(found) < len(bufs) and sel.get_map():
+            events = sel.select(_remaining(deadline))
+            if not events and deadline is not None and time.monotonic() >= deadline:
+                _kill_group(self._proc)
+                timed_out = True
+                break
+            for key, _ in events:
+                f = key.fileobj
+                data = os.read(f.fileno(), _READ_SIZE)
+                buf = bufs[f]
+                if not data:
+                    if f is self._proc.stdout and on_stdout is not None:
+                        on_stdout(bytes(buf[passed:]))
+                    sel.unregister(f)
+                    continue
+                start = max(0, len(buf) - len(self._marker))
+                buf += data
+                if f in found:
+                    continue
+                idx = buf.find(self._marker, start)
+                if f is self._proc.stdout and on_stdout is not None:
+                    end = idx if idx != -1 else max(passed, len(buf) - len(self._marker))
+                    on_stdout(bytes(buf[passed:end]))
+                    passed = end
+                if idx == -1:
+                    continue
+                if f is self._proc.stdout:
+                    eol = buf.find(b'\n', idx)
+                    if eol == -1:
+                        continue
+                    found[f] = int(buf[idx + len(self._marker):eol])
+                else:
+                    found[f] = None
+                del buf[idx:]
+                sel.unregister(f)
+        sel.close()
+        return bytes(bufs[self._proc.stdout]), bytes(bufs[self._proc.stderr]), \
+            found.get(self._proc.stdout), timed_out
+
+    def execute(self, command, timeout=None, on_stdout=None):
+        """Run command in the session
+        Parameters
+        ==========
+        command : str
+        timeout : float (default: None)
+            seconds to wait for the command, the session is killed when it expires
+        on_stdout : callable (default: None)
+            called with the output of the command on stdout (bytes) as it arrives
+
+        Returns
+        =======
+        (stdout, stderr, return code, timed_out)
+        """
+        try:
+            self._proc.stdin.write(self._script(command).encode('utf-8'))
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+        try:
+            stdout, stderr, ret_code, timed_out = self._read_until_markers(timeout, on_stdout)
+        except BaseException:
+            self.kill()
+            raise
+        if ret_code is None:
+            # The command exited the shell (e.g. `exit 1`), its exit code is the shell's
+            ret_code = self._proc.wait()
+        return _decode(stdout), _decode(stderr), ret_code, timed_out
+
+    def kill(self):
+        """Kill the shell and the command it is running"""
+        _kill_group(self._proc)
+
+    def close(self):
+        if self.alive:
+            self._proc.stdin.close()
+            self._proc.wait()
+        for f in (self._proc.stdin, self._proc.stdout, self._proc.stderr):
+            f.close()
+
+
+# ioctl(2) cloning a file's data blocks into another file (a reflink) on Linux
+_FICLONE = 0x40049409
+
+
+def _clone_file(src, dst):
+    """Copy src to dst, sharing their data blocks when the file system supports reflinks"""
+    if sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+class ShellTestFixture:
+    """ShellTestFixture runs the setup command of a shell test file once in a scratch directory
+
+    The tests of the file run in the scratch directory, or when the file is isolated, each in
+    its own copy of it. Files are copied with reflinks where possible, so copies are cheap and
+    a test modifying a file does not affect other tests. The directory of the shell test file is
+    passed to the setup command and the tests in the SHELLTEST_DIR environment variable.
+    """
+
+    def __init__(self, cfg, source_dir):
+        """Initialize a ShellTestFixture
+        Parameters
+        ==========
+        cfg : ShellTestConfig
+            configuration of the file, cfg.setup is the setup command
+        source_dir : str
+            directory of the shell test file
+        """
+        self._cfg = cfg
+        self._lock = threading.Lock()
+        self._copies = set()
+        self.env = _get_env({'SHELLTEST_DIR': os.path.abspath(source_dir)})
+        self.path = None
+        self.stdout = self.stderr = ''
+        self.ret_code = None
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.ret_code == 0 and not self.timed_out
+
+    def setup(self, timeout=None):
+        """Run the setup command, only the first call runs it"""
+        with self._lock:
+            if self.path is not None:
+                return
+            self.path = tempfile.mkdtemp(prefix='shelltest-')
+            cmd = shlex.split(self._cfg.command_shell) + [self._cfg.setup]
+            log.debug('running setup %r in %r', self._cfg.setup, self.path)
+            with Popen(cmd, shell=False, stdout=PIPE, stderr=PIPE, cwd=self.path, env=self.env,
+                       start_new_session=True) as p:
+                stdout, stderr, self.timed_out, _ = _capture(p, timeout=timeout)
+            self.stdout, self.stderr = stdout.excerpt(), stderr.excerpt()
+            self.ret_code = p.returncode
+
+    def copy(self):
+        """Path to a new copy of the scratch directory"""
+        parent = tempfile.mkdtemp(prefix='shelltest-')
+        with self._lock:
+            self._copies.add(parent)
+        # copytree creates the directory it copies to
+        path = os.path.join(parent, 'scratch')
+        shutil.copytree(self.path, path, symlinks=True, copy_function=_clone_file)
+        return path
+
+    def remove(self, path):
+        """Remove a copy made with copy"""
+        parent = os.path.dirname(path)
+        with self._lock:
+            self._copies.discard(parent)
+        shutil.rmtree(parent, ignore_errors=True)
+
+    def close(self):
+        with self._lock:
+            paths = list(self._copies) + ([self.path] if self.path else [])
+            self._copies = set()
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _status_str(status):
+    if status.cached:
+        return 'cached'
+    return 'passed' if status.success else 'failed'
+
+
+def _dependencies(tests):
+    """Indices of the tests each of tests waits for
+
+    A test waits for the tests of its needs option. Otherwise it waits for all earlier tests of
+    its file, unless it is independent or isolated. Tests run in a session always wait, they
+    share one shell. Only the earlier tests no other test waits for are recorded, the rest are
+    waited for through them.
+    """
+    deps = []
+    by_line = {}
+    # per file, the tests no later test waits for yet
+    last = defaultdict(set)
+    for i, test in enumerate(tests):
+        name = test.source.name
+        cfg = test.cfg
+        if cfg.session and not cfg.isolated:
+            waits = set(last[name])
+        elif cfg.needs:
+            # needed tests that are not run are not waited for
+            waits = set(by_line[name, n] for n in cfg.needs if (name, n) in by_line)
+        elif cfg.independent or cfg.isolated:
+            waits = set()
+        else:
+            waits = set(last[name])
+        last[name] -= waits
+        last[name].add(i)
+        by_line[name, test.source.line_num] = i
+        deps.append(waits)
+    return deps
+
+
+def _with_dependencies(tests, selected):
+    """The tests for which selected is true and the tests they wait for, in order"""
+    keep = list(selected)
+    deps = _dependencies(tests)
+    # tests only wait for earlier tests
+    for i in reversed(range(len(tests))):
+        if keep[i]:
+            for j in deps[i]:
+                keep[j] = True
+    return [t for t, k in zip(tests, keep) if k]
+
+
 class ShellTestRunner:
     """ShellTestRunner"""
 
-    def __init__(self, tests):
+    def __init__(self, tests, cache=None, hooks=None):
+        """Initialize a ShellTestRunner
+        Parameters
+        ==========
+        tests : iterable of ShellTest
+        cache : ShellTestResultCache (default: None)
+            when given, tests that passed in a previous run are not run again
+        hooks : ShellTestHooks or iterable of ShellTestHooks (default: None)
+            told as each test starts and ends and about the phases of each test
+        """
         self.tests = list(tests)
-
-    def _strip_whitespace(self, string):
-        for line in string.split('\n'):
-            line = line.strip()
-            if line:
-                yield line
+        self._cache = cache
+        self._cache_plan = None
+        self._hooks = combine_hooks(hooks)
+        self._sessions = {}
+        self._deadline = None
+        self._fixtures = {}
+        # processes of the commands that are running, killed when the run is interrupted
+        self._procs = set()
+        self._lock = threading.Lock()
+        # number of tests of each file that have not finished, for cleaning up fixtures
+        self._pending = Counter(test.source.name for test in self.tests)
+        self._pool = ShellTestProcessPool()
 
     def check_output(self, expected_output, actual_output, cfg):
         """Compare actual to expected output, comparison depends on the configuration
         """
         if cfg.ignore_trailing_whitespace:
-            return tuple(self._strip_whitespace(actual_output)) \
-                    == tuple(self._strip_whitespace(expected_output))
+            return tuple(_strip_whitespace(actual_output)) \
+                    == tuple(_strip_whitespace(expected_output))
         return (actual_output == expected_output)
 
-    def get_status(self, test, actual_output, ret_code):
+    def get_status(self, test, actual_output, ret_code, timed_out=False, out_verified=None,
+                   limit_exceeded=None):
         """Get the status of the command running, compares actual to expected output and the return code
+        Parameters
+        ==========
+        out_verified : bool (default: None)
+            result of comparing the output when it was already compared while it was captured
+        limit_exceeded : str (default: None)
+            name of the option limiting the resource the command was killed for using
+
         Returns
         =======
         ShellTestResultStatus
         """
         rc_verified = (ret_code == 0)
-        out_verified = self.check_output(test.expected_output, actual_output, test.cfg)
-        return ShellTestResultStatus(rc_verified and out_verified, out_verified, rc_verified)
+        if out_verified is None and test.matcher is not None:
+            out_verified = test.matcher.match(actual_output)
+        elif out_verified is None:
+            out_verified = self.check_output(test.expected_output, actual_output, test.cfg)
+        success = rc_verified and out_verified and not timed_out and not limit_exceeded
+        return ShellTestResultStatus(success, out_verified, rc_verified, timed_out,
+                                     limit_exceeded=limit_exceeded)
+
+    def _get_timeout(self, test):
+        """Seconds test may run for, limited by its timeout option and the total run budget"""
+        timeout = test.cfg.timeout
+        remaining = _remaining(self._deadline)
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
 
     def _get_command(self, test):
         return shlex.split(test.cfg.command_shell) + [test.command]
 
-    def _execute(self, test, show_output):
-        cwd = os.path.dirname(test.source.name)
-        if not os.path.isdir(cwd):
-            cwd = '.'
-        p = Popen(self._get_command(test), shell=False, stdout=PIPE,
-                  stderr=PIPE, cwd=cwd, env=_get_env())
-        stdout = []
-        while p.poll() is None:
-            line = p.stdout.readline().decode('utf-8')
-            if show_output:
-                print('>>> ' + line.strip())
-            stdout.append(line)
-        line = p.stdout.read().decode('utf-8')
-        if show_output:
-            print('>>> ' + line.strip())
-        stdout.append(line)
-        actual_output = ''.join(stdout)
-        err_output = p.stderr.read().decode('utf-8')
-        return actual_output, err_output, p.returncode
+    def _uses_session(self, test):
+        # isolated tests do not share any state, and only POSIX shells can run a session
+        if not test.cfg.session or test.cfg.isolated:
+            return False
+        return _is_posix_shell(shlex.split(test.cfg.command_shell))
+
+    def _get_session(self, test, cwd=None, env=None):
+        """Get the live session for the file test is from, starting a new one if needed"""
+        session = self._sessions.get(test.source.name)
+        if session is None or not session.alive:
+            if session is not None:
+                session.close()
+            session = ShellTestSession(test.cfg, cwd or _get_cwd(test), env)
+            self._sessions[test.source.name] = session
+        return session
+
+    def _close_sessions(self, tests):
+        for name in set(test.source.name for test in tests):
+            session = self._sessions.pop(name, None)
+            if session is not None:
+                session.close()
+
+    def _get_fixture(self, test):
+        """ShellTestFixture of the file test is from, set up if needed, None without a setup"""
+        if test.cfg.setup is None:
+            return None
+        with self._lock:
+            fixture = self._fixtures.get(test.source.name)
+            if fixture is None:
+                fixture = ShellTestFixture(test.cfg, _get_cwd(test))
+                self._fixtures[test.source.name] = fixture
+        fixture.setup(self._get_timeout(test))
+        return fixture
+
+    def _close_fixtures(self, tests):
+        for name in set(test.source.name for test in tests):
+            with self._lock:
+                fixture = self._fixtures.pop(name, None)
+            if fixture is not None:
+                fixture.close()
+
+    def _test_finished(self, test):
+        """Clean up the session, processes and fixture of the file test is from once all its
+        tests have finished"""
+        with self._lock:
+            self._pending[test.source.name] -= 1
+            done = self._pending[test.source.name] <= 0
+        if done:
+            self._close_sessions([test])
+            self._pool.discard([test.source.name])
+            self._close_fixtures([test])
+
+    def _expired(self):
+        """True once the total run budget has expired"""
+        remaining = _remaining(self._deadline)
+        return remaining is not None and remaining <= 0
+
+    def _expired_result(self, test):
+        """Result of a test that is not started as the total run budget has expired"""
+        status = ShellTestResultStatus(False, False, False, True)
+        return ShellTestResult(test, '', '', None, status)
+
+    def _setup_failed_result(self, test, fixture):
+        status = ShellTestResultStatus(False, False, False, fixture.timed_out, setup_failed=True)
+        err_output = fixture.stderr or fixture.stdout
+        return ShellTestResult(test, '', err_output, fixture.ret_code, status)
+
+    def _phase(self, test, phase, start):
+        """Tell the hooks about a phase of test that started at start and ends now"""
+        if self._hooks is not None:
+            self._hooks.on_phase(test, phase, start, time.perf_counter())
+
+    def _execute_session(self, test, show_output, cwd=None, env=None):
+        session = self._get_session(test, cwd, env)
+        printer = _OutputPrinter() if show_output else None
+        start = time.perf_counter()
+        actual_output, err_output, ret_code, timed_out = session.execute(
+            test.command, self._get_timeout(test), printer.write if printer else None)
+        self._phase(test, 'wait', start)
+        if printer:
+            printer.close()
+        return actual_output, err_output, ret_code, timed_out, None, None
+
+    def _get_comparator(self, test):
+        """StreamingComparator for test, None if its output is compared once it is captured"""
+        # only exact comparison is done while the output is captured
+        if not test.cfg.streaming_compare or self._uses_session(test) or \
+                test.matcher is not None:
+            return None
+        return StreamingComparator(test.expected_output, test.cfg.ignore_trailing_whitespace,
+                                   kill=test.cfg.kill_on_mismatch)
+
+    def _popen(self, test, cwd=None, env=None):
+        """Start the command of test with its resource limits, in a process started ahead of time
+        when prespawn is set"""
+        cwd = cwd or _get_cwd(test)
+        env = env or _get_env()
+        # isolated tests each run in a new copy of their scratch directory
+        prespawn = test.cfg.prespawn and not test.cfg.isolated
+        with self._lock:
+            refill = prespawn and self._pending[test.source.name] > 1
+        return self._pool.popen(test.source.name, shlex.split(test.cfg.command_shell),
+                                test.command, cwd, env, refill, _get_rlimits(test.cfg),
+                                idle=prespawn)
+
+    def _execute(self, test, show_output, comparator=None, cwd=None, env=None):
+        """Run the command of test
+        Returns
+        =======
+        (stdout, stderr, ret_code, timed_out, rusage, limit_exceeded). stdout is the
+        _OutputBuffer of the output when it was spilled to disk, otherwise it is a str
+        """
+        if self._uses_session(test):
+            return self._execute_session(test, show_output, cwd, env)
+        printer = _OutputPrinter() if show_output else None
+
+        def on_stdout(data):
+            if printer:
+                printer.write(data)
+            return comparator.feed(data) if comparator else False
+        start = time.perf_counter()
+        p = self._popen(test, cwd, env)
+        self._phase(test, 'spawn', start)
+        start = time.perf_counter()
+        with self._lock:
+            self._procs.add(p)
+        try:
+            with p:
+                stdout, stderr, timed_out, exceeded = _capture(
+                    p, on_stdout, self._get_timeout(test), keep_stdout=comparator is None,
+                    spill_bytes=test.cfg.spill_output_bytes, max_bytes=test.cfg.max_output_bytes)
+                rusage = _wait(p)
+        finally:
+            with self._lock:
+                self._procs.discard(p)
+        self._phase(test, 'wait', start)
+        if printer:
+            printer.close()
+        err_output = stderr.excerpt()
+        stderr.close()
+        if not stdout.spilled:
+            stdout = stdout.excerpt()
+        if exceeded:
+            limit = 'max_output_bytes'
+        else:
+            limit = _rlimit_exceeded(test.cfg, p.returncode, rusage)
+        return stdout, err_output, p.returncode, timed_out, rusage, limit
+
+    def _compare_output(self, test, actual_output, comparator=None):
+        """Finish comparing output compared while it was captured or spilled to disk
+        Returns
+        =======
+        (actual_output, out_verified, mismatch) where out_verified and mismatch are None if
+        the output is left to get_status to compare
+        """
+        spilled = isinstance(actual_output, _OutputBuffer)
+        if spilled and test.matcher is not None:
+            out_verified = test.matcher.match_chunks(actual_output.chunks())
+            excerpt = actual_output.excerpt()
+            actual_output.close()
+            return excerpt, out_verified, None
+        elif spilled:
+            # spilled output is compared from disk, only the start and end of it are kept
+            buf = actual_output
+            comparator = StreamingComparator(test.expected_output,
+                                             test.cfg.ignore_trailing_whitespace)
+            for chunk in buf.chunks():
+                comparator.feed(chunk)
+            actual_output = buf.excerpt()
+            buf.close()
+        elif comparator is None:
+            return actual_output, None, None
+        comparator.finish()
+        if not spilled and comparator.mismatch is not None:
+            # the output was compared while it was captured, only an excerpt of it was kept
+            actual_output = comparator.mismatch.actual
+        return actual_output, comparator.matched, comparator.mismatch
+
+    def _plan_cache(self):
+        """Cache key of each test and whether it is skipped, keyed by the id of the test
+
+        The key of a test includes the keys of the tests it waits for, so it runs again when
+        an earlier test changes. A test that passed before is only skipped when every test
+        waiting for it is skipped too, otherwise it runs for its side effects.
+        """
+        deps = self._dependencies()
+        keys = []
+        for test, waits in zip(self.tests, deps):
+            keys.append(self._cache.key(test, [keys[j] for j in sorted(waits)]))
+        skip = [self._cache.passed(key) for key in keys]
+        # tests only wait for earlier tests, so dependents are decided first
+        for i in reversed(range(len(keys))):
+            if not skip[i]:
+                for j in deps[i]:
+                    skip[j] = False
+        return {id(test): (key, s) for test, key, s in zip(self.tests, keys, skip)}
+
+    def _cached_result(self, test):
+        """Look test up in the result cache
+        Returns
+        =======
+        (cache key or None without a cache, cached ShellTestResult or None)
+        """
+        if self._cache is None:
+            return None, None
+        with self._lock:
+            if self._cache_plan is None:
+                self._cache_plan = self._plan_cache()
+        plan = self._cache_plan.get(id(test))
+        if plan is None:
+            key = self._cache.key(test)
+            plan = key, self._cache.passed(key)
+        key, skip = plan
+        if skip:
+            status = ShellTestResultStatus(True, True, True, cached=True)
+            return key, ShellTestResult(test, test.expected_output, '', 0, status)
+        return key, None
+
+    def _cache_status(self, key, status):
+        if key is not None and status.success:
+            self._cache.add(key)
 
     def run_test(self, test, show_output=False):
         """Run a single shell test
@@ -395,11 +1799,119 @@ class ShellTestRunner:
         =======
         The ShellTestResult of running test
         """
-        actual_output, err_output, ret_code = self._execute(test, show_output)
-        status = self.get_status(test, actual_output, ret_code)
-        return ShellTestResult(test, actual_output, err_output, ret_code, status)
-
-    def run(self, show_tests=False, show_output=False):
+        if self._hooks is None:
+            return self._run_test(test, show_output)
+        start = time.perf_counter()
+        self._hooks.on_test_start(test)
+        result = self._run_test(test, show_output)
+        self._hooks.on_test_end(result, start, time.perf_counter())
+        return result
+
+    def _run_test(self, test, show_output):
+        key, result = self._cached_result(test)
+        if result is not None:
+            return result
+        if self._expired():
+            return self._expired_result(test)
+        fixture = self._get_fixture(test)
+        if fixture is not None and not fixture.ok:
+            return self._setup_failed_result(test, fixture)
+        cwd = env = None
+        if fixture is not None:
+            cwd = fixture.copy() if test.cfg.isolated else fixture.path
+            env = fixture.env
+        comparator = self._get_comparator(test)
+        start = time.monotonic()
+        try:
+            actual_output, err_output, ret_code, timed_out, rusage, limit = \
+                self._execute(test, show_output, comparator, cwd, env)
+        finally:
+            if fixture is not None and test.cfg.isolated:
+                fixture.remove(cwd)
+        usage = _get_usage(time.monotonic() - start, rusage)
+        start = time.perf_counter()
+        actual_output, out_verified, mismatch = \
+            self._compare_output(test, actual_output, comparator)
+        status = self.get_status(test, actual_output, ret_code, timed_out, out_verified, limit)
+        self._phase(test, 'compare', start)
+        self._cache_status(key, status)
+        return ShellTestResult(test, actual_output, err_output, ret_code, status, usage, mismatch)
+
+    def _run_one(self, test, show_tests, show_output):
+        if show_tests:
+            end = '\n' if show_output else ''
+            print('exec: {!r} ... '.format(test.command), end=end)
+        res = self.run_test(test, show_output)
+        self._test_finished(test)
+        if show_tests:
+            print(_status_str(res.status))
+        return res
+
+    def _run_tests(self, tests, show_tests, show_output):
+        try:
+            for test in tests:
+                yield self._run_one(test, show_tests, show_output)
+        finally:
+            self._close_sessions(tests)
+            self._pool.discard(set(test.source.name for test in tests))
+
+    def _dependencies(self):
+        return _dependencies(self.tests)
+
+    def _kill_running(self):
+        """Kill the commands that are running on other threads"""
+        with self._lock:
+            procs = list(self._procs)
+        for p in procs:
+            _kill_group(p)
+        for session in list(self._sessions.values()):
+            session.kill()
+
+    def _run_graph(self, show_tests, show_output, jobs):
+        """Run tests on jobs threads, each as soon as the tests it waits for have finished
+        Returns
+        =======
+        A generator of ShellTestResults, in the order of the tests
+        """
+        deps = self._dependencies()
+        waiting = [len(d) for d in deps]
+        dependents = [[] for _ in deps]
+        for i, d in enumerate(deps):
+            for j in d:
+                dependents[j].append(i)
+        # ready tests are started in test order, so results can be yielded early
+        ready = [i for i, n in enumerate(waiting) if n == 0]
+        running = {}
+        results = {}
+        next_result = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            try:
+                while next_result < len(self.tests):
+                    while ready and len(running) < jobs:
+                        i = heapq.heappop(ready)
+                        # tests are shown once they finish, workers would interleave their lines
+                        future = executor.submit(self._run_one, self.tests[i], False, show_output)
+                        running[future] = i
+                    done, _ = wait_futures(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = running.pop(future)
+                        results[i] = future.result()
+                        if show_tests:
+                            print('exec: {!r} ... {}'.format(self.tests[i].command,
+                                                             _status_str(results[i].status)))
+                        for j in dependents[i]:
+                            waiting[j] -= 1
+                            if not waiting[j]:
+                                heapq.heappush(ready, j)
+                    while next_result in results:
+                        yield results.pop(next_result)
+                        next_result += 1
+            except BaseException:
+                # a Ctrl-C interrupts the main thread, the workers are waited for on exit
+                self._kill_running()
+                raise
+
+    def run(self, show_tests=False, show_output=False, jobs=1, total_timeout=None):
         """Run tests
         Parameters
         ==========
@@ -407,26 +1919,59 @@ class ShellTestRunner:
             display tests as they are executed
         show_output : bool (default: False)
             Show output from a command while it is running
+        jobs : int (default: 1)
+            number of tests to run concurrently. Tests within a single file are run in
+            order, unless they are independent, name the tests they need or are isolated
+        total_timeout : float (default: None)
+            seconds all tests may run for, tests still running or not yet started once it
+            has expired time out
 
         Returns
         =======
         A generator of ShellTestResults
         """
-        for test in self.tests:
-            if show_tests:
-                end = '\n' if show_output else ''
-                print('exec: {!r} ... '.format(test.command), end=end)
-            res = self.run_test(test, show_output)
-            if show_tests:
-                print('passed' if res.status.success else 'failed')
-            yield res
+        if total_timeout is not None:
+            self._deadline = time.monotonic() + total_timeout
+        try:
+            if jobs <= 1:
+                yield from self._run_tests(self.tests, show_tests, show_output)
+                return
+            yield from self._run_graph(show_tests, show_output, jobs)
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the sessions, processes and fixtures of the tests
+
+        run closes them when it is done, call close when running tests with run_test.
+        """
+        self._close_sessions(self.tests)
+        self._pool.close()
+        self._close_fixtures(self.tests)
 
 
 class ShellTestResultsFormatter:
     """ShellTestResultsFormatter"""
 
-    def __init__(self, results):
-        self._results = list(results)
+    # Limits on the size of diffs of unexpected output, None disables a limit
+    diff_context = 3
+    diff_max_hunks = 10
+    diff_max_lines = 200
+    # Inputs with more lines are only summarized by their first difference
+    diff_max_input_lines = 100000
+
+    def __init__(self, results, hooks=None):
+        """Initialize a ShellTestResultsFormatter
+        Parameters
+        ==========
+        results : iterable of ShellTestResult
+        hooks : ShellTestHooks or iterable of ShellTestHooks (default: None)
+            told how long formatting the results and the diff of each failure took
+        """
+        self._hooks = combine_hooks(hooks)
+        # passing tests are only counted, their output is dropped as results arrive
+        self._results = [r if not r.status.success else r._replace(actual_output='', err_output='')
+                         for r in results]
 
     def failed_tests(self):
         for r in self._results:
@@ -435,13 +1980,14 @@ class ShellTestResultsFormatter:
 
     @classmethod
     def diff(cls, expected, actual):
-        out = []
-        for line in difflib.unified_diff(expected.split('\n'),
-                                         actual.split('\n'),
-                                         'expected',
-                                         'actual',
-                                         lineterm=''):
-            out.append(line)
+        out = diff.unified_diff(expected.split('\n'),
+                                actual.split('\n'),
+                                'expected',
+                                'actual',
+                                context=cls.diff_context,
+                                max_hunks=cls.diff_max_hunks,
+                                max_lines=cls.diff_max_lines,
+                                max_input_lines=cls.diff_max_input_lines)
         return '\n'.join(out)
 
     @classmethod
@@ -458,11 +2004,31 @@ class ShellTestResultsFormatter:
         out = out[:1] + [space + line for line in out[1:]]
         return '\n'.join(out)
 
+    @classmethod
+    def failure_reason(cls, result):
+        """Short description of why result failed, None if it passed"""
+        if result.status.success:
+            return None
+        if result.status.setup_failed:
+            return 'failed setup command'
+        if result.status.limit_exceeded:
+            return 'exceeding {}'.format(result.status.limit_exceeded)
+        if result.status.timed_out:
+            return 'timeout'
+        if result.status.ret_code_verified or result.mismatch:
+            reason = 'unexpected output'
+        else:
+            reason = 'non-zero return code'
+        hint = _rlimit_hint(result.test.cfg, result.err_output or '')
+        if hint is not None:
+            reason += ', possibly from exceeding {}'.format(hint)
+        return reason
+
     @classmethod
     def format_result(cls, result, output_max_len=80):
         if result.status.success:
             return 'command completed successfully'
-        reason = 'unexpected output' if result.status.ret_code_verified else 'non-zero return code'
+        reason = cls.failure_reason(result)
         fmt = (
             'Command failed due to {reason}',
             '     file: {path}:{line_num}',
@@ -475,7 +2041,15 @@ class ShellTestResultsFormatter:
         indent = 11 # start of {diff} in msg
         expected = result.test.expected_output
         actual = result.actual_output
+        mismatch_line = None
+        if result.mismatch:
+            # Only excerpts around the first difference were kept
+            fmt = fmt[:4] + ('  differs: at output line {mismatch_line}',) + fmt[4:]
+            expected = result.mismatch.expected
+            actual = result.mismatch.actual
+            mismatch_line = result.mismatch.line_num
         msg = '\n'.join(fmt).format(reason=reason,
+                                    mismatch_line=mismatch_line,
                                     cmd=result.test.command,
                                     expected=cls.trunc(expected, output_max_len),
                                     actual=cls.trunc(actual, output_max_len),
@@ -487,8 +2061,31 @@ class ShellTestResultsFormatter:
             msg += ('\n   stderr: {stderr}'.format(stderr=cls.indent(result.err_output, indent)))
         return msg
 
-    def format(self):
-        """Return a string of formatted results"""
+    @classmethod
+    def format_usage(cls, result):
+        usage = result.usage
+        fields = ['{:8.3f}s wall'.format(usage.wall_time)]
+        if usage.user_time is not None:
+            fields.append('{:8.3f}s user'.format(usage.user_time))
+            fields.append('{:8.3f}s sys'.format(usage.system_time))
+            fields.append('{:8.1f}MiB rss'.format(usage.max_rss / 2**20))
+        fields.append('{}:{} {!r}'.format(result.test.source.name, result.test.source.line_num,
+                                          result.test.command))
+        return '  '.join(fields)
+
+    def slowest(self, n):
+        """The n results with the longest wall time"""
+        results = [r for r in self._results if r.usage is not None]
+        return sorted(results, key=lambda r: r.usage.wall_time, reverse=True)[:n]
+
+    def format(self, durations=0):
+        """Return a string of formatted results
+        Parameters
+        ==========
+        durations : int (default: 0)
+            number of slowest tests to list
+        """
+        start = time.perf_counter()
         src_stats = defaultdict(list)
         for r in self._results:
             src_stats[r.test.source.name].append(r)
@@ -497,21 +2094,151 @@ class ShellTestResultsFormatter:
         for src, results in list(src_stats.items()):
             n = len(results)
             p = sum(1 for r in results if r.status.success)
+            c = sum(1 for r in results if r.status.cached)
             failed_cnt += n - p
-            out.append('{} {} of {} ({:3.1f}%) passed'\
-                       .format(src, p, n, 100 * p / float(n)))
+            line = '{} {} of {} ({:3.1f}%) passed'.format(src, p, n, 100 * p / float(n))
+            if c:
+                line += ', {} cached'.format(c)
+            out.append(line)
             for r in [r for r in results if not r.status.success]:
+                diff_start = time.perf_counter()
                 out.append(self.format_result(r))
+                if self._hooks is not None:
+                    self._hooks.on_phase(r.test, 'diff', diff_start, time.perf_counter())
+        if durations:
+            slowest = self.slowest(durations)
+            out.append('slowest {} test(s)'.format(len(slowest)))
+            for r in slowest:
+                out.append(self.format_usage(r))
         if failed_cnt:
             out.append('{} test(s) failed'.format(failed_cnt))
-        return '\n'.join(out)
+        text = '\n'.join(out)
+        if self._hooks is not None:
+            self._hooks.on_report(text, start, time.perf_counter())
+        return text
+
 
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
-def run(paths, show_tests=False, show_output=False):
-    finder = ShellTestFileFinder(paths)
-    parsers = [ShellTestParser(p) for p in finder.find_paths()]
-    tests = list(itertools.chain.from_iterable(p.parse() for p in parsers))
-    runner = ShellTestRunner(tests)
-    results = runner.run(show_tests, show_output)
-    fmt = ShellTestResultsFormatter(results)
+
+def shard_paths(paths, index, count, durations=None, root=None):
+    """Select the paths of one shard, balancing the shards by the expected run time of files
+    Parameters
+    ==========
+    paths : iterable of paths
+    index : int
+        shard to select, from 1 to count
+    count : int
+        number of shards
+    durations : dict (default: None)
+        run time of files keyed by path relative to root, e.g. as written by
+        shelltest.reporters.DurationsReporter. Files without a duration are estimated from
+        their size
+    root : str (default: None)
+        directory the keys of durations are relative to, the current directory by default
+
+    Returns
+    =======
+    list of the paths of shard index, in the order they were given. The shards are disjoint
+    and the same for the same paths and durations, so every node of a split run must be given
+    the same durations
+    """
+    if not 1 <= index <= count:
+        raise ValueError('shard index {} is not between 1 and {}'.format(index, count))
+    paths = list(paths)
+    root = root or os.getcwd()
+    durations = {os.path.normpath(os.path.join(root, p)): d for p, d in (durations or {}).items()}
+    sizes = {p: _file_size(p) for p in paths}
+    known = [p for p in paths if os.path.abspath(p) in durations]
+    known_time = sum(durations[os.path.abspath(p)] for p in known)
+    known_size = sum(sizes[p] for p in known)
+
+    def weight(p):
+        duration = durations.get(os.path.abspath(p))
+        if duration is not None:
+            return duration
+        if not known:
+            return sizes[p]
+        if known_size and known_time:
+            # seconds per byte of the files that have been run before
+            return sizes[p] * known_time / known_size
+        return known_time / len(known)
+    weights = {p: weight(p) for p in paths}
+    # longest processing time first, each file goes to the least loaded shard
+    loads = [(0, i) for i in range(count)]
+    selected = set()
+    for p in sorted(weights, key=lambda p: (-weights[p], p)):
+        load, i = heapq.heappop(loads)
+        if i == index - 1:
+            selected.add(p)
+        heapq.heappush(loads, (load + weights[p], i))
+    return [p for p in paths if p in selected]
+
+
+def _discover(paths, hooks):
+    """Generator passing paths through, telling hooks how long finding each one took"""
+    paths = iter(paths)
+    while True:
+        start = time.perf_counter()
+        path = next(paths, None)
+        if path is None:
+            return
+        hooks.on_discover(path, start, time.perf_counter())
+        yield path
+
+
+def run(paths, show_tests=False, show_output=False, jobs=1, cfg=None, total_timeout=None,
+        cache=None, history=None, last_failed=False, failed_first=False, parse_cache=None,
+        include=None, exclude=None, compact=False, reporters=None, shard=None, hooks=None,
+        shard_durations=None):
+    hooks = combine_hooks(hooks)
+    finder = ShellTestFileFinder(paths, cfg, include, exclude)
+    file_paths = finder.find_paths()
+    if hooks is not None:
+        file_paths = _discover(file_paths, hooks)
+    if shard is not None:
+        index, count = shard
+        # the history differs between nodes, only durations given to every node are used
+        file_paths = shard_paths(file_paths, index, count, shard_durations)
+    if history is not None and (last_failed or failed_first):
+        file_paths = list(file_paths)
+        if last_failed:
+            file_paths = history.last_failed(file_paths)
+        if failed_first:
+            file_paths = history.failed_first(file_paths)
+
+    def parse(path):
+        parser = ShellTestParser(path, cfg, parse_cache, compact)
+        if hooks is None:
+            return parser.parse()
+        start = time.perf_counter()
+        tests = parser.parse()
+        hooks.on_parse(path, tests, start, time.perf_counter())
+        return tests
+    # files are parsed as the finder yields them
+    tests = list(itertools.chain.from_iterable(parse(p) for p in file_paths))
+    if parse_cache is not None:
+        parse_cache.save()
+    if history is not None and last_failed:
+        # failed tests run with the earlier tests they wait for, e.g. ones setting up state
+        failed = [history.failed(t.source) for t in tests]
+        if any(failed):
+            tests = _with_dependencies(tests, failed)
+    runner = ShellTestRunner(tests, cache, hooks)
+    results = runner.run(show_tests, show_output, jobs, total_timeout)
+    if history is not None:
+        results = history.record(results)
+    if reporters:
+        # imported here as shelltest.reporters depends on this module
+        from shelltest.reporters import report
+        results = report(results, reporters)
+    fmt = ShellTestResultsFormatter(results, hooks)
+    if cache is not None:
+        cache.save()
+    if history is not None:
+        history.save()
     return results, fmt, sum(1 for _ in fmt.failed_tests())
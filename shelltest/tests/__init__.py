@@ -0,0 +1,26 @@
+import shlex
+
+from shelltest.shelltest import ShellTest, ShellTestConfig, ShellTestParser, ShellTestSource
+
+
+def barrier(path, count):
+    """Shell commands that wait until count commands using the barrier directory path have
+    reached it. Tests using a barrier only pass when they run concurrently, give them a timeout."""
+    path = shlex.quote(str(path))
+    return ('mkdir -p {0}; touch {0}/$$; '
+            'until [ $(ls {0} | wc -l) -ge {1} ]; do sleep 0.01; done; ').format(path, count)
+
+
+def command_test(command, output=u'', **options):
+    """ShellTest of command expecting output, options are set on its configuration"""
+    cfg = ShellTestConfig()
+    for key, val in options.items():
+        cfg[key] = val
+    return ShellTest(command, output, ShellTestSource('', 0), cfg)
+
+
+def write_tests(tmpdir, name, content):
+    """Write the shell test file name to tmpdir, returns its parsed tests"""
+    path = tmpdir.join(name)
+    path.write(content)
+    return ShellTestParser(str(path)).parse()
@@ -0,0 +1,114 @@
+import asyncio
+import io
+import sys
+
+import pytest
+
+from shelltest.async_runner import AsyncShellTestRunner
+from shelltest.shelltest import (ShellTest, ShellTestSource, ShellTestConfig, ShellTestParser,
+                                 ShellTestResultsFormatter)
+from shelltest.tests import barrier
+
+
+def collect(runner, **kwargs):
+    async def _collect():
+        return [r async for r in runner.run(**kwargs)]
+    return asyncio.run(_collect())
+
+
+@pytest.mark.parametrize(u'cmd,output,ret_code,success', (
+    (u'echo hello', u'hello\n', 0, True),
+    (u'awk \'BEGIN { printf "%s", "asdf" }\'', u'asdf', 0, True),
+    (u'exit 42', u'', 42, False),
+))
+def test_run(cmd, output, ret_code, success):
+    test = ShellTest(cmd, output, ShellTestSource('', 0), ShellTestConfig())
+    res, = collect(AsyncShellTestRunner([test]))
+    assert res.ret_code == ret_code
+    assert res.status.success == success
+    assert res.test == test
+
+
+def test_files_run_concurrently_in_order(tmpdir):
+    cfg = ShellTestConfig()
+    cfg.timeout = 10
+    # each test waits for all of them to start, they time out unless they run concurrently
+    wait = barrier(tmpdir.join('barrier'), 4)
+    tests = [ShellTest(wait + u'echo {}'.format(i), u'{}\n'.format(i),
+                       ShellTestSource(str(i), 0), cfg) for i in range(4)]
+    results = collect(AsyncShellTestRunner(tests, concurrency=4))
+    assert [r.test for r in results] == tests
+    assert all(r.status.success for r in results)
+
+
+def test_session():
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"> X=5\n"
+    u"> echo $X\n"
+    u"5\n")
+    results = collect(AsyncShellTestRunner(ShellTestParser(fobj).parse()))
+    assert all(r.status.success for r in results)
+
+
+def test_timeout():
+    cfg = ShellTestConfig()
+    cfg.timeout = 0.2
+    test = ShellTest(u'echo start; sleep 10', u'start\n', ShellTestSource('', 0), cfg)
+    res, = collect(AsyncShellTestRunner([test]))
+    assert res.status.timed_out
+    assert res.actual_output == u'start\n'
+
+
+def test_async_max_output_bytes_and_spill():
+    cfg = ShellTestConfig()
+    cfg.max_output_bytes = 100000
+    cfg.spill_output_bytes = 1024
+    tests = [ShellTest('yes', '', ShellTestSource('', 0), cfg),
+             ShellTest('seq 1 5000', ''.join('{}\n'.format(i) for i in range(1, 5001)),
+                       ShellTestSource('', 1), cfg)]
+    results = collect(AsyncShellTestRunner(tests))
+    assert results[0].status.limit_exceeded == 'max_output_bytes'
+    assert results[1].status.success
+    assert '... ' in results[1].actual_output
+
+
+def test_async_resource_limits():
+    cfg = ShellTestConfig()
+    cfg.max_open_files = 20
+    code = u"fs = [open('/dev/null') for i in range({})]"
+    tests = [ShellTest(u'{} -c "{}"'.format(sys.executable, code.format(n)), u'',
+                       ShellTestSource('', n), cfg) for n in (100, 5)]
+    results = collect(AsyncShellTestRunner(tests))
+    assert not results[0].status.success
+    assert 'possibly from exceeding max_open_files' in \
+        ShellTestResultsFormatter.failure_reason(results[0])
+    assert results[1].status.success
+
+
+def test_async_dependencies(tmpdir):
+    path = tmpdir.join('dag.sh')
+    # the independent tests wait for each other at the barrier
+    wait = barrier(tmpdir.join('barrier'), 2)
+    path.write('#[sht] independent = true\n'
+               '#[sht] timeout = 10\n'
+               '> {0}echo a > a\n'
+               '> {0}echo b\nb\n'
+               '> cat a; rm a #[sht] needs = 3\na\n'.format(wait))
+    tests = ShellTestParser(str(path)).parse()
+    results = collect(AsyncShellTestRunner(tests, concurrency=4))
+    assert [r.test for r in results] == tests
+    assert all(r.status.success for r in results)
+
+
+def test_async_streaming_compare():
+    cfg = ShellTestConfig()
+    cfg.streaming_compare = True
+    cfg.kill_on_mismatch = True
+    tests = [ShellTest(u'yes', u'y\ny\nn\n', ShellTestSource('', 0), cfg),
+             ShellTest(u'seq 1 3', u'1\n2\n3\n', ShellTestSource('', 1), cfg)]
+    results = collect(AsyncShellTestRunner(tests))
+    assert not results[0].status.output_verified
+    assert results[0].mismatch.line_num == 3
+    assert results[1].status.success
+    assert results[1].actual_output == u'1\n2\n3\n'
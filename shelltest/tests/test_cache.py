@@ -0,0 +1,140 @@
+import os
+
+from shelltest.cache import ShellTestParseCache, ShellTestResultCache, ShellTestRunHistory
+from shelltest.shelltest import (ShellTest, ShellTestSource, ShellTestRunner, ShellTestConfig,
+                                 ShellTestParser, run)
+
+
+def make_test(tmpdir, cmd=u'echo hi', output=u'hi\n', depends=(), name='t.sh'):
+    cfg = ShellTestConfig()
+    cfg.depends = depends
+    return ShellTest(cmd, output, ShellTestSource(str(tmpdir.join(name)), 1), cfg)
+
+
+def test_passing_tests_are_cached(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    tests = [make_test(tmpdir), make_test(tmpdir, u'false', u'', name='u.sh')]
+    cache = ShellTestResultCache(cache_dir)
+    results = list(ShellTestRunner(tests, cache).run())
+    assert [r.status.cached for r in results] == [False, False]
+    cache.save()
+    results = list(ShellTestRunner(tests, ShellTestResultCache(cache_dir)).run())
+    assert [r.status.cached for r in results] == [True, False]
+    assert results[0].status.success
+
+
+def test_key_changes_with_dependency(tmpdir):
+    dep = tmpdir.join('tool')
+    dep.write('v1')
+    cache = ShellTestResultCache(str(tmpdir.join('cache')))
+    test = make_test(tmpdir, depends=('tool',))
+    key = cache.key(test)
+    assert key == cache.key(test)
+    assert key != cache.key(make_test(tmpdir, output=u'hi'))
+    dep.write('version 2')
+    assert key != cache.key(test)
+
+
+def test_earlier_tests_run_for_later_tests(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    path = tmpdir.join('t.sh')
+    def run(content):
+        path.write(content)
+        cache = ShellTestResultCache(cache_dir)
+        results = list(ShellTestRunner(ShellTestParser(str(path)).parse(), cache).run())
+        cache.save()
+        return [(r.status.cached, r.status.success) for r in results]
+    assert run('> echo hi > out.txt\n> cat out.txt; rm out.txt; exit 1\nhi\n') == \
+        [(False, True), (False, False)]
+    # the first test passed, but runs again as the second test waits for it
+    assert run('> echo hi > out.txt\n> cat out.txt; rm out.txt\nhi\n') == \
+        [(False, True), (False, True)]
+    assert run('> echo hi > out.txt\n> cat out.txt; rm out.txt\nhi\n') == \
+        [(True, True), (True, True)]
+    # changing an earlier test changes the keys of the tests after it
+    assert run('> echo hi > out.txt; true\n> cat out.txt; rm out.txt\nhi\n') == \
+        [(False, True), (False, True)]
+
+
+def test_eviction(tmpdir, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr('shelltest.cache.time.time', lambda: next(clock))
+    cache_dir = str(tmpdir.join('cache'))
+    cache = ShellTestResultCache(cache_dir, max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.add(key)
+    cache.save()
+    cache = ShellTestResultCache(cache_dir)
+    assert not cache.passed('a')
+    assert cache.passed('b') and cache.passed('c')
+
+
+def test_history_last_failed_and_failed_first(tmpdir):
+    history_dir = str(tmpdir.join('cache'))
+    a, b = str(tmpdir.join('a.sh')), str(tmpdir.join('b.sh'))
+    tests = [ShellTest(u'true', u'', ShellTestSource(a, 1), ShellTestConfig()),
+             ShellTest(u'true', u'', ShellTestSource(b, 1), ShellTestConfig()),
+             ShellTest(u'false', u'', ShellTestSource(b, 2), ShellTestConfig())]
+    history = ShellTestRunHistory(history_dir)
+    list(history.record(ShellTestRunner(tests).run()))
+    history.save()
+
+    history = ShellTestRunHistory(history_dir)
+    assert [history.failed(t.source) for t in tests] == [False, False, True]
+    assert history.duration(tests[0].source) > 0
+    assert history.last_failed([a, b]) == [b]
+    assert history.failed_first([a, b]) == [b, a]
+
+
+def test_last_failed_runs_earlier_tests(tmpdir):
+    path = tmpdir.join('t.sh')
+    path.write('> echo a\na\n> echo hi > out.txt\n> cat out.txt; rm out.txt\nbye\n'
+               '> echo b #[sht] independent = true\nb\n')
+    history = ShellTestRunHistory(str(tmpdir.join('cache')))
+    results, fmt, failed = run([str(path)], history=history)
+    assert failed == 1
+    path.write('> echo a\na\n> echo hi > out.txt\n> cat out.txt; rm out.txt\nhi\n'
+               '> echo b #[sht] independent = true\nb\n')
+    results, fmt, failed = run([str(path)], history=history, last_failed=True)
+    # the failed test runs with the tests it waits for, the independent test is left out
+    assert [r.test.source.line_num for r in fmt._results] == [1, 3, 4]
+    assert failed == 0
+
+
+def test_history_last_failed_without_failures(tmpdir):
+    history = ShellTestRunHistory(str(tmpdir.join('cache')))
+    assert history.last_failed(['a.sh', 'b.sh']) == ['a.sh', 'b.sh']
+
+
+def test_parse_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    path = tmpdir.join('t.sh')
+    path.write(u'#[sht] command_prompt = $\n$ echo hi\nhi\n$ echo $?\n0\n')
+    tests = ShellTestParser(str(path)).parse()
+
+    cache = ShellTestParseCache(cache_dir)
+    assert ShellTestParser(str(path), cache=cache).parse() == tests
+    cache.save()
+
+    cache = ShellTestParseCache(cache_dir)
+    parser = ShellTestParser(str(path), cache=cache)
+    assert parser.parse() == tests
+    assert parser._cfg.command_prompt == u'$'
+    assert tests[0].cfg is not tests[1].cfg
+
+    # Changing the default configuration invalidates the entry
+    cfg = ShellTestConfig()
+    cfg.timeout = 5
+    assert ShellTestParser(str(path), cfg, cache=cache).parse()[0].cfg.timeout == 5
+
+    # Options of single tests and the matchers compiled from them are kept
+    path.write(u'> echo v1 #[sht] match = regex\nv\\d\n> echo a\na\n')
+    tests = ShellTestParser(str(path), cache=cache).parse()
+    cached = ShellTestParser(str(path), cache=cache).parse()
+    assert cached == tests
+    assert cached[0].cfg.match == 'regex' and cached[0].matcher is not None
+    assert cached[1].cfg.match == 'exact' and cached[1].matcher is None
+
+    # Changing the file invalidates the entry
+    path.write(u'> echo bye\nbye\n')
+    assert [t.command for t in ShellTestParser(str(path), cache=cache).parse()] == [u'echo bye']
@@ -0,0 +1,95 @@
+import pytest
+
+from shelltest.compare import StreamingComparator
+from shelltest.shelltest import ShellTest, ShellTestSource, ShellTestRunner, ShellTestConfig
+
+
+expected = u''.join(u'line {}\n'.format(i) for i in range(20))
+
+
+def compare(expected, actual, ignore_trailing_whitespace, chunk_size=3):
+    c = StreamingComparator(expected, ignore_trailing_whitespace, context=2)
+    for i in range(0, len(actual), chunk_size):
+        c.feed(actual[i:i + chunk_size])
+    c.finish()
+    return c
+
+
+@pytest.mark.parametrize('ignore_trailing_whitespace', (True, False))
+def test_match(ignore_trailing_whitespace):
+    c = compare(expected, expected.encode('utf-8'), ignore_trailing_whitespace)
+    assert c.matched
+    assert c.mismatch is None
+
+
+@pytest.mark.parametrize('ignore_trailing_whitespace', (True, False))
+@pytest.mark.parametrize('actual,line_num', (
+    (expected.replace(u'line 10', u'LINE 10'), 11),
+    (expected[:50], 8),
+    (expected + u'extra\n', 21),
+))
+def test_mismatch(ignore_trailing_whitespace, actual, line_num):
+    c = compare(expected, actual.encode('utf-8'), ignore_trailing_whitespace)
+    assert not c.matched
+    assert c.mismatch.line_num == line_num
+
+
+def test_mismatch_context():
+    c = compare(expected, expected.replace(u'line 10', u'LINE 10').encode('utf-8'), False)
+    assert c.mismatch.expected == u'line 8\nline 9\nline 10\nline 11\nline 12\n'
+    assert c.mismatch.actual == u'line 8\nline 9\nLINE 10\nline 11\nline 12'
+
+
+def test_ignore_trailing_whitespace():
+    assert compare(u'a\nb\n', b'a   \n\n  b\n\n', True).matched
+    assert not compare(u'a\nb\n', b'a   \n\n  b\n\n', False).matched
+
+
+def test_runner_kills_on_mismatch():
+    cfg = ShellTestConfig()
+    cfg.streaming_compare = True
+    cfg.kill_on_mismatch = True
+    tests = [ShellTest(u'yes', u'y\ny\nn\n', ShellTestSource('', 0), cfg),
+             ShellTest(u'seq 1 3', u'1\n2\n3\n', ShellTestSource('', 1), cfg)]
+    results = list(ShellTestRunner(tests).run())
+    assert not results[0].status.output_verified
+    assert results[0].mismatch.line_num == 3
+    assert results[1].status.success
+    assert results[1].mismatch is None
+    assert results[1].actual_output == u'1\n2\n3\n'
+
+
+def test_runner_keeps_excerpt_of_matching_output():
+    cfg = ShellTestConfig()
+    cfg.streaming_compare = True
+    tests = [ShellTest(u"printf '1  \\n2\\n'", u'1\n2\n', ShellTestSource('', 0), cfg),
+             ShellTest(u'seq 1 100000', u''.join(u'{}\n'.format(i) for i in range(1, 100001)),
+                       ShellTestSource('', 1), cfg)]
+    results = list(ShellTestRunner(tests).run())
+    assert all(r.status.success for r in results)
+    # the actual output is reported, not the expected output
+    assert results[0].actual_output == u'1  \n2\n'
+    excerpt = results[1].actual_output
+    assert excerpt.startswith(u'1\n2\n') and excerpt.endswith(u'99999\n100000\n')
+    assert u'bytes not shown' in excerpt and len(excerpt) < 10000
+
+
+def test_long_line_is_not_buffered():
+    c = StreamingComparator(expected, True, context=2)
+    for _ in range(100):
+        c.feed(b'x' * 65536)
+        if c.done:
+            break
+    assert c.done
+    assert c.mismatch.line_num == 1
+    assert len(c.mismatch.actual) <= 2 * 65536
+
+
+def test_long_whitespace_is_not_compared():
+    c = StreamingComparator(u'a\n', True)
+    c.feed(b'a')
+    for _ in range(10):
+        c.feed(b' ' * 65536)
+    c.feed(b'\n')
+    c.finish()
+    assert c.matched
@@ -0,0 +1,71 @@
+import difflib
+import random
+
+import pytest
+
+from shelltest import diff
+from shelltest.shelltest import ShellTestResultsFormatter
+
+
+def apply_opcodes(a, b, opcodes):
+    out = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+            out.extend(a[i1:i2])
+        else:
+            out.extend(b[j1:j2])
+    return out
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_opcodes_large_inputs(seed):
+    rng = random.Random(seed)
+    a = ['line {}'.format(rng.randrange(5000)) for _ in range(3000)]
+    b = list(a)
+    for _ in range(50):
+        i = rng.randrange(len(b))
+        b[i:i + rng.randrange(3)] = ['new {}'.format(rng.randrange(10))] * rng.randrange(3)
+    assert apply_opcodes(a, b, diff.get_opcodes(a, b)) == b
+
+
+def test_opcodes_large_inputs_without_unique_lines():
+    a = ['a', 'b'] * 2000
+    b = ['b', 'c'] * 2000
+    assert apply_opcodes(a, b, diff.get_opcodes(a, b)) == b
+
+
+def test_small_inputs_match_difflib():
+    a = ['a', 'b', 'c', 'd', 'e']
+    b = ['a', 'c', 'd', 'x', 'e', 'f']
+    assert diff.unified_diff(a, b) == list(difflib.unified_diff(a, b, 'expected', 'actual',
+                                                                lineterm=''))
+
+
+def test_max_hunks():
+    a = ['line {}'.format(i) for i in range(10000)]
+    b = ['changed' if i % 100 == 0 else line for i, line in enumerate(a)]
+    out = diff.unified_diff(a, b, max_hunks=2)
+    assert sum(1 for line in out if line.startswith('@@')) == 2
+    assert out[-1] == '... 98 more hunk(s) not shown'
+
+
+def test_max_lines():
+    a = ['line {}'.format(i) for i in range(100)]
+    out = diff.unified_diff(a, [], max_lines=10)
+    assert len(out) == 11
+    assert out[-1] == '... diff truncated after 10 lines'
+
+
+def test_max_input_lines_summary():
+    a = ['line {}'.format(i) for i in range(100)]
+    b = a[:50] + ['changed'] + a[51:]
+    assert diff.unified_diff(a, b, max_input_lines=10) == [
+        'first difference at line 51 (100 expected lines, 100 actual lines)',
+        '-line 50',
+        '+changed']
+
+
+def test_formatter_diff():
+    assert ShellTestResultsFormatter.diff('a\nb', 'a\nc') == \
+        '--- expected\n+++ actual\n@@ -1,2 +1,2 @@\n a\n-b\n+c'
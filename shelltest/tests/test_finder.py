@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from shelltest.shelltest import ShellTestFileFinder
+
+
+@pytest.fixture
+def tree(tmpdir):
+    for path in ('a.sh', 'b.txt', 'sub/c.shtest', 'sub/deep/d.sh', '.git/e.sh',
+                 'node_modules/pkg/f.sh', 'other/g.test'):
+        p = tmpdir.join(path)
+        p.dirpath().ensure(dir=True)
+        p.write('')
+    return tmpdir
+
+
+def found(tree, **kwargs):
+    finder = ShellTestFileFinder(str(tree), **kwargs)
+    return [os.path.relpath(p, str(tree)) for p in finder.find_paths()]
+
+
+def test_default_excludes_are_pruned(tree):
+    assert found(tree) == ['a.sh', 'sub/c.shtest', 'sub/deep/d.sh']
+
+
+def test_without_default_excludes(tree):
+    assert sorted(found(tree, default_exclude=False)) == [
+        '.git/e.sh', 'a.sh', 'node_modules/pkg/f.sh', 'sub/c.shtest', 'sub/deep/d.sh']
+
+
+def test_exclude(tree):
+    assert found(tree, exclude=['deep']) == ['a.sh', 'sub/c.shtest']
+    assert found(tree, exclude=['sub/*.shtest']) == ['a.sh', 'sub/deep/d.sh']
+
+
+def test_include(tree):
+    assert found(tree, include=['*.test', '*.txt']) == ['b.txt', 'other/g.test']
+
+
+def test_explicit_file_path(tree):
+    finder = ShellTestFileFinder([str(tree.join('a.sh')), str(tree.join('b.txt'))])
+    assert list(finder.find_paths()) == [str(tree.join('a.sh'))]
+
+
+def test_generic_directory_names_are_searched(tmpdir):
+    for path in ('build/a.sh', 'dist/b.sh', '.tox/c.sh'):
+        tmpdir.join(path).ensure()
+    assert sorted(found(tmpdir)) == ['build/a.sh', 'dist/b.sh']
@@ -0,0 +1,110 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+from shelltest.async_runner import AsyncShellTestRunner
+from shelltest.hooks import ChromeTraceProfiler, combine_hooks, ShellTestHooks
+from shelltest.shelltest import run, ShellTestParser
+from shelltest.tests import write_tests
+
+
+class Recorder(ShellTestHooks):
+    def __init__(self):
+        self.events = []
+
+    def on_discover(self, path, start, end):
+        assert start <= end
+        self.events.append(('discover', path))
+
+    def on_parse(self, path, tests, start, end):
+        self.events.append(('parse', path, len(tests)))
+
+    def on_test_start(self, test):
+        self.events.append(('start', test.command))
+
+    def on_phase(self, test, phase, start, end):
+        assert start <= end
+        self.events.append((phase, test.command))
+
+    def on_test_end(self, result, start, end):
+        self.events.append(('end', result.test.command, result.status.success))
+
+    def on_report(self, text, start, end):
+        self.events.append(('report', text))
+
+
+@pytest.fixture
+def files(tmpdir):
+    """a.sh with a failing test and b.sh, whose test runs in a session"""
+    write_tests(tmpdir, 'a.sh', '> echo a\na\n> echo b\nc\n')
+    write_tests(tmpdir, 'b.sh', '#[sht] session = true\n> echo d\nd\n')
+    return str(tmpdir.join('a.sh')), str(tmpdir.join('b.sh'))
+
+
+def test_hook_events(files):
+    a, b = files
+    recorder = Recorder()
+    results, fmt, failed = run([a, b], hooks=recorder)
+    text = fmt.format()
+    assert failed == 1
+    assert recorder.events == [
+        ('discover', a), ('parse', a, 2), ('discover', b), ('parse', b, 1),
+        ('start', 'echo a'), ('spawn', 'echo a'), ('wait', 'echo a'), ('compare', 'echo a'),
+        ('end', 'echo a', True),
+        ('start', 'echo b'), ('spawn', 'echo b'), ('wait', 'echo b'), ('compare', 'echo b'),
+        ('end', 'echo b', False),
+        ('start', 'echo d'), ('wait', 'echo d'), ('compare', 'echo d'), ('end', 'echo d', True),
+        ('diff', 'echo b'), ('report', text)]
+
+
+def test_async_hook_events(files):
+    a, b = files
+    tests = ShellTestParser(a).parse() + ShellTestParser(b).parse()
+    recorder = Recorder()
+
+    async def collect():
+        return [r async for r in AsyncShellTestRunner(tests, hooks=recorder).run()]
+    results = asyncio.run(collect())
+    assert [r.status.success for r in results] == [True, False, True]
+    for cmd, phases, success in (('echo a', ['spawn', 'wait', 'compare'], True),
+                                 ('echo b', ['spawn', 'wait', 'compare'], False),
+                                 ('echo d', ['wait', 'compare'], True)):
+        events = [e for e in recorder.events if e[1] == cmd]
+        assert events == [('start', cmd)] + [(p, cmd) for p in phases] + [('end', cmd, success)]
+
+
+def test_combine_hooks():
+    assert combine_hooks(None) is None
+    assert combine_hooks([]) is None
+    recorder = Recorder()
+    assert combine_hooks(recorder) is recorder
+    assert combine_hooks([recorder]) is recorder
+    other = Recorder()
+    combine_hooks([recorder, other]).on_report('text', 0, 1)
+    assert recorder.events == other.events == [('report', 'text')]
+
+
+def test_chrome_trace_profiler(files):
+    a, b = files
+    out = io.StringIO()
+    profiler = ChromeTraceProfiler(out)
+    results, fmt, failed = run([a, b], jobs=2, hooks=profiler)
+    fmt.format()
+    profiler.save()
+    events = json.loads(out.getvalue())['traceEvents']
+    threads = {e['tid']: e['args']['name'] for e in events if e['name'] == 'thread_name'}
+    spans = [e for e in events if e['ph'] == 'X']
+    assert all(e['tid'] in threads for e in spans)
+    assert sorted(e['name'] for e in spans if e['cat'] not in ('test', 'phase')) == \
+        ['discover', 'discover', 'parse', 'parse', 'report']
+    tests = [e for e in spans if e['cat'] == 'test']
+    assert sorted(e['name'] for e in tests) == [a + ':1', a + ':3', b + ':2']
+    # files run on worker threads, the phases of a test are nested in it
+    assert all(threads[e['tid']] != 'MainThread' for e in tests)
+    for e in spans:
+        if e['cat'] == 'phase' and e['name'] != 'diff':
+            test = next(t for t in tests if t['name'] == e['args']['test'])
+            assert test['tid'] == e['tid']
+            assert test['ts'] <= e['ts'] and e['ts'] + e['dur'] <= test['ts'] + test['dur']
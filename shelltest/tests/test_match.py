@@ -0,0 +1,105 @@
+import os
+import tempfile
+from io import StringIO
+
+import pytest
+
+from shelltest.match import ShellTestMatcher, _gen_lines
+from shelltest.shelltest import (ShellTestConfig, ShellTestParser, ShellTestRunner,
+                                 _OutputBuffer)
+
+
+@pytest.mark.parametrize('mode,expected,actual,matched', [
+    ('exact', 'a b\n', 'a b\n', True),
+    ('exact', 'a b\n', 'a  b\n', False),
+    ('exact', 'build {{re:\\d+}} ok\n', 'build 42 ok\n', True),
+    ('exact', 'build {{re:\\d+}} ok\n', 'build x ok\n', False),
+    ('exact', 'a.b {{re:x}}\n', 'axb x\n', False),
+    ('regex', 'pid \\d+ (ok|fine)\n', 'pid 12 fine\n', True),
+    ('regex', 'pid \\d+\n', 'pid 12 fine\n', False),
+    ('glob', 'file-*.txt\n', 'file-abc.txt\n', True),
+    ('glob', 'file-?.txt\n', 'file-abc.txt\n', False),
+    ('numeric', 'took 1.5s of 3\n', 'took 1.5000001s of 3\n', True),
+    ('numeric', 'took 1.5s of 3\n', 'took 1.6s of 3\n', False),
+    ('numeric', 'took 1.5s of 3\n', 'took 1.5 s of 3\n', False),
+    ('numeric', '{{re:\\w+}} 1e3\n', 'x 1000.0000001\n', True),
+    ('numeric', '1{{re:-}}2\n', '1-2.0\n', True),
+])
+def test_modes(mode, expected, actual, matched):
+    assert ShellTestMatcher(expected, mode).match(actual) == matched
+
+
+def test_line_count_and_whitespace():
+    assert ShellTestMatcher('a\n\nb  \n', 'regex').match('a\nb\n\n')
+    assert not ShellTestMatcher('a\nb\n', 'regex').match('a\n')
+    assert not ShellTestMatcher('a\n', 'regex').match('a\nb\n')
+    assert not ShellTestMatcher('a\n', 'regex', ignore_trailing_whitespace=False).match('a \n')
+
+
+def test_normalize():
+    source_dir = tempfile.mkdtemp()
+    try:
+        m = ShellTestMatcher('red $SHELLTEST_DIR/x $TMP/y\n', normalize=('ansi', 'paths'),
+                             source_dir=source_dir)
+        tmp = tempfile.gettempdir()
+        assert m.match('\x1b[31mred\x1b[0m {}/x {}/y\n'.format(source_dir, tmp))
+        assert not m.match('red {}/x {}/y\n'.format(os.getcwd(), tmp))
+    finally:
+        os.rmdir(source_dir)
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        ShellTestMatcher('', 'fuzzy')
+    with pytest.raises(ValueError):
+        ShellTestMatcher('', normalize=('dates',))
+    with pytest.raises(ValueError):
+        ShellTestConfig().match = 'fuzzy'
+
+
+def test_match_chunks():
+    m = ShellTestMatcher('n\\d+\n' * 1000, 'regex')
+    buf = _OutputBuffer(spill_bytes=64)
+    buf.write(''.join('n{}\n'.format(i) for i in range(1000)).encode())
+    try:
+        assert buf.spilled
+        assert m.match_chunks(buf.chunks())
+        assert not ShellTestMatcher('n\\d+\n' * 999, 'regex').match_chunks(buf.chunks())
+    finally:
+        buf.close()
+
+
+def test_gen_lines_bounded():
+    chunks = [b'ab\nc', b'd' * 100, b'e\nf', b'g' * 50, b'\xc3', b'\xa9h\n', b'i' * 20]
+    assert list(_gen_lines(chunks)) == \
+        ['ab', 'c' + 'd' * 100 + 'e', 'f' + 'g' * 50 + '\xe9h', 'i' * 20]
+    assert list(_gen_lines(chunks, 10)) == ['ab', 'c' + 'd' * 9, 'f' + 'g' * 9, 'i' * 10]
+    assert list(_gen_lines(chunks, 200)) == list(_gen_lines(chunks))
+    # a long line that is not expected still fails to match
+    m = ShellTestMatcher('a\n{{re:x+}}\n', 'exact')
+    assert m.match_chunks([b'a\n', b'x' * 100000, b'x' * 100000, b'\n'])
+    assert not ShellTestMatcher('a\nb\n').match_chunks([b'a\nb', b'x' * 200000, b'\n'])
+
+
+def test_parsed_tests_are_compiled_once():
+    fobj = StringIO(
+        u"#[sht] normalize = ansi\n"
+        u"> printf '\\033[1mbold\\033[0m\\n'\n"
+        u"bold\n"
+        u"> echo 'v1.2' #[sht] match = regex #[sht] timeout = 5\n"
+        u"v\\d\\.\\d\n"
+        u"> echo plain\n"
+        u"pl.in\n")
+    tests = ShellTestParser(fobj).parse()
+    assert [t.command for t in tests] == [u"printf '\\033[1mbold\\033[0m\\n'", u"echo 'v1.2'",
+                                          u'echo plain']
+    assert tests[1].cfg.match == 'regex' and tests[1].cfg.timeout == 5
+    assert tests[2].cfg.match == 'exact'
+    assert all(t.matcher is not None for t in tests)
+    results = list(ShellTestRunner(tests).run())
+    assert [r.status.success for r in results] == [True, True, False]
+
+
+def test_exact_tests_are_not_compiled():
+    tests = ShellTestParser(StringIO(u"> echo hi\nhi\n")).parse()
+    assert tests[0].matcher is None
@@ -5,7 +5,7 @@ import pytest
 
 from shelltest.shelltest import (ShellTestParser, ShellTest,
                                  ShellTestSource, ShellTestConfig,
-                                 is_escaped_newline)
+                                 CompactShellTest, is_escaped_newline)
 
 
 _script = u"""\
@@ -65,6 +65,19 @@ def test_header_config():
     assert p._cfg.ignore_trailing_whitespace == True
 
 
+@pytest.mark.parametrize(u'line,cmd,timeout', (
+    (u"> echo a #[sht] timeout = 2", u"echo a", 2),
+    (u"> grep '#[sht] timeout = 1' f.sh", u"grep '#[sht] timeout = 1' f.sh", None),
+    (u'> echo "#[sht] x = 1" #[sht] timeout = 2', u'echo "#[sht] x = 1"', 2),
+    (u"> echo \\#[sht] timeout = 1", u"echo \\#[sht] timeout = 1", None),
+    (u"> echo 'a\\' #[sht] timeout = 2", u"echo 'a\\'", 2),
+))
+def test_quoted_cmd_args(line, cmd, timeout):
+    test, = ShellTestParser(StringIO(line + u"\n")).parse()
+    assert test.command == cmd
+    assert test.cfg.timeout == timeout
+
+
 def test_ignore_comments():
     fobj = StringIO(
         u"> # Ignore this line\n"\
@@ -117,3 +130,64 @@ def test_multiline_command():
     (u'line\\\\\n', False)))
 def test_is_escaped_newline(line, expected):
     assert is_escaped_newline(line) == expected
+
+
+_compact_script = u"""\
+#[sht] command_prompt = $
+$ echo hello
+hello
+$ # comment
+ignored
+$ printf 'a\\\\
+b'
+a\\
+b
+$ true
+$ echo é
+é
+
+"""
+
+
+def test_compact_parser(tmpdir):
+    path = tmpdir.join('t.sh')
+    path.write_binary(_compact_script.encode('utf-8'))
+    tests = ShellTestParser(str(path)).parse()
+    compact = ShellTestParser(str(path), compact=True).parse()
+    assert len(tests) == len(compact) == 4
+    for t, c in zip(tests, compact):
+        assert isinstance(c, CompactShellTest)
+        assert (t.command, t.expected_output, t.source, dict(t.cfg)) == \
+            (c.command, c.expected_output, c.source, dict(c.cfg))
+
+
+def test_compact_parser_file_changed(tmpdir):
+    path = tmpdir.join('t.sh')
+    path.write_binary(_compact_script.encode('utf-8'))
+    compact = ShellTestParser(str(path), compact=True).parse()
+    path.write_binary(b'> echo changed\nchanged\n')
+    with pytest.raises(ValueError, match='changed since it was parsed'):
+        compact[0].expected_output
+
+
+def test_config_copy_on_write():
+    cfg = ShellTestConfig()
+    copy = cfg.copy()
+    copy.command_prompt = u'$'
+    assert cfg.command_prompt == u'>'
+    cfg.timeout = 1
+    assert copy.timeout is None
+
+
+def test_dependencies():
+    fobj = StringIO(
+    u"#[sht] independent = true\n"
+    u"> echo a\n"
+    u"> echo b #[sht] needs = 2\n"
+    u"> echo c #[sht] independent = false\n")
+    tests = ShellTestParser(fobj).parse()
+    assert [(t.command, t.cfg.independent, t.cfg.needs) for t in tests] == \
+        [(u'echo a', True, ()), (u'echo b', True, (2,)), (u'echo c', False, ())]
+    # only earlier commands can be needed
+    with pytest.raises(ValueError):
+        ShellTestParser(StringIO(u"> echo a #[sht] needs = 2\n> echo b\n")).parse()
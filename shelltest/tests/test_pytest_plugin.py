@@ -0,0 +1,30 @@
+import pytest
+
+
+pytest_plugins = 'pytester'
+
+
+@pytest.fixture
+def shelltests(pytester):
+    pytester.makefile('.sh', passing='> echo a\na\n> echo b\nb\n', failing='> echo a\nb\n')
+    pytester.makefile('.shtest', session='#[sht] session = true\n> x=1\n> echo $x\n1\n')
+    return pytester
+
+
+def test_plugin_disabled_by_default(shelltests):
+    result = shelltests.runpytest_inprocess('-p', 'shelltest.pytest_plugin')
+    result.assert_outcomes()
+
+
+def test_plugin_collects_and_runs(shelltests):
+    result = shelltests.runpytest_inprocess('-p', 'shelltest.pytest_plugin', '--shelltest', '-v')
+    result.assert_outcomes(passed=4, failed=1)
+    result.stdout.fnmatch_lines(['*passing.sh::test_line_1 PASSED*',
+                                 '*session.shtest::test_line_3 PASSED*',
+                                 '*Command failed due to unexpected output*'])
+
+
+def test_plugin_ini(shelltests):
+    shelltests.makeini('[pytest]\nshelltest = true\n')
+    result = shelltests.runpytest_inprocess('-p', 'shelltest.pytest_plugin', 'passing.sh')
+    result.assert_outcomes(passed=2)
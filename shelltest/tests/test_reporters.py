@@ -0,0 +1,72 @@
+import io
+import json
+import os
+import xml.etree.ElementTree as ET
+
+from shelltest.reporters import DurationsReporter, JsonLinesReporter, JUnitXmlReporter, report
+from shelltest.shelltest import (ShellTest, ShellTestConfig, ShellTestResultsFormatter,
+                                 ShellTestRunner, ShellTestSource)
+
+
+def results():
+    cfg = ShellTestConfig()
+    tests = [ShellTest('echo a', 'a\n', ShellTestSource('a.sh', 1), cfg),
+             ShellTest('printf "<\\033>"', 'b\n', ShellTestSource('a.sh', 3), cfg),
+             ShellTest('exit 3', '', ShellTestSource('b.sh', 1), cfg)]
+    return ShellTestRunner(tests).run()
+
+
+def test_json_lines_reporter():
+    out = io.StringIO()
+    seen = []
+    for r in report(results(), [JsonLinesReporter(out)]):
+        # each result is written before the next one is run
+        seen.append(r)
+        assert len(out.getvalue().splitlines()) == len(seen)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(l['file'], l['line'], l['success']) for l in lines] == \
+        [('a.sh', 1, True), ('a.sh', 3, False), ('b.sh', 1, False)]
+    assert 'actual_output' not in lines[0]
+    assert lines[1]['reason'] == 'unexpected output'
+    assert lines[1]['actual_output'] == '<\x1b>'
+    assert lines[2]['reason'] == 'non-zero return code'
+    assert lines[2]['ret_code'] == 3
+
+
+def test_junit_xml_reporter(tmpdir):
+    path = str(tmpdir.join('junit.xml'))
+    list(report(results(), [JUnitXmlReporter(path)]))
+    root = ET.parse(path).getroot()
+    suites = root.findall('testsuite')
+    assert [(s.get('name'), s.get('tests'), s.get('failures')) for s in suites] == \
+        [('a.sh', '2', '1'), ('b.sh', '1', '1')]
+    cases = root.findall('.//testcase')
+    assert [c.get('name') for c in cases] == ['echo a', 'printf "<\\033>"', 'exit 3']
+    assert cases[0].find('failure') is None
+    assert cases[1].find('failure').get('message') == 'unexpected output'
+
+
+def test_durations_reporter(tmpdir):
+    path = str(tmpdir.join('durations.json'))
+    rs = list(report(results(), [DurationsReporter(path, root=str(tmpdir))]))
+    with open(path) as f:
+        durations = json.load(f)
+    # names are relative to the current directory, keys to root
+    rel = os.path.relpath(os.getcwd(), str(tmpdir))
+    a, b = os.path.join(rel, 'a.sh'), os.path.join(rel, 'b.sh')
+    assert durations == {a: rs[0].usage.wall_time + rs[1].usage.wall_time,
+                         b: rs[2].usage.wall_time}
+
+
+def test_reporter_finished_when_closed():
+    out = io.StringIO()
+    gen = report(results(), [JUnitXmlReporter(out)])
+    next(gen)
+    gen.close()
+    assert out.getvalue().endswith('</testsuites>\n')
+
+
+def test_formatter_drops_passing_output():
+    fmt = ShellTestResultsFormatter(results())
+    assert [r.actual_output for r in fmt._results][0] == ''
+    assert [r.actual_output for r in fmt.failed_tests()] == ['<\x1b>', '']
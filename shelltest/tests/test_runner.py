@@ -1,10 +1,18 @@
 import os
+import resource
+import signal
+import subprocess
+import sys
 import tempfile
+import time
 import io
 
 import pytest
 
-from shelltest.shelltest import ShellTest, ShellTestSource, ShellTestRunner, ShellTestConfig, ShellTestParser
+from shelltest.shelltest import (ShellTest, ShellTestSource, ShellTestRunner, ShellTestConfig,
+                                 ShellTestParser, ShellTestProcessPool, ShellTestResultsFormatter,
+                                 ShellTestFixture)
+from shelltest.tests import barrier, command_test, write_tests
 
 
 def runner(tests):
@@ -46,3 +54,429 @@ def test_command_shell_changed():
     tests = p.parse()
     r = next(ShellTestRunner(tests).run())
     assert r.actual_output == u'bash\n'
+
+
+def test_run_jobs_groups_results_by_file():
+    tests = []
+    for name in ('b', 'a', 'c'):
+        cfg = ShellTestConfig()
+        for i in range(3):
+            cmd = u'echo {}{}'.format(name, i)
+            tests.append(ShellTest(cmd, u'{}{}\n'.format(name, i), ShellTestSource(name, i), cfg))
+    results = list(ShellTestRunner(tests).run(jobs=3))
+    assert [r.test for r in results] == tests
+    assert all(r.status.success for r in results)
+
+
+def test_run_jobs_show_tests(capsys):
+    cfg = ShellTestConfig()
+    tests = [ShellTest(u'sleep 0.{}; echo {}'.format(i % 2, i), u'{}\n'.format(i),
+                       ShellTestSource(str(i), 0), cfg) for i in range(6)]
+    list(ShellTestRunner(tests).run(show_tests=True, jobs=3))
+    lines = capsys.readouterr().out.splitlines()
+    # each test is shown on one complete line
+    assert sorted(lines) == sorted(u"exec: {!r} ... passed".format(t.command) for t in tests)
+
+
+def test_session_keeps_shell_state():
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"> X=5; f() { echo fn $1; }\n"
+    u"> echo $X; f 3\n"
+    u"5\n"
+    u"fn 3\n"
+    u"> printf abc; echo err >&2; false\n"
+    u"abc")
+    results = list(ShellTestRunner(ShellTestParser(fobj).parse()).run())
+    assert [r.status.success for r in results] == [True, True, False]
+    assert results[2].actual_output == u'abc'
+    assert results[2].err_output == u'err\n'
+    assert results[2].ret_code == 1
+
+
+def test_session_restarts_after_exit():
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"> X=5; exit 3\n"
+    u"> echo $X\n"
+    u"\n")
+    results = list(ShellTestRunner(ShellTestParser(fobj).parse()).run())
+    assert results[0].ret_code == 3
+    assert results[1].status.success
+
+
+def test_close_after_run_test():
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"> X=5\n"
+    u"> echo $X\n"
+    u"5\n")
+    r = ShellTestRunner(ShellTestParser(fobj).parse())
+    assert all(r.run_test(test).status.success for test in r.tests)
+    session = r._sessions[r.tests[0].source.name]
+    r.close()
+    assert not session.alive
+    assert not r._sessions
+
+
+def test_session_non_posix_shell():
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"#[sht] timeout = 10\n"
+    u"#[sht] command_shell = python -c\n"
+    u"> print('a')\n"
+    u"a\n"
+    u"> print('b')\n"
+    u"b\n")
+    r = ShellTestRunner(ShellTestParser(fobj).parse())
+    # commands of other shells are run on their own
+    assert [res.status.success for res in r.run()] == [True, True]
+    assert not r._sessions
+
+
+def test_session_incomplete_command():
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"#[sht] timeout = 10\n"
+    u"> X=5\n"
+    u"> echo \"unterminated\n"
+    u"> if true; then echo x\n"
+    u"> cat <<EOF\n"
+    u"> echo $X\n"
+    u"5\n")
+    results = list(ShellTestRunner(ShellTestParser(fobj).parse()).run())
+    # incomplete commands fail with a syntax error, the session carries on
+    assert [r.ret_code != 0 for r in results] == [False, True, True, False, False]
+    assert not any(r.status.timed_out for r in results)
+    assert results[4].status.success
+
+
+def test_session_show_output(capsys):
+    fobj = io.StringIO(
+    u"#[sht] session = true\n"
+    u"> echo a; echo b\n"
+    u"a\n"
+    u"b\n")
+    results = list(ShellTestRunner(ShellTestParser(fobj).parse()).run(show_output=True))
+    assert results[0].status.success
+    assert capsys.readouterr().out == u'>>> a\n>>> b\n'
+
+
+def test_large_stderr_does_not_block():
+    cmd = u"head -c 1000000 /dev/zero | tr '\\0' 'x' >&2; echo done"
+    res = next(runner([(cmd, u'done\n')]).run())
+    assert res.status.success
+    assert len(res.err_output) == 1000000
+
+
+def test_show_output_streams_lines(capsys):
+    res = next(runner([(u"printf 'a\\nb'; printf c", u'a\nbc')]).run(show_output=True))
+    assert res.status.success
+    assert capsys.readouterr().out == u'>>> a\n>>> bc\n'
+
+
+def test_timeout_kills_process_group():
+    cfg = ShellTestConfig()
+    cfg.timeout = 0.2
+    tests = [ShellTest(u'echo start; (sleep 10; echo bg) & sleep 10', u'start\n',
+                       ShellTestSource('', 0), cfg)]
+    res = next(ShellTestRunner(tests).run())
+    assert res.status.timed_out
+    assert not res.status.success
+    assert res.actual_output == u'start\n'
+    assert ShellTestResultsFormatter.format_result(res).startswith(
+        u'Command failed due to timeout')
+
+
+def test_total_timeout():
+    tests = [ShellTest(u'sleep 10', u'', ShellTestSource('', i), ShellTestConfig())
+             for i in range(2)]
+    results = list(ShellTestRunner(tests).run(total_timeout=0.2))
+    assert [r.status.timed_out for r in results] == [True, True]
+    # tests after the budget expired are not started
+    assert results[1].ret_code is None and results[1].usage is None
+    assert ShellTestResultsFormatter.failure_reason(results[1]) == 'timeout'
+
+
+def test_resource_usage():
+    res = next(runner([(u'i=0; while [ $i -lt 2000 ]; do i=$((i+1)); done', u'')]).run())
+    assert res.usage.wall_time > 0
+    assert res.usage.user_time + res.usage.system_time > 0
+    assert res.usage.max_rss > 0
+
+
+def test_format_durations():
+    results = list(runner([(u'sleep 0.1', u''), (u'true', u'')]).run())
+    out = ShellTestResultsFormatter(results).format(durations=1)
+    lines = out.split('\n')
+    assert lines[1] == u'slowest 1 test(s)'
+    assert lines[2].endswith(u"'sleep 0.1'")
+
+
+def test_setup_fixture(tmpdir):
+    tmpdir.join('data').write('x\n')
+    tests = write_tests(tmpdir, 'setup.sh',
+                        '#[sht] setup = cp "$SHELLTEST_DIR/data" . && echo y > generated\n'
+                        '> cat data generated\nx\ny\n'
+                        '> echo z > generated\n'
+                        '> cat generated\nz\n'
+                        '> test "$PWD" != "$SHELLTEST_DIR" && echo scratch\nscratch\n')
+    results = list(ShellTestRunner(tests).run())
+    assert [r.status.success for r in results] == [True] * 4
+    # the scratch directory is removed once all tests of the file have run
+    assert not tmpdir.join('generated').exists()
+
+
+def test_setup_fixture_isolated(tmpdir):
+    wait = barrier(tmpdir.join('barrier'), 4)
+    tests = write_tests(tmpdir, 'isolated.sh',
+                        '#[sht] setup = echo 0 > counter\n'
+                        '#[sht] isolated = true\n'
+                        '#[sht] timeout = 10\n' +
+                        ''.join('> {}cat counter; echo {} > counter\n0\n'.format(wait, i)
+                                for i in range(4)))
+    results = list(ShellTestRunner(tests).run(jobs=4))
+    # each test has its own copy of the fixture and tests run concurrently, they wait for
+    # each other at the barrier
+    assert [r.status.success for r in results] == [True] * 4
+    assert [r.test.source.line_num for r in results] == [4, 6, 8, 10]
+
+
+def test_fixture_copy(tmpdir):
+    cfg = ShellTestConfig()
+    cfg['setup'] = 'mkdir sub && echo x > sub/data && ln -s sub link'
+    fixture = ShellTestFixture(cfg, str(tmpdir))
+    fixture.setup()
+    try:
+        path = fixture.copy()
+        assert path != fixture.path
+        with open(os.path.join(path, 'sub', 'data')) as f:
+            assert f.read() == 'x\n'
+        assert os.path.islink(os.path.join(path, 'link'))
+        fixture.remove(path)
+        assert not os.path.exists(os.path.dirname(path))
+    finally:
+        fixture.close()
+    assert not os.path.exists(fixture.path)
+
+
+def test_setup_failed(tmpdir):
+    tests = write_tests(tmpdir, 'failed.sh',
+                        '#[sht] setup = echo broken >&2; exit 3\n'
+                        '> echo a\na\n')
+    res = next(ShellTestRunner(tests).run())
+    assert not res.status.success
+    assert res.status.setup_failed
+    assert res.ret_code == 3
+    msg = ShellTestResultsFormatter.format_result(res)
+    assert 'Command failed due to failed setup command' in msg
+    assert 'broken' in msg
+
+
+@pytest.mark.parametrize('ignore_trailing_whitespace', (True, False))
+def test_spilled_output(ignore_trailing_whitespace):
+    expected = ''.join('{}\n'.format(i) for i in range(20000))
+    test = command_test('seq 0 19999', expected, spill_output_bytes=1024,
+                        ignore_trailing_whitespace=ignore_trailing_whitespace)
+    res = ShellTestRunner([test]).run_test(test)
+    assert res.status.success
+    # only the start and end of the output are kept
+    assert len(res.actual_output) < 3 * 4096
+    assert res.actual_output.startswith('0\n1\n')
+    assert res.actual_output.endswith('19998\n19999\n')
+
+
+def test_spilled_output_mismatch():
+    expected = ''.join('{}\n'.format(i) for i in range(20000))
+    test = command_test('seq 0 19999 | sed s/^15000$/x/', expected, spill_output_bytes=1024)
+    res = ShellTestRunner([test]).run_test(test)
+    assert not res.status.success
+    assert res.mismatch.line_num == 15001
+    assert 'x' in res.mismatch.actual
+    assert '+x' in ShellTestResultsFormatter.format_result(res)
+
+
+def test_max_output_bytes():
+    test = command_test('yes', '', max_output_bytes=100000, timeout=10)
+    res = ShellTestRunner([test]).run_test(test)
+    assert not res.status.success
+    assert not res.status.timed_out
+    assert res.status.limit_exceeded == 'max_output_bytes'
+    assert 'Command failed due to exceeding max_output_bytes' in \
+        ShellTestResultsFormatter.format_result(res)
+
+
+def pooled_runner(tmpdir, content):
+    r = ShellTestRunner(write_tests(tmpdir, 'pooled.sh', '#[sht] prespawn = true\n' + content))
+    r._pool = ShellTestProcessPool(size=1)
+    return r
+
+
+def test_prespawned_processes_are_fresh(tmpdir):
+    r = pooled_runner(tmpdir,
+                      '> x=1; echo $$ > pid; echo "$0 $# $PWD"\nsh 0 {}\n'
+                      '> echo "[$x] [$cmd] [$line]"; test "$(cat pid)" != $$ && echo new\n'
+                      '[] [] []\nnew\n'
+                      '> printf \'%s\\n\' "  a\\tb" \\\n'
+                      '  "c"\n  a\\tb\nc\n'
+                      '> for fd in 3 4 5 6 7 8 9; do [ -e /dev/fd/$fd ] && echo $fd; done; cat\n'
+                      '> exit 3\n'.format(tmpdir))
+    results = list(r.run())
+    assert [res.status.success for res in results] == [True, True, True, True, False]
+    assert results[-1].ret_code == 3
+    # idle processes are stopped once the tests of their file have run
+    assert not any(r._pool._idle.values())
+
+
+def test_prespawned_process_timeout(tmpdir):
+    r = pooled_runner(tmpdir, '#[sht] timeout = 0.2\n> sleep 10\n> echo ok\nok\n')
+    results = list(r.run())
+    assert results[0].status.timed_out
+    assert results[1].status.success
+
+
+def test_prespawn_disabled_or_unsupported_shell(tmpdir):
+    r = pooled_runner(tmpdir, '#[sht] prespawn = false\n> echo $0\nsh\n')
+    assert next(r.run()).status.success
+    r = pooled_runner(tmpdir, '#[sht] command_shell = python -c\n> print(1)\n1\n> print(2)\n2\n')
+    assert [res.status.success for res in r.run()] == [True, True]
+    assert not r._pool._idle
+
+
+def test_stdin_is_inherited(tmpdir):
+    path = tmpdir.join('stdin.sh')
+    path.write('> cat\ninput\n')
+    script = ('import sys\n'
+              'from shelltest.shelltest import ShellTestParser, ShellTestRunner\n'
+              'r = next(ShellTestRunner(ShellTestParser(sys.argv[1]).parse()).run())\n'
+              'sys.exit(not r.status.success)\n')
+    proc = subprocess.run([sys.executable, '-c', script, str(path)], input=b'input\n')
+    assert proc.returncode == 0
+
+
+def _alive(pid):
+    """True unless pid has exited, zombies have exited"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            return 'State:\tZ' not in f.read()
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.parametrize('jobs,session', [(1, False), (2, False), (1, True)])
+def test_interrupt_kills_commands(tmpdir, jobs, session):
+    # commands run in their own session, the terminal's SIGINT only reaches shelltest
+    path = tmpdir.join('interrupt.sh')
+    pid_path = tmpdir.join('pid')
+    path.write('#[sht] session = {}\n> echo $$ > {}; exec sleep 37\n'.format(
+        str(session).lower(), pid_path))
+    script = ('import sys\n'
+              'from shelltest.shelltest import ShellTestParser, ShellTestRunner\n'
+              'r = ShellTestRunner(ShellTestParser(sys.argv[1]).parse())\n'
+              'list(r.run(jobs=int(sys.argv[2])))\n')
+    proc = subprocess.Popen([sys.executable, '-c', script, str(path), str(jobs)],
+                            stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not (pid_path.exists() and pid_path.read().strip()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    pid = int(pid_path.read())
+    proc.send_signal(signal.SIGINT)
+    assert proc.wait(10) != 0
+    assert not _alive(pid)
+
+
+def test_process_pool_launcher_failed(tmpdir, monkeypatch):
+    # commands are started directly when the launcher is gone before it gets its command
+    monkeypatch.setattr('shelltest.shelltest._PooledProcess.start', lambda *args: False)
+    pool = ShellTestProcessPool(size=0)
+    try:
+        with pool.popen('a.sh', ['sh', '-c'], 'ulimit -n', str(tmpdir), dict(os.environ),
+                        rlimits=[(resource.RLIMIT_NOFILE, 20)]) as p:
+            assert p.communicate()[0] == b'20\n'
+    finally:
+        pool.close()
+
+
+def test_process_pool_reuses_idle_process(tmpdir):
+    pool = ShellTestProcessPool(size=1)
+    env = {'PATH': os.environ['PATH']}
+    try:
+        with pool.popen('a.sh', ['sh', '-c'], 'true', str(tmpdir), env) as p:
+            p.wait()
+        for futures in pool._spawning.values():
+            for f in futures:
+                f.result()
+        idle = [proc.proc.pid for procs in pool._idle.values() for proc in procs]
+        with pool.popen('a.sh', ['sh', '-c'], 'echo $$', str(tmpdir), env, refill=False) as p:
+            out = p.stdout.read()
+            p.wait()
+        assert [p.pid] == idle
+        assert out == '{}\n'.format(p.pid).encode()
+    finally:
+        pool.close()
+
+
+def test_resource_limits():
+    test = command_test(u'{} -c "while True: pass"'.format(sys.executable), timeout=10,
+                        max_cpu_seconds=1)
+    res = ShellTestRunner([test]).run_test(test)
+    assert not res.status.success
+    assert not res.status.timed_out
+    assert res.status.limit_exceeded == 'max_cpu_seconds'
+    assert 'Command failed due to exceeding max_cpu_seconds' in \
+        ShellTestResultsFormatter.format_result(res)
+
+
+@pytest.mark.parametrize('code,option,value', (
+    (u'x = bytearray(512 * 2**20)', 'max_memory', 256 * 2**20),
+    (u"fs = [open('/dev/null') for i in range(100)]", 'max_open_files', 20),
+    # the error of a limit is only a hint, other failures report it too
+    (u"import sys; sys.exit('Resource temporarily unavailable')", 'max_processes', 1000),
+))
+def test_resource_limit_hints(code, option, value):
+    test = command_test(u'{} -c "{}"'.format(sys.executable, code), timeout=10,
+                        **{option: value})
+    res = ShellTestRunner([test]).run_test(test)
+    assert not res.status.success
+    assert res.status.limit_exceeded is None
+    assert 'Command failed due to non-zero return code, possibly from exceeding {}'.format(
+        option) in ShellTestResultsFormatter.format_result(res)
+
+
+def test_resource_limits_within_limits(tmpdir):
+    code = u"fs = [open('/dev/null') for i in range(5)]"
+    test = command_test(u'{} -c "{}"'.format(sys.executable, code), timeout=10,
+                        max_open_files=20, max_memory=2**30)
+    assert ShellTestRunner([test]).run_test(test).status.success
+    # limits are set on prespawned processes as well
+    r = pooled_runner(tmpdir, '#[sht] max_open_files = 20\n> ulimit -n\n20\n> ulimit -n\n20\n')
+    assert [res.status.success for res in r.run()] == [True, True]
+
+
+def dag_tests(wait=''):
+    return ('#[sht] independent = true\n'
+            '#[sht] timeout = 10\n'
+            '> {0}echo a > a\n'
+            '> {0}echo b > b\n'
+            '> {0}echo c\nc\n'
+            '> cat a b #[sht] needs = 3, 4\na\nb\n'
+            '> rm a b #[sht] independent = false\n').format(wait)
+
+
+def test_dependencies(tmpdir):
+    # the independent tests wait for each other at the barrier, they only pass when they run
+    # concurrently
+    tests = write_tests(tmpdir, 'dag.sh', dag_tests(barrier(tmpdir.join('barrier'), 3)))
+    tests += write_tests(tmpdir, 'serial.sh', '> echo a\na\n> echo b\nb\n')
+    tests += write_tests(tmpdir, 'session.sh', '#[sht] independent = true\n'
+                                               '#[sht] session = true\n> X=1\n> echo $X\n1\n')
+    r = ShellTestRunner(tests)
+    # the last test waits for the tests nothing waits for yet, the others through them
+    assert r._dependencies() == [set(), set(), set(), {0, 1}, {2, 3}, set(), {5}, set(), {7}]
+    results = list(r.run(jobs=4))
+    assert all(res.status.success for res in results)
+    # results are reported in line order
+    assert [res.test for res in results] == tests
+    results = list(ShellTestRunner(write_tests(tmpdir, 'dag.sh', dag_tests())).run())
+    assert all(res.status.success for res in results)
@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+from shelltest.cache import ShellTestRunHistory
+from shelltest.shelltest import (ShellTest, ShellTestConfig, ShellTestRunner, ShellTestSource,
+                                 run, shard_paths)
+
+
+@pytest.fixture
+def files(tmpdir):
+    paths = []
+    for i, size in enumerate((400, 100, 100, 100, 100, 300)):
+        path = tmpdir.join('{}.sh'.format(i))
+        path.write('x' * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_shards_are_disjoint_and_complete(files):
+    shards = [shard_paths(files, i, 3) for i in range(1, 4)]
+    assert sorted(p for s in shards for p in s) == sorted(files)
+    assert shards == [shard_paths(files, i, 3) for i in range(1, 4)]
+    # shards keep the order paths were given in
+    for s in shards:
+        assert s == [p for p in files if p in s]
+
+
+def test_shards_balanced_by_size(files):
+    shards = [shard_paths(files, i, 2) for i in range(1, 3)]
+    sizes = [sum(os.path.getsize(p) for p in s) for s in shards]
+    assert sizes == [500, 600] or sizes == [600, 500]
+
+
+def test_shards_balanced_by_duration(files, tmpdir):
+    # one of the smallest files is the slowest, durations are keyed by relative path
+    durations = {os.path.basename(p): 1.0 for p in files}
+    durations[os.path.basename(files[1])] = 100.0
+    shards = [shard_paths(files, i, 2, durations, str(tmpdir)) for i in range(1, 3)]
+    assert [files[1]] in shards
+    with tmpdir.as_cwd():
+        assert shards == [shard_paths(files, i, 2, durations) for i in range(1, 3)]
+
+
+def test_unknown_durations_estimated_from_size(files):
+    durations = {os.path.abspath(files[1]): 10.0, os.path.abspath(files[2]): 10.0}
+    # 0.1s per byte, the unknown 400 and 300 byte files are the slowest
+    shards = [shard_paths(files, i, 2, durations) for i in range(1, 3)]
+    assert any(files[0] in s and files[5] not in s for s in shards)
+    assert any(files[5] in s and files[0] not in s for s in shards)
+
+
+def test_shards_do_not_depend_on_history(files, tmpdir):
+    for path in files:
+        tests = '> true\n' * (os.path.getsize(path) // 100)
+        with open(path, 'w') as f:
+            f.write(tests)
+    # each node has a different history, e.g. of the shard it ran last time
+    histories = []
+    for i, slow in enumerate((files[0], files[5])):
+        history = ShellTestRunHistory(str(tmpdir.join('cache{}'.format(i))))
+        tests = [ShellTest(u'sleep 0.1' if p == slow else u'true', u'', ShellTestSource(p, 1),
+                           ShellTestConfig()) for p in files]
+        list(history.record(ShellTestRunner(tests).run()))
+        histories.append(history)
+    shards = []
+    for index, history in zip((1, 2), histories):
+        results, fmt, failed = run(files, shard=(index, 2), history=history)
+        shards.append(set(r.test.source.name for r in fmt._results))
+    assert not shards[0] & shards[1]
+    assert shards[0] | shards[1] == set(files)
+
+
+def test_invalid_shard(files):
+    with pytest.raises(ValueError):
+        shard_paths(files, 0, 2)
+    with pytest.raises(ValueError):
+        shard_paths(files, 3, 2)
+
+
+def test_history_file_durations(tmpdir):
+    a, b = str(tmpdir.join('a.sh')), str(tmpdir.join('b.sh'))
+    tests = [ShellTest(u'true', u'', ShellTestSource(a, 1), ShellTestConfig()),
+             ShellTest(u'true', u'', ShellTestSource(a, 2), ShellTestConfig()),
+             ShellTest(u'sleep 0.1', u'', ShellTestSource(b, 1), ShellTestConfig())]
+    history = ShellTestRunHistory(str(tmpdir.join('cache')))
+    list(history.record(ShellTestRunner(tests).run()))
+    durations = history.file_durations()
+    assert set(durations) == {a, b}
+    assert durations[b] >= 0.1 > durations[a] > 0
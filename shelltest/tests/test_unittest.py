@@ -1,3 +1,20 @@
+import types
+
+import pytest
+
 from shelltest.unittest import create_unittests
 
 create_unittests('./shelltests')
+
+
+def test_create_unittests_twice(tmpdir):
+    tmpdir.join('a.sh').write('> echo a\na\n')
+    module = types.ModuleType('shelltests_module')
+    module.__file__ = str(tmpdir.join('test_module.py'))
+    create_unittests('.', module)
+    first = module.TestShell_a_sh
+    create_unittests('.', module)
+    assert module.TestShell_a_sh is not first
+    module.TestShell_a_sh = object()
+    with pytest.raises(ValueError):
+        create_unittests('.', module)
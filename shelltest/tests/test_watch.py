@@ -0,0 +1,94 @@
+import os
+import threading
+
+import pytest
+
+from shelltest.cache import ShellTestParseCache
+from shelltest.shelltest import CompactShellTest
+from shelltest.watch import _InotifyNotifier, ShellTestWatcher
+
+
+def touch(path, content):
+    st = os.stat(path) if os.path.exists(path) else None
+    with open(path, 'w') as f:
+        f.write(content)
+    if st is not None:
+        # make sure the mtime changes on file systems with a coarse resolution
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def tree(tmpdir):
+    tmpdir.mkdir('sub')
+    touch(str(tmpdir.join('a.sh')), '> echo a\na\n')
+    touch(str(tmpdir.join('sub', 'b.sh')), '#[sht] depends = ../tool\n> echo b\nb\n')
+    touch(str(tmpdir.join('tool')), '1')
+    return tmpdir
+
+
+def test_watcher_initial_files(tree):
+    w = ShellTestWatcher([str(tree)], inotify=False)
+    assert [os.path.relpath(p, str(tree)) for p in w.files] == ['a.sh', os.path.join('sub', 'b.sh')]
+    assert [t.command for t in w.tests(w.files)] == ['echo a', 'echo b']
+    assert w.poll() == []
+
+
+def test_watcher_modified_file(tree):
+    w = ShellTestWatcher([str(tree)], inotify=False)
+    touch(str(tree.join('a.sh')), '> echo c\nc\n')
+    assert w.poll() == [str(tree.join('a.sh'))]
+    assert [t.command for t in w.tests([str(tree.join('a.sh'))])] == ['echo c']
+
+
+def test_watcher_new_and_removed_files(tree):
+    w = ShellTestWatcher([str(tree)], inotify=False)
+    tree.mkdir('new')
+    touch(str(tree.join('new', 'c.sh')), '> echo c\nc\n')
+    assert w.poll() == [str(tree.join('new', 'c.sh'))]
+    tree.join('a.sh').remove()
+    assert w.poll() == []
+    assert str(tree.join('a.sh')) not in w.files
+
+
+def test_watcher_dependency(tree):
+    w = ShellTestWatcher([str(tree)], inotify=False)
+    touch(str(tree.join('tool')), '22')
+    assert w.poll() == [str(tree.join('sub', 'b.sh'))]
+    assert w.poll() == []
+
+
+def test_watcher_parse_error(tree, capsys):
+    w = ShellTestWatcher([str(tree)], inotify=False)
+    touch(str(tree.join('a.sh')), '#[sht] session = maybe\n> echo c\nc\n')
+    assert w.poll() == [str(tree.join('a.sh'))]
+    assert w.tests([str(tree.join('a.sh'))]) == []
+    assert 'can not parse {}'.format(tree.join('a.sh')) in capsys.readouterr().err
+    assert w.poll() == []
+    touch(str(tree.join('a.sh')), '> echo c\nc\n')
+    assert w.poll() == [str(tree.join('a.sh'))]
+    assert [t.command for t in w.tests([str(tree.join('a.sh'))])] == ['echo c']
+
+
+def test_watcher_parse_options(tree, tmpdir):
+    parse_cache = ShellTestParseCache(str(tmpdir.join('cache')))
+    w = ShellTestWatcher([str(tree)], inotify=False, parse_cache=parse_cache, compact=True)
+    tests = w.tests(w.files)
+    assert all(isinstance(t, CompactShellTest) for t in tests)
+    assert [t.expected_output for t in tests] == ['a\n', 'b\n']
+    parse_cache.save()
+    assert os.listdir(str(tmpdir.join('cache')))
+
+
+def test_inotify_notifier(tmpdir):
+    try:
+        notifier = _InotifyNotifier()
+    except (OSError, AttributeError):
+        pytest.skip('inotify not available')
+    notifier.watch([str(tmpdir)])
+    timer = threading.Timer(0.05, touch, (str(tmpdir.join('a.sh')), 'x'))
+    timer.start()
+    try:
+        notifier.wait()
+    finally:
+        timer.join()
+        notifier.close()
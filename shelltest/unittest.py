@@ -46,7 +46,11 @@ class ShellTestCaseBase(unittest.TestCase):
     pass
 
 
-def create_unittests(path, module=None):
+def _is_shell_test_case(obj):
+    return isinstance(obj, type) and issubclass(obj, ShellTestCaseBase)
+
+
+def create_unittests(path, module=None, parse_cache=None):
     """Find unit tests in path and create classes on the calling module representing the test cases
     Parameters
     ==========
@@ -55,6 +59,8 @@ def create_unittests(path, module=None):
     module : python module (supporting attributes .__file__ and .__dict__)
         module to add test cases to
         defaults to the module of the call site
+    parse_cache : ShellTestParseCache (default: None)
+        cache of previously parsed shell test files
 
     Each shell test file is converted to a test case with each command converted to a single test
     """
@@ -67,10 +73,17 @@ def create_unittests(path, module=None):
     tests_path = os.path.abspath(os.path.join(dirname, path))
 
     finder = ShellTestFileFinder(tests_path)
-    parsers = [ShellTestParser(p) for p in finder.find_paths()]
+    parsers = [ShellTestParser(p, cache=parse_cache) for p in finder.find_paths()]
+    created = set()
     for p in parsers:
         cls_name = str(get_class_name(p.path, tests_path))
+        existing = mod_dict.get(cls_name)
+        # classes from an earlier call, e.g. when the module is imported twice, are replaced
+        if cls_name in created or (existing is not None and not _is_shell_test_case(existing)):
+            raise ValueError('Duplicate class name {!r} created for {!r}'.format(cls_name, p.path))
+        created.add(cls_name)
         cls_members = { get_test_name(test):new_test_method(test) for test in p.parse() }
-        assert cls_name not in mod_dict, 'Duplicate class name created'
         log.debug('creating class %r with members %r', cls_name, cls_members)
         mod_dict[cls_name] = (type(cls_name, (ShellTestCaseBase,), cls_members))
+    if parse_cache is not None:
+        parse_cache.save()
@@ -0,0 +1,258 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sys
+import time
+
+from shelltest.shelltest import (ShellTestConfig, ShellTestFileFinder, ShellTestParser,
+                                 ShellTestResultsFormatter, ShellTestRunner)
+
+
+log = logging.getLogger(__name__)
+
+
+# inotify(7) events that change the contents of a directory or a file in it
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_ONLYDIR = 0x1000000
+_IN_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE
+_IN_MASK |= _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR
+
+
+def _stamp(path):
+    """State of a file that changes when it is modified, None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class _PollNotifier:
+    """Wakes up every interval seconds, changes are found by comparing stat results"""
+
+    def __init__(self, interval):
+        self._interval = interval
+
+    def watch(self, dirs):
+        pass
+
+    def wait(self):
+        time.sleep(self._interval)
+
+    def close(self):
+        pass
+
+
+class _InotifyNotifier:
+    """Wakes up when inotify reports a change in one of the watched directories"""
+
+    # wait a little after the first event so a burst of writes is handled at once
+    debounce = 0.05
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._fd = fd
+        self._watched = set()
+
+    def watch(self, dirs):
+        for d in set(dirs) - self._watched:
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), _IN_MASK)
+            if wd < 0:
+                log.debug('can not watch %r: %s', d, os.strerror(ctypes.get_errno()))
+                continue
+            self._watched.add(d)
+
+    def _drain(self):
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self):
+        select.select([self._fd], [], [])
+        time.sleep(self.debounce)
+        self._drain()
+        # directories that were removed lose their watch, they are added back once they exist
+        self._watched = set(d for d in self._watched if os.path.isdir(d))
+
+    def close(self):
+        os.close(self._fd)
+
+
+class ShellTestWatcher:
+    """ShellTestWatcher keeps track of shell test files and the files they depend on
+
+    Parsed tests are kept between polls and a file is only parsed again once it changes.
+    A file is affected by a change when it is new or modified, or when one of the files in
+    the `depends` option of its tests is modified.
+    """
+
+    def __init__(self, paths, cfg=None, include=None, exclude=None, interval=0.5,
+                 inotify=True, parse_cache=None, compact=False):
+        """Initialize a ShellTestWatcher
+        Parameters
+        ==========
+        paths : iterable of paths
+            shell test files and directories to watch
+        cfg : ShellTestConfig (default: None)
+        include, exclude : iterable of glob patterns (default: None)
+            passed to ShellTestFileFinder
+        interval : float (default: 0.5)
+            seconds between polls when inotify is not used
+        inotify : bool (default: True)
+            use inotify when it is available instead of polling
+        parse_cache : ShellTestParseCache (default: None)
+        compact : bool (default: False)
+            passed to ShellTestParser
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        self._paths = list(paths)
+        self._cfg = cfg or ShellTestConfig()
+        self._parse_cache = parse_cache
+        self._compact = compact
+        self._finder = ShellTestFileFinder(self._paths, self._cfg, include, exclude)
+        self._notifier = None
+        if inotify:
+            try:
+                self._notifier = _InotifyNotifier()
+            except (OSError, AttributeError) as e:
+                log.debug('inotify not available, polling: %s', e)
+        if self._notifier is None:
+            self._notifier = _PollNotifier(interval)
+        self._files = []
+        self._dirs = {}
+        self._stamps = {}
+        self._tests = {}
+        self._depends = {}
+        self._scan()
+        for path in self._files:
+            self._parse(path)
+
+    @property
+    def files(self):
+        """Shell test files in the order they were found"""
+        return list(self._files)
+
+    def _scan(self):
+        """Find shell test files, returning the ones that are new"""
+        files = list(self._finder.find_paths())
+        dirs = set(self._finder.searched_dirs)
+        dirs.update(os.path.dirname(os.path.abspath(p)) for p in self._paths
+                    if not os.path.isdir(p))
+        dirs.update(os.path.dirname(dep) for deps in self._depends.values() for dep in deps)
+        self._dirs = {d: _stamp(d) for d in dirs}
+        self._notifier.watch(dirs)
+        new = [p for p in files if p not in self._stamps]
+        for path in set(self._stamps) - set(files):
+            log.debug('%r was removed', path)
+            del self._stamps[path]
+            self._tests.pop(path, None)
+            self._depends.pop(path, None)
+        self._files = files
+        return new
+
+    def _parse(self, path):
+        self._stamps[path] = _stamp(path)
+        try:
+            tests = ShellTestParser(path, self._cfg, self._parse_cache, self._compact).parse()
+        except OSError as e:
+            log.debug('can not parse %r: %s', path, e)
+            tests = []
+        except ValueError as e:
+            # the stamp is kept, the file is parsed again once it is saved with the error fixed
+            print('can not parse {}: {}'.format(path, e), file=sys.stderr)
+            tests = []
+        self._tests[path] = tests
+        cwd = os.path.dirname(os.path.abspath(path))
+        deps = set(os.path.join(cwd, dep) for t in tests for dep in t.cfg.depends)
+        self._depends[path] = {dep: _stamp(dep) for dep in deps}
+        new_dirs = set(os.path.dirname(dep) for dep in deps) - set(self._dirs)
+        if new_dirs:
+            self._dirs.update((d, _stamp(d)) for d in new_dirs)
+            self._notifier.watch(new_dirs)
+
+    def poll(self):
+        """Check for changes
+        Returns
+        =======
+        list of shell test files affected by changes since the last poll
+        """
+        changed = set()
+        if any(_stamp(d) != stamp for d, stamp in self._dirs.items()):
+            changed.update(self._scan())
+        for path in self._files:
+            if path in changed or _stamp(path) != self._stamps.get(path):
+                changed.add(path)
+            elif any(_stamp(dep) != stamp for dep, stamp in self._depends[path].items()):
+                log.debug('a dependency of %r changed', path)
+                changed.add(path)
+        for path in changed:
+            self._parse(path)
+        return [p for p in self._files if p in changed]
+
+    def tests(self, paths):
+        """Parsed tests of the shell test files paths"""
+        return [t for p in paths for t in self._tests.get(p, ())]
+
+    def changes(self):
+        """Generator of lists of affected files, all files are yielded first"""
+        yield self.files
+        while True:
+            self._notifier.wait()
+            changed = self.poll()
+            if changed:
+                yield changed
+
+    def close(self):
+        self._notifier.close()
+
+
+def watch(paths, show_tests=False, show_output=False, jobs=1, cfg=None, include=None,
+          exclude=None, durations=0, interval=0.5, total_timeout=None, cache=None,
+          parse_cache=None, compact=False):
+    """Run shell tests, then run them again as files change, until interrupted
+    Parameters
+    ==========
+    paths : iterable of paths
+    interval : float (default: 0.5)
+        seconds between polls when inotify is not available
+    total_timeout : float (default: None)
+        seconds each run of the affected tests may take
+
+    The remaining parameters are those of shelltest.run
+    """
+    watcher = ShellTestWatcher(paths, cfg, include, exclude, interval,
+                               parse_cache=parse_cache, compact=compact)
+    try:
+        for files in watcher.changes():
+            if parse_cache is not None:
+                parse_cache.save()
+            tests = watcher.tests(files)
+            runner = ShellTestRunner(tests, cache)
+            fmt = ShellTestResultsFormatter(runner.run(show_tests, show_output, jobs,
+                                                       total_timeout))
+            print(fmt.format(durations=durations))
+            if cache is not None:
+                cache.save()
+            print('watching {} file(s) for changes'.format(len(watcher.files)), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()